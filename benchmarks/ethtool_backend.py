@@ -0,0 +1,76 @@
+"""
+Benchmark of reading ethtool settings of a device.
+
+Creates a veth pair (or a device of another kind) and reports reads per
+second of the link settings, offload features, coalescing and pause frame
+settings done through the SIOCETHTOOL ioctl and through the ethtool command.
+Runs in the current network namespace and requires root:
+
+    python -m benchmarks.ethtool_backend --count 1000
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import time
+import argparse
+import subprocess
+import pyroute2
+from lnst.Common import EthtoolIoctl
+from lnst.Common.EthtoolIoctl import EthtoolNotSupported
+from lnst.Common.Utils import is_installed
+
+def bench(name, count, func):
+    try:
+        func()
+    except (EthtoolNotSupported, subprocess.CalledProcessError) as e:
+        print("{:<28} not supported: {}".format(name, e))
+        return
+
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.1f} reads/s".format(name, count / elapsed))
+
+def ethtool_cmd(*args):
+    subprocess.run(["ethtool"] + list(args), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000,
+                        help="number of reads of each setting")
+    parser.add_argument("--ifname", default="lnstbench0")
+    parser.add_argument("--kind", default="veth",
+                        help="link kind of the created device")
+    args = parser.parse_args()
+    ifname = args.ifname
+
+    with pyroute2.IPRoute() as ipr:
+        if args.kind == "veth":
+            ipr.link("add", ifname=ifname, kind="veth",
+                     peer="{}p".format(ifname))
+        else:
+            ipr.link("add", ifname=ifname, kind=args.kind)
+    try:
+        reads = [
+            ("link settings", EthtoolIoctl.get_link_settings, []),
+            ("features", EthtoolIoctl.get_features, ["-k"]),
+            ("coalescing", EthtoolIoctl.get_coalesce, ["-c"]),
+            ("pause frames", EthtoolIoctl.get_pause, ["-a"]),
+        ]
+        for name, ioctl_func, cmd_args in reads:
+            bench("ioctl " + name, args.count, lambda: ioctl_func(ifname))
+            if is_installed("ethtool"):
+                bench("command " + name, args.count,
+                      lambda: ethtool_cmd(*(cmd_args + [ifname])))
+        if not is_installed("ethtool"):
+            print("ethtool command not installed, skipped")
+    finally:
+        with pyroute2.IPRoute() as ipr:
+            ipr.link("del", ifname=ifname)
+
+if __name__ == "__main__":
+    main()
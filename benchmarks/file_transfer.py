@@ -0,0 +1,97 @@
+"""
+Throughput benchmark of the Controller <-> Agent file transfer.
+
+Connects to a running agent and reports MB/s of the legacy one call per chunk
+transfer and of the pipelined stream transfer, in both directions and with
+each available compression. Optionally emulates a high latency link to the
+agent by adding a netem delay to the loopback device (requires root and a
+local agent):
+
+    python -m lnst.Agent -p 9998 &
+    python -m benchmarks.file_transfer --port 9998 --delay 10ms
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+from lnst.Common.Logs import LoggingCtl
+from lnst.Common.FileTransfer import available_compressions
+from lnst.Controller.Config import CtlConfig
+from lnst.Controller.MessageDispatcher import MessageDispatcher
+from lnst.Controller.Machine import Machine
+
+def connect(hostname, port):
+    log_ctl = LoggingCtl(0, log_dir=tempfile.mkdtemp(), log_subdir="bench",
+                         colours=False)
+    msg_dispatcher = MessageDispatcher(log_ctl)
+    machine = Machine("bench", hostname, msg_dispatcher, CtlConfig(),
+                      rpcport=port, security={"auth_type": "none"})
+    machine.init_connection()
+    log_ctl.add_agent("bench")
+    return machine
+
+def bench(name, size, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.1f} MB/s".format(name, size / elapsed / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--size", type=int, default=128,
+                        help="size of the transferred file in MB")
+    parser.add_argument("--delay", default=None,
+                        help="netem delay added to the lo device, e.g. 10ms")
+    args = parser.parse_args()
+
+    machine = connect(args.host, args.port)
+    size = args.size * 1024 * 1024
+
+    # half random, half compressible content
+    local = tempfile.NamedTemporaryFile(delete=False)
+    local.write(os.urandom(size // 2))
+    local.write(b"lnst" * (size // 8))
+    local.close()
+    pulled = local.name + ".pulled"
+
+    if args.delay:
+        subprocess.check_call(["tc", "qdisc", "add", "dev", "lo", "root",
+                               "netem", "delay", args.delay])
+    try:
+        remote = machine._copy_file_to_machine_legacy(local.name)
+        bench("legacy push", size,
+              lambda: machine._copy_file_to_machine_legacy(local.name,
+                                                           remote))
+        bench("legacy pull", size,
+              lambda: machine._copy_file_from_machine_legacy(remote, pulled))
+
+        for compression in [None] + available_compressions():
+            try:
+                machine._supports_file_stream(compression)
+            except Exception as e:
+                print("{:<28} {}".format("stream %s" % compression, e))
+                continue
+
+            bench("stream push (%s)" % compression, size,
+                  lambda: machine.copy_file_to_machine(
+                      local.name, remote, compression=compression))
+            bench("stream pull (%s)" % compression, size,
+                  lambda: machine.copy_file_from_machine(
+                      remote, pulled, compression=compression))
+    finally:
+        if args.delay:
+            subprocess.call(["tc", "qdisc", "del", "dev", "lo", "root"])
+        os.unlink(local.name)
+        if os.path.exists(pulled):
+            os.unlink(pulled)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of the netlink requests done by Device objects on the Agent.
+
+Creates a dummy device, adds and removes N addresses to it through the
+Device netlink request path of an InterfaceManager and reports operations
+per second, once with a new IPRoute socket per request (the old behaviour)
+and once with the shared IPRouteSession. Runs in the current network
+namespace and requires root:
+
+    python -m benchmarks.netlink_session --count 1000
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import time
+import argparse
+import ipaddress
+import pyroute2
+from lnst.Agent.InterfaceManager import InterfaceManager
+from lnst.Agent.NetlinkSession import IPRouteSession
+from lnst.Devices.Device import Device
+from lnst.Devices.LoopbackDevice import LoopbackDevice
+
+class PerRequestSession(IPRouteSession):
+    """opens a new IPRoute socket for every request"""
+    def call(self, obj_name, op_name, *args, **kwargs):
+        try:
+            return super(PerRequestSession, self).call(obj_name, op_name,
+                                                       *args, **kwargs)
+        finally:
+            self.close()
+
+class DiscardingServerHandler(object):
+    """drops the device updates normally sent to the Controller"""
+    def send_data_to_ctl(self, data):
+        pass
+
+def bench(name, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.1f} ops/s".format(name, count / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000,
+                        help="number of configured addresses")
+    parser.add_argument("--ifname", default="lnstbench0")
+    parser.add_argument("--kind", default="dummy",
+                        help="link kind of the created device")
+    args = parser.parse_args()
+
+    addrs = list(ipaddress.ip_network("10.0.0.0/8").hosts())[:args.count]
+
+    with pyroute2.IPRoute() as ipr:
+        ipr.link("add", ifname=args.ifname, kind=args.kind)
+    try:
+        if_manager = InterfaceManager(DiscardingServerHandler())
+        if_manager.add_device_class("Device", Device)
+        if_manager.add_device_class("LoopbackDevice", LoopbackDevice)
+        if_manager.rescan_devices()
+        dev = if_manager.get_device_by_name(args.ifname)
+
+        def add_addrs():
+            for addr in addrs:
+                dev._ipr_wrapper("addr", "add", index=dev.ifindex,
+                                 address=str(addr), mask=32)
+
+        def del_addrs():
+            for addr in addrs:
+                dev._ipr_wrapper("addr", "del", index=dev.ifindex,
+                                 address=str(addr), mask=32)
+
+        for name, session in [("per request", PerRequestSession()),
+                              ("session", IPRouteSession())]:
+            if_manager._ipr_session = session
+            bench("{} addr add".format(name), len(addrs), add_addrs)
+            bench("{} addr del".format(name), len(addrs), del_addrs)
+            session.close()
+        if_manager.close()
+    finally:
+        with pyroute2.IPRoute() as ipr:
+            ipr.link("del", ifname=args.ifname)
+
+if __name__ == "__main__":
+    main()
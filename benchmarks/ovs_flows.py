@@ -0,0 +1,78 @@
+"""
+Benchmark of OpenFlow programming of OvsBridgeDevice.
+
+Creates an Open vSwitch bridge and adds N flows to it, once with an
+ovs-ofctl add-flow call per flow (the old flows_add behaviour), once with
+a single add-flows call and once in a single bundle. Then it dumps and
+parses the flows. Requires root and a running Open vSwitch:
+
+    python -m benchmarks.ovs_flows --count 10000
+
+The per flow variant forks ovs-ofctl N times, --per-flow-count limits it
+to fewer flows, its rate is still reported per flow.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import time
+import argparse
+import ipaddress
+from lnst.Common.ExecCmd import exec_cmd
+from lnst.Devices.OvsBridgeDevice import ofctl_add_flows, parse_dump_flows
+
+def bench(name, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.1f} flows/s {:>9.3f} s".format(name, count / elapsed,
+                                                       elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10000,
+                        help="number of added flows")
+    parser.add_argument("--per-flow-count", type=int, default=None,
+                        help="number of flows added one by one, "
+                             "defaults to --count")
+    parser.add_argument("--bridge", default="lnstbench0")
+    args = parser.parse_args()
+
+    hosts = ipaddress.ip_network("10.0.0.0/8").hosts()
+    entries = ["priority=100,ip,nw_dst={},actions=drop".format(next(hosts))
+               for i in range(args.count)]
+    per_flow_entries = entries[:args.per_flow_count or args.count]
+
+    exec_cmd("ovs-vsctl add-br {}".format(args.bridge))
+    try:
+        def per_flow():
+            for entry in per_flow_entries:
+                exec_cmd("ovs-ofctl add-flow {} '{}'".format(args.bridge,
+                                                             entry))
+
+        def del_flows():
+            exec_cmd("ovs-ofctl del-flows {}".format(args.bridge))
+
+        bench("add-flow per flow", len(per_flow_entries), per_flow)
+        del_flows()
+        bench("add-flows", len(entries),
+              lambda: ofctl_add_flows(args.bridge, entries, bundle=False))
+        del_flows()
+        bench("add-flows --bundle", len(entries),
+              lambda: ofctl_add_flows(args.bridge, entries))
+
+        flows = []
+        def dump():
+            out = exec_cmd("ovs-ofctl dump-flows {}".format(args.bridge),
+                           log_outputs=False)[0]
+            flows.extend(parse_dump_flows(out))
+        bench("dump-flows and parse", len(entries), dump)
+        if len(flows) != len(entries):
+            print("expected {} flows, dumped {}".format(len(entries),
+                                                         len(flows)))
+    finally:
+        exec_cmd("ovs-vsctl del-br {}".format(args.bridge))
+
+if __name__ == "__main__":
+    main()
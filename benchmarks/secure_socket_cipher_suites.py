@@ -0,0 +1,81 @@
+"""
+Throughput benchmark of the SecureSocket record protection cipher suites.
+
+Sets up a keyed SecureSocket pair over a socketpair (skipping the
+authentication handshake) and reports MB/s for each cipher suite on 1KB,
+64KB and 8MB payloads. Run from the repository root:
+
+    python -m benchmarks.secure_socket_cipher_suites
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+from lnst.Common.SecureSocket import SecureSocket, FRAMING_BINARY
+from lnst.Common.SecureSocket import SUPPORTED_CIPHER_SUITES
+
+SIZES = [1024, 64*1024, 8*1024*1024]
+TOTAL_BYTES = 256*1024*1024
+MAX_MSGS = 20000
+
+def keyed_socket_pair(cipher_suite):
+    a, b = socket.socketpair()
+    client = SecureSocket(a)
+    server = SecureSocket(b)
+    client._role = "client"
+    server._role = "server"
+
+    master_secret = os.urandom(48)
+    ctl_random = os.urandom(28)
+    agent_random = os.urandom(28)
+    for s in [client, server]:
+        s._master_secret = master_secret
+        s._ctl_random = ctl_random
+        s._agent_random = agent_random
+        s.set_framing(FRAMING_BINARY)
+        s.set_cipher_suite(cipher_suite)
+        s._init_cipher_spec()
+        s._change_read_cipher_spec()
+        s._change_write_cipher_spec()
+    return client, server
+
+def bench(cipher_suite, size):
+    sender, receiver = keyed_socket_pair(cipher_suite)
+
+    count = max(5, min(MAX_MSGS, TOTAL_BYTES // size))
+    payload = {"type": "result", "result": os.urandom(size)}
+
+    def send_all():
+        for _ in range(count):
+            sender.send_msg(payload)
+
+    t = threading.Thread(target=send_all)
+    start = time.perf_counter()
+    t.start()
+    for _ in range(count):
+        receiver.recv_msg()
+    elapsed = time.perf_counter() - start
+    t.join()
+
+    sender.close()
+    receiver.close()
+    return count / elapsed, count * size / elapsed / 2**20
+
+def main():
+    print("{:>24} {:>10} {:>12} {:>10}".format("cipher suite", "size",
+                                               "msgs/s", "MB/s"))
+    for size in SIZES:
+        for cipher_suite in SUPPORTED_CIPHER_SUITES:
+            msgs, mbs = bench(cipher_suite, size)
+            print("{:>24} {:>10} {:>12.0f} {:>10.1f}".format(
+                cipher_suite, size, msgs, mbs))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
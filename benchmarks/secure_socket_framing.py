@@ -0,0 +1,63 @@
+"""
+Microbenchmark of the SecureSocket wire framing.
+
+Pushes messages of several sizes through a socketpair and reports messages/s
+and MB/s for each supported framing. Run from the repository root:
+
+    python -m benchmarks.secure_socket_framing
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import sys
+import time
+import socket
+import threading
+from lnst.Common.SecureSocket import SecureSocket
+from lnst.Common.SecureSocket import FRAMING_ASCII, FRAMING_BINARY
+
+FRAMING_NAMES = {FRAMING_ASCII: "ascii", FRAMING_BINARY: "binary"}
+
+SIZES = [64, 1024, 64*1024, 1024*1024]
+TOTAL_BYTES = 256*1024*1024
+MAX_MSGS = 20000
+
+def bench(framing, size):
+    a, b = socket.socketpair()
+    sender = SecureSocket(a)
+    receiver = SecureSocket(b)
+    sender.set_framing(framing)
+    receiver.set_framing(framing)
+
+    count = max(10, min(MAX_MSGS, TOTAL_BYTES // size))
+    payload = {"type": "result", "result": b"x" * size}
+
+    def send_all():
+        for _ in range(count):
+            sender.send_msg(payload)
+
+    t = threading.Thread(target=send_all)
+    start = time.perf_counter()
+    t.start()
+    for _ in range(count):
+        receiver.recv_msg()
+    elapsed = time.perf_counter() - start
+    t.join()
+
+    a.close()
+    b.close()
+    return count / elapsed, count * size / elapsed / 2**20
+
+def main():
+    print("{:>8} {:>10} {:>14} {:>10}".format("framing", "size", "msgs/s", "MB/s"))
+    for size in SIZES:
+        for framing in [FRAMING_ASCII, FRAMING_BINARY]:
+            msgs, mbs = bench(framing, size)
+            print("{:>8} {:>10} {:>14.0f} {:>10.1f}".format(
+                FRAMING_NAMES[framing], size, msgs, mbs))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
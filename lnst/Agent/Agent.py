@@ -12,6 +12,7 @@ jpirko@redhat.com (Jiri Pirko)
 """
 
 import signal
+import select
 import logging
 import os, stat
 import sys, traceback
@@ -21,14 +22,21 @@ import ctypes
 import multiprocessing
 import imp
 import types
-from time import sleep, time
+import itertools
+import tarfile
+import hashlib
+from time import sleep, time, perf_counter
 from inspect import isclass
+from collections import OrderedDict
 from tempfile import NamedTemporaryFile
 from lnst.Common.Logs import log_exc_traceback
 from lnst.Common.PacketCapture import PacketCapture
 from lnst.Common.Utils import die_when_parent_die
 from lnst.Common.ExecCmd import exec_cmd, ExecCmdFail
 from lnst.Common.ResourceCache import ResourceCache
+from lnst.Common.FileTransfer import available_compressions
+from lnst.Common.FileTransfer import compress, decompress
+from lnst.Common.FileTransfer import FileTransferError, StreamDigest
 from lnst.Common.Utils import check_process_running
 from lnst.Common.Utils import is_installed
 from lnst.Common.ConnectionHandler import send_data
@@ -37,7 +45,9 @@ from lnst.Common.Config import DefaultRPCPort
 from lnst.Common.DeviceRef import DeviceRef
 from lnst.Common.LnstError import LnstError
 from lnst.Common.DeviceError import DeviceDeleted, DeviceDisabled
-from lnst.Common.DeviceError import DeviceConfigValueError
+from lnst.Common.DeviceError import DeviceConfigValueError, DeviceNotFound
+from lnst.Common.DeviceError import DeviceConfigError
+from lnst.Common.DeviceError import DeviceFeatureNotSupported
 from lnst.Common.Parameters import Parameters
 from lnst.Common.IpAddress import ipaddress
 from lnst.Common.Version import lnst_version
@@ -49,6 +59,8 @@ from lnst.Agent.AgentSecSocket import AgentSecSocket, SecSocketException
 # maximum time the server should block on select -- forces frequent Netlink
 # checks
 MAX_SERVER_HANG = 5
+# quiet time of the connections after which the netns pool is refilled
+NETNS_POOL_REFILL_DELAY = 0.05
 
 Devices = types.ModuleType("Devices")
 Devices.__path__ = ["lnst.Devices"]
@@ -85,13 +97,30 @@ class RemoteMethods:
         self._agent_server = agent_server
         self._agent_config = agent_config
 
+        # pre-forked network namespace processes by a temporary name
+        self._netns_pool = OrderedDict()
+        self._netns_pool_size = 0
+        self._netns_pool_ids = itertools.count()
+        # job pool size of a pre-forked namespace process once claimed
+        self._claim_job_pool_size = 0
+        self._netns_pool_stats = {"spawned": 0,
+                                  "claims": 0,
+                                  "claims_waited": 0,
+                                  "cold_starts": 0,
+                                  "init_time_total": 0.0,
+                                  "init_time_max": 0.0,
+                                  "claim_time_total": 0.0,
+                                  "claim_time_max": 0.0}
+
         self._capture_files = {}
         self._copy_targets = {}
         self._copy_sources = {}
+        self._stream_digests = {}
         self._system_config = {}
 
         self._cache = ResourceCache(agent_config.get_option("cache", "dir"),
-                                    agent_config.get_option("cache", "expiration_period"))
+                                    agent_config.get_option("cache", "expiration_period"),
+                                    agent_config.get_option("cache", "size_limit"))
 
         self._dynamic_modules = {}
         self._dynamic_classes = {}
@@ -111,6 +140,9 @@ class RemoteMethods:
         agent_desc["kernel_release"] = k_release.strip()
         agent_desc["redhat_release"] = r_release.strip()
         agent_desc["lnst_version"] = lnst_version
+        # presence of this key advertises support of the stream_* file
+        # transfer methods
+        agent_desc["file_stream_compressions"] = available_compressions()
 
         return ("hello", agent_desc)
 
@@ -144,6 +176,10 @@ class RemoteMethods:
         self._cache.del_old_entries()
         self.reset_file_transfers()
         self._remove_capture_files()
+        # the pre-forked processes carry the device classes of this session
+        self._netns_pool_size = 0
+        self._destroy_netns_workers(list(self._netns_pool.keys()))
+        self._job_context.get_pool().set_size(0)
         return "bye"
 
     def map_device_class(self, cls_name, module_name):
@@ -157,6 +193,15 @@ class RemoteMethods:
 
         setattr(Devices, cls_name, cls)
 
+    def map_device_classes(self, classes):
+        for cls_name, module_name in classes:
+            self.map_device_class(cls_name, module_name)
+
+    def load_cached_modules(self, modules):
+        """loads a list of (module_name, res_hash) modules in order"""
+        for module_name, res_hash in modules:
+            self.load_cached_module(module_name, res_hash)
+
     def load_cached_module(self, module_name, res_hash):
         self._cache.renew_entry(res_hash)
         if module_name in self._dynamic_modules:
@@ -221,7 +266,10 @@ class RemoteMethods:
         dev = self._if_manager.get_device(ifindex)
         method = getattr(dev, name)
 
-        return method(*args, **kwargs)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._if_manager.invalidate_if_data(ifindex)
 
     def dev_getattr(self, ifindex, name):
         dev = self._if_manager.get_device(ifindex)
@@ -229,56 +277,129 @@ class RemoteMethods:
 
     def dev_setattr(self, ifindex, name, value):
         dev = self._if_manager.get_device(ifindex)
-        return setattr(dev, name, value)
+        try:
+            return setattr(dev, name, value)
+        finally:
+            self._if_manager.invalidate_if_data(ifindex)
+
+    def dev_snapshot(self, ifindexes, expensive=False, skip=()):
+        """reads all public attributes of the devices in a single call
+
+        Returns a dictionary of ifindex to {"attrs": {name: value},
+        "costs": {name: seconds}}. Attributes not supported by a device are
+        left out, as are the attributes in skip and unless expensive is
+        True the ones listed in the _subprocess_attrs of the device class
+        as they run external commands.
+        """
+        result = {}
+        for ifindex in ifindexes:
+            dev = self._if_manager.get_device(ifindex)
+            dev_cls = type(dev)
+            attrs = {}
+            costs = {}
+            for name in dir(dev_cls):
+                if name[0] == '_' or name in skip:
+                    continue
+                if not expensive and name in dev_cls._subprocess_attrs:
+                    continue
+                if callable(getattr(dev_cls, name)):
+                    continue
+
+                start = perf_counter()
+                try:
+                    attrs[name] = getattr(dev, name)
+                except DeviceFeatureNotSupported as e:
+                    logging.debug(str(e))
+                costs[name] = perf_counter() - start
+            result[ifindex] = {"attrs": attrs, "costs": costs}
+        return result
+
+    def exec_batch(self, operations):
+        """executes a list of device operations in a single call
+
+        The operations are (op, ifindex, name, args, kwargs) tuples where op
+        is "method", "setattr" or "getattr". Returns a list of
+        ("result", value) or ("exception", exception) pairs, the execution
+        stops at the first failing operation. The value of
+        a "setattr" operation is the previous value of the attribute.
+        """
+        results = []
+        # the events of the previous operations are applied by get_device,
+        # the batch used to do a single dump
+        self._if_manager.sync_devices(replaces_dump=True)
+        for op, ifindex, name, args, kwargs in operations:
+            try:
+                dev = self._if_manager.get_device(ifindex,
+                                                  replaces_dump=False)
+                if op == "method":
+                    value = getattr(dev, name)(*args, **kwargs)
+                elif op == "setattr":
+                    value = getattr(dev, name)
+                    setattr(dev, name, args[0])
+                elif op == "getattr":
+                    value = getattr(dev, name)
+                else:
+                    raise LnstError("Unknown batch operation %s" % op)
+            except Exception as e:
+                # the reply covers every operation executed before this one
+                self._if_manager.invalidate_if_data(ifindex)
+                log_exc_traceback()
+                results.append(("exception", e))
+                break
+            self._if_manager.invalidate_if_data(ifindex)
+            results.append(("result", value))
+        return results
+
+    def wait_tentative_ips(self, ifindexes, timeout=5):
+        """waits for the end of duplicate address detection of all ip
+        addresses of the devices, returns False if it didn't finish in
+        time"""
+        devices = [self._if_manager.get_device(ifindex)
+                   for ifindex in ifindexes]
+
+        def condition():
+            return all([not ip.is_tentative
+                        for dev in devices for ip in dev.ips])
+
+        return self._if_manager.wait_for_condition(condition, timeout)
+
+    def set_device_update_events(self, enabled):
+        self._if_manager.set_update_events(enabled)
+        return True
+
+    def get_if_manager_stats(self):
+        """counters of the netlink device database: full dumps done and
+        avoided, resynchronizations and processed netlink messages"""
+        return self._if_manager.get_stats()
 
     def get_devices(self):
         devices = self._if_manager.get_devices()
         result = {}
         for device in devices:
-            result[device.ifindex] = device._get_if_data()
+            result[device.ifindex] = self._if_manager.get_if_data(device)
         return result
 
     def get_device(self, ifindex):
         device = self._if_manager.get_device(ifindex)
         if device:
-            return device._get_if_data()
+            return self._if_manager.get_if_data(device)
         else:
             return None
 
     def get_devices_by_devname(self, devname):
-        name_scan = self._if_manager.get_devices()
-        netdevs = []
-
-        for entry in name_scan:
-            if entry["name"] == devname:
-                netdevs.append(entry)
-        return netdevs
+        try:
+            device = self._if_manager.get_device_by_name(devname)
+        except DeviceNotFound:
+            return []
+        return [self._if_manager.get_if_data(device)]
 
     def get_devices_by_hwaddr(self, hwaddr):
-        devices = self._if_manager.get_devices()
-        matched = []
-        for dev in devices:
-            if dev.get_hwaddr() == hwaddr:
-                entry = {"name": dev.get_name(),
-                         "hwaddr": dev.get_hwaddr()}
-                matched.append(entry)
-        return matched
+        devices = self._if_manager.get_devices_by_params({"hwaddr": hwaddr})
+        return [{"name": dev.name, "hwaddr": dev.hwaddr} for dev in devices]
 
     def get_devices_by_params(self, params):
-        devices = self._if_manager.get_devices()
-        matched = []
-        for dev in devices:
-            dev_data = dev._get_if_data()
-            entry = {"name": dev.get_name(),
-                     "hwaddr": dev.get_hwaddr()}
-            for key, value in params.items():
-                if key not in dev_data or dev_data[key] != value:
-                    entry = None
-                    break
-
-            if entry is not None:
-                matched.append(entry)
-        return matched
+        devices = self._if_manager.get_devices_by_params(params)
+        return [{"name": dev.name, "hwaddr": dev.hwaddr} for dev in devices]
 
     def destroy_devices(self):
         if self._if_manager is None:
@@ -290,7 +411,7 @@ class RemoteMethods:
                 dev.destroy()
             except (DeviceDisabled, DeviceDeleted, DeviceConfigValueError):
                 pass
-            self._if_manager.rescan_devices()
+            self._if_manager.sync_devices(replaces_dump=True)
 
     # def add_route(self, if_id, dest):
         # dev = self._if_manager.get_mapped_device(if_id)
@@ -386,7 +507,7 @@ class RemoteMethods:
         return True
 
     def run_job(self, job):
-        job_instance = Job(job, self._log_ctl)
+        job_instance = Job(job, self._log_ctl, self._job_context.get_pool())
         self._job_context.add_job(job_instance)
 
         res = job_instance.run()
@@ -407,6 +528,18 @@ class RemoteMethods:
         self._job_context.cleanup()
         return "Commands killed"
 
+    def set_job_pool_size(self, size):
+        """sets the number of pre-forked processes for the shell jobs
+
+        The pool is refilled when no messages arrive for a while, the
+        network namespaces created afterwards keep pools of the same size.
+        """
+        self._job_context.get_pool().set_size(size)
+        return True
+
+    def get_job_pool_stats(self):
+        return self._job_context.get_pool_stats()
+
     def machine_cleanup(self):
         logging.info("Performing machine cleanup.")
         self._job_context.cleanup()
@@ -416,9 +549,10 @@ class RemoteMethods:
         if self._if_manager is not None:
             self._if_manager.deconfigure_all()
 
-        for netns in list(self._net_namespaces.keys()):
-            self.del_namespace(netns)
-        self._net_namespaces = {}
+        self.del_namespaces(list(self._net_namespaces.keys()))
+        self._net_namespaces.clear()
+        self._netns_pool_size = 0
+        self._destroy_netns_workers(list(self._netns_pool.keys()))
 
         for obj_id, obj in list(self._dynamic_objects.items()):
             del obj
@@ -434,6 +568,8 @@ class RemoteMethods:
         self._dynamic_objects = {}
         self._dynamic_classes = {}
         self._dynamic_modules = {}
+        if self._if_manager is not None:
+            self._if_manager.close()
         self._if_manager = None
         self._server_handler.set_if_manager(None)
         self._cache.del_old_entries()
@@ -446,6 +582,38 @@ class RemoteMethods:
 
         return False
 
+    def missing_resources(self, res_hashes):
+        return [res_hash for res_hash in res_hashes
+                if not self._cache.query(res_hash)]
+
+    def add_resource_archive(self, local_path, entries):
+        """adds the files of a tar archive to the resource cache
+
+        entries is a dictionary of the archive member names, which are the
+        sha256 digests of the files, to the resource names
+        """
+        try:
+            with tarfile.open(local_path, "r:*") as archive:
+                for member in archive.getmembers():
+                    if member.name not in entries or not member.isfile():
+                        raise LnstError("Unexpected resource archive member "
+                                        "{}".format(member.name))
+
+                    data = archive.extractfile(member).read()
+                    if hashlib.sha256(data).hexdigest() != member.name:
+                        raise LnstError("Digest mismatch of resource "
+                                        "{}".format(entries[member.name]))
+
+                    with NamedTemporaryFile("w+b", delete=False) as f:
+                        f.write(data)
+                    self._cache.add_file_entry(f.name, entries[member.name])
+        finally:
+            os.remove(local_path)
+        return True
+
+    def get_resource_cache_stats(self):
+        return self._cache.get_stats()
+
     def add_resource_to_cache(self, res_type, local_path, name):
         if res_type == "file":
             self._cache.add_file_entry(local_path, name)
@@ -501,6 +669,97 @@ class RemoteMethods:
 
         return False
 
+    def start_stream_to(self, filepath=None, resume=False):
+        """opens a file for a pipelined transfer to the agent
+
+        Returns the path of the file and the offset the transfer should
+        continue from, which is the current size of the file when resuming.
+        """
+        if filepath in self._copy_targets:
+            raise FileTransferError("File %s is already being transferred" %
+                                    filepath)
+
+        if filepath is None:
+            tmpfile = NamedTemporaryFile("w+b", delete=False)
+            filepath = tmpfile.name
+            self._copy_targets[filepath] = tmpfile
+            offset = 0
+        else:
+            resume = resume and os.path.exists(filepath)
+            try:
+                target = open(filepath, "r+b" if resume else "w+b")
+            except OSError as e:
+                raise FileTransferError("Cannot open %s: %s" % (filepath, e))
+            self._copy_targets[filepath] = target
+            offset = os.path.getsize(filepath) if resume else 0
+
+        self._stream_digests[filepath] = StreamDigest(filepath)
+        return filepath, offset
+
+    def stream_part_to(self, filepath, offset, data, compression=None):
+        try:
+            data = decompress(compression, data)
+            os.pwrite(self._copy_targets[filepath].fileno(), data, offset)
+            self._stream_digests[filepath].update(offset, data)
+        except Exception as e:
+            # the failed transfer can be started again
+            self.abort_stream(filepath)
+            raise FileTransferError("Transfer of %s failed: %s" %
+                                    (filepath, e))
+
+    def finish_stream_to(self, filepath, size, digest):
+        try:
+            target = self._copy_targets.pop(filepath)
+            target.truncate(size)
+            target.close()
+        except Exception as e:
+            self.abort_stream(filepath)
+            raise FileTransferError("Transfer of %s failed: %s" %
+                                    (filepath, e))
+
+        stream_digest = self._stream_digests.pop(filepath)
+        if stream_digest.hexdigest(size) != digest:
+            raise FileTransferError("Integrity check of %s failed" % filepath)
+        return True
+
+    def abort_stream(self, filepath):
+        """closes the file of a failed transfer in either direction"""
+        for files in [self._copy_targets, self._copy_sources]:
+            file_handle = files.pop(filepath, None)
+            if file_handle is not None:
+                file_handle.close()
+        self._stream_digests.pop(filepath, None)
+        return True
+
+    def start_stream_from(self, filepath):
+        """opens a file for a pipelined transfer from the agent
+
+        Returns the size of the file or None if it doesn't exist.
+        """
+        if filepath in self._copy_sources or not os.path.exists(filepath):
+            return None
+
+        self._copy_sources[filepath] = open(filepath, "rb")
+        self._stream_digests[filepath] = StreamDigest(filepath)
+        return os.fstat(self._copy_sources[filepath].fileno()).st_size
+
+    def stream_part_from(self, filepath, offset, size, compression=None):
+        try:
+            data = os.pread(self._copy_sources[filepath].fileno(), size,
+                            offset)
+            self._stream_digests[filepath].update(offset, data)
+            return compress(compression, data)
+        except Exception as e:
+            self.abort_stream(filepath)
+            raise FileTransferError("Transfer of %s failed: %s" %
+                                    (filepath, e))
+
+    def finish_stream_from(self, filepath, size):
+        """closes the transferred file and returns digest of its first size
+        bytes for the integrity check"""
+        self._copy_sources.pop(filepath).close()
+        return self._stream_digests.pop(filepath).hexdigest(size)
+
     def reset_file_transfers(self):
         for file_handle in self._copy_targets.values():
             file_handle.close()
@@ -509,122 +768,268 @@ class RemoteMethods:
         for file_handle in self._copy_sources.values():
             file_handle.close()
         self._copy_sources = {}
+        self._stream_digests = {}
 
     def add_namespace(self, netns):
+        """creates a named network namespace
+
+        The namespace is taken from the pool of pre-forked namespace
+        processes, see set_netns_pool_size, and only a bind mount and a
+        rename are done here. When the pool is empty a new process is
+        forked and waited for.
+        """
         if netns in self._net_namespaces:
             logging.debug("Network namespace %s already exists." % netns)
-        else:
-            logging.debug("Creating network namespace %s." % netns)
-            read_pipe, write_pipe = multiprocessing.Pipe()
-            pid = os.fork()
-            if pid != 0:
-                self._net_namespaces[netns] = {"pid": pid,
-                                               "pipe": read_pipe}
-                self._server_handler.add_netns(netns, read_pipe)
-
-                result = self._agent_server.wait_for_result(netns)
-                if result["result"] != True:
-                    raise Exception("Namespace creation failed")
-
-                return True
-            elif pid == 0:
-                self._agent_server.set_netns_sighandlers()
-                #create new network namespace
-                libc_name = ctypes.util.find_library("c")
-                #from sched.h
-                CLONE_NEWNET = 0x40000000
-                CLONE_NEWNS = 0x00020000
-                #based on ipnetns.c from the iproute2 project
-                MNT_DETACH = 0x00000002
-                MS_BIND = 4096
-                MS_SLAVE = 1<<19
-                MS_REC = 16384
-                MS_SHARED = 1 << 20
-                libc = ctypes.CDLL(libc_name)
-
-                #based on ipnetns.c from the iproute2 project
-                #bind to named namespace
-                netns_dir = "/var/run/netns/".encode("ascii")
-                if not os.path.exists(netns_dir):
-                    os.mkdir(netns_dir, stat.S_IRWXU | stat.S_IRGRP |
-                                         stat.S_IXGRP | stat.S_IROTH |
-                                         stat.S_IXOTH)
-
-                # this is a code mimicking the iproute2 implementation
-                # introduced by commit 58a3e8270f:
-                # modify all mounts in the files and subdirectories of
-                # /var/run/netns to be shared mount points so that unmount
-                # events can propagate, making it unlikely that "ip netns delete"
-                # will fail because a directory is mounted in another mount
-                # namespace
-                done = False
-                while libc.mount(b'', netns_dir, b'none', MS_SHARED | MS_REC, None) != 0:
-                    if done:
-                        raise OSError(ctypes.get_errno(), 'share rundir failed', netns)
-                    if libc.mount(netns_dir, netns_dir, b'none', MS_BIND | MS_REC,
-                                  None) != 0:
-                        raise OSError(ctypes.get_errno(), 'mount rundir failed', netns)
-                    done = True
-
-                netns_path = netns_dir + netns.encode("ascii")
-                try:
-                    f = os.open(netns_path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
-                except FileExistsError:
-                    raise Exception("Network namespace {} already exists".format(netns))
-
-                os.close(f)
-                if libc.unshare(CLONE_NEWNET) < 0:
-                    raise OSError(ctypes.get_errno(), 'unshare failed', netns)
-
-                if libc.mount(
-                        b'/proc/self/ns/net',
-                        netns_path,
-                        b'none',
-                        MS_BIND,
-                        None) < 0:
-                    raise OSError(ctypes.get_errno(), 'mount failed', netns)
-
-                #map network sysfs to new net
-                libc.unshare(CLONE_NEWNS)
-                libc.mount(b'', b'/', b'none', MS_SLAVE | MS_REC, None)
-                libc.umount2(b'/sys', MNT_DETACH)
-                libc.mount(netns, b'/sys', b'sysfs', 0, None)
-
-                #set ctl socket to pipe to main netns
-                self._server_handler.close_s_sock()
-                self._server_handler.close_c_sock()
-                self._server_handler.clear_connections()
-                self._server_handler.clear_netns_connections()
-
-                self._server_handler.set_netns(netns)
-                self._server_handler.set_ctl_sock((write_pipe, "root_netns"))
-
-                self._log_ctl.disable_logging()
-                self._log_ctl.set_origin_name(netns)
-                self._log_ctl.set_connection(write_pipe)
-
-                self.init_if_manager()
-
-                logging.debug("Created network namespace %s" % netns)
-                return True
-            else:
-                raise Exception("Fork failed!")
+            return
+
+        logging.debug("Creating network namespace %s." % netns)
+        start = perf_counter()
+        if len(self._netns_pool) == 0:
+            self._netns_pool_stats["cold_starts"] += 1
+            self._spawn_netns_worker()
+
+        ready = [key for key, worker in self._netns_pool.items()
+                 if worker["ready"]]
+        key = ready[0] if ready else next(iter(self._netns_pool))
+        if not self._netns_pool[key]["ready"]:
+            self._netns_pool_stats["claims_waited"] += 1
+            self._agent_server.wait_for_netns_ready(key)
+
+        try:
+            self._bind_netns(netns, self._netns_pool[key]["pid"])
+        except Exception:
+            self._destroy_netns_workers([key])
+            raise
+        worker = self._netns_pool.pop(key)
+
+        self._server_handler.del_netns(key)
+        self._net_namespaces[netns] = {"pid": worker["pid"],
+                                       "pipe": worker["pipe"]}
+        self._server_handler.add_netns(netns, worker["pipe"])
+        self._server_handler.send_data_to_netns(
+            netns, {"type": "command", "method_name": "claim_namespace",
+                    "args": [netns], "kwargs": {}})
+        result = self._agent_server.wait_for_result(netns)
+        if result["result"] != True:
+            raise Exception("Namespace creation failed")
+
+        claim_time = perf_counter() - start
+        self._netns_pool_stats["claims"] += 1
+        self._netns_pool_stats["claim_time_total"] += claim_time
+        self._netns_pool_stats["claim_time_max"] = max(
+            self._netns_pool_stats["claim_time_max"], claim_time)
+        logging.debug("Created network namespace %s in %.3fs" %
+                      (netns, claim_time))
+        return True
+
+    def set_netns_pool_size(self, size):
+        """sets the number of pre-forked network namespace processes
+
+        The pool is refilled when no messages arrive for a while and is
+        emptied by machine_cleanup.
+        """
+        self._netns_pool_size = size
+        surplus = list(self._netns_pool.keys())[size:]
+        self._destroy_netns_workers(surplus)
+        return True
+
+    def get_netns_pool_stats(self):
+        stats = dict(self._netns_pool_stats)
+        stats["size"] = self._netns_pool_size
+        stats["idle"] = len(self._netns_pool)
+        stats["ready"] = len([worker for worker in self._netns_pool.values()
+                              if worker["ready"]])
+        return stats
+
+    def claim_namespace(self, netns):
+        """names the network namespace of this pre-forked process
+
+        The devices created in the namespace before it was claimed are
+        announced again under the new name.
+        """
+        self._server_handler.set_netns(netns)
+        self._log_ctl.set_origin_name(netns)
+        self._job_context.get_pool().set_size(self._claim_job_pool_size)
+
+        self._if_manager.sync_devices()
+        for dev in self._if_manager.get_devices():
+            self._server_handler.send_data_to_ctl(
+                {"type": "dev_created",
+                 "dev_data": self._if_manager.get_if_data(dev)})
+        return True
+
+    def netns_pool_message(self, netns, data):
+        """handles a message of a pre-forked network namespace process
+
+        Returns True for the messages that aren't forwarded to the
+        Controller, i.e. anything sent before the namespace was claimed.
+        """
+        if netns in self._netns_pool:
+            if data["type"] == "ready":
+                self._netns_worker_ready(netns)
+            return True
+        return netns not in self._net_namespaces
+
+    def _netns_worker_ready(self, key):
+        worker = self._netns_pool[key]
+        if worker["ready"]:
+            return
+        worker["ready"] = True
+        init_time = perf_counter() - worker["spawned"]
+        self._netns_pool_stats["init_time_total"] += init_time
+        self._netns_pool_stats["init_time_max"] = max(
+            self._netns_pool_stats["init_time_max"], init_time)
+
+    def _netns_pool_needs_refill(self):
+        # only the root namespace process keeps a pool
+        return (self._server_handler.get_netns() is None and
+                len(self._netns_pool) < self._netns_pool_size)
+
+    def _refill_netns_pool(self):
+        while self._netns_pool_needs_refill():
+            self._spawn_netns_worker()
+
+    def _spawn_netns_worker(self):
+        """forks a process with a new network namespace
+
+        The new process initializes its InterfaceManager, reports it's
+        ready and serves the commands sent to the namespace, it never
+        returns from this method. Returns the pid in the parent.
+        """
+        key = "pool{}".format(next(self._netns_pool_ids))
+        read_pipe, write_pipe = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid != 0:
+            self._netns_pool[key] = {"pid": pid,
+                                     "pipe": read_pipe,
+                                     "ready": False,
+                                     "spawned": perf_counter()}
+            self._server_handler.add_netns(key, read_pipe)
+            self._netns_pool_stats["spawned"] += 1
+            return pid
+
+        self._agent_server.set_netns_sighandlers()
+        #create new network namespace
+        libc_name = ctypes.util.find_library("c")
+        #from sched.h
+        CLONE_NEWNET = 0x40000000
+        CLONE_NEWNS = 0x00020000
+        #based on ipnetns.c from the iproute2 project
+        MNT_DETACH = 0x00000002
+        MS_SLAVE = 1<<19
+        MS_REC = 16384
+        libc = ctypes.CDLL(libc_name)
+
+        if libc.unshare(CLONE_NEWNET) < 0:
+            raise OSError(ctypes.get_errno(), 'unshare failed', key)
+
+        #map network sysfs to new net
+        libc.unshare(CLONE_NEWNS)
+        libc.mount(b'', b'/', b'none', MS_SLAVE | MS_REC, None)
+        libc.umount2(b'/sys', MNT_DETACH)
+        libc.mount(key.encode("ascii"), b'/sys', b'sysfs', 0, None)
+
+        #set ctl socket to pipe to main netns
+        self._server_handler.close_s_sock()
+        self._server_handler.close_c_sock()
+        self._server_handler.clear_connections()
+        self._server_handler.clear_netns_connections()
+
+        self._server_handler.set_netns(key)
+        self._server_handler.set_ctl_sock((write_pipe, "root_netns"))
+
+        self._log_ctl.disable_logging()
+        self._log_ctl.set_origin_name(key)
+        self._log_ctl.set_connection(write_pipe)
+
+        # the namespaces and the pools belong to the parent
+        self._net_namespaces.clear()
+        self._netns_pool = OrderedDict()
+        self._netns_pool_size = 0
+        # the job workers are forked once the namespace is claimed so they
+        # log with its name
+        self._claim_job_pool_size = self._job_context.get_pool().detach()
+
+        self.init_if_manager()
+
+        logging.debug("Created network namespace process %s" % key)
+        self._server_handler.send_data_to_ctl({"type": "ready"})
+        self._agent_server.run()
+        logging.shutdown()
+        os._exit(0)
+
+    def _bind_netns(self, netns, pid):
+        """makes the network namespace of the process visible as
+        /var/run/netns/<netns>"""
+        libc_name = ctypes.util.find_library("c")
+        #based on ipnetns.c from the iproute2 project
+        MS_BIND = 4096
+        MS_REC = 16384
+        MS_SHARED = 1 << 20
+        libc = ctypes.CDLL(libc_name)
+
+        #based on ipnetns.c from the iproute2 project
+        #bind to named namespace
+        netns_dir = "/var/run/netns/".encode("ascii")
+        if not os.path.exists(netns_dir):
+            os.mkdir(netns_dir, stat.S_IRWXU | stat.S_IRGRP |
+                                 stat.S_IXGRP | stat.S_IROTH |
+                                 stat.S_IXOTH)
+
+        # this is a code mimicking the iproute2 implementation
+        # introduced by commit 58a3e8270f:
+        # modify all mounts in the files and subdirectories of
+        # /var/run/netns to be shared mount points so that unmount
+        # events can propagate, making it unlikely that "ip netns delete"
+        # will fail because a directory is mounted in another mount
+        # namespace
+        done = False
+        while libc.mount(b'', netns_dir, b'none', MS_SHARED | MS_REC, None) != 0:
+            if done:
+                raise OSError(ctypes.get_errno(), 'share rundir failed', netns)
+            if libc.mount(netns_dir, netns_dir, b'none', MS_BIND | MS_REC,
+                          None) != 0:
+                raise OSError(ctypes.get_errno(), 'mount rundir failed', netns)
+            done = True
+
+        netns_path = netns_dir + netns.encode("ascii")
+        try:
+            f = os.open(netns_path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
+        except FileExistsError:
+            raise Exception("Network namespace {} already exists".format(netns))
+
+        os.close(f)
+        if libc.mount(
+                "/proc/{}/ns/net".format(pid).encode("ascii"),
+                netns_path,
+                b'none',
+                MS_BIND,
+                None) < 0:
+            os.unlink(netns_path)
+            raise OSError(ctypes.get_errno(), 'mount failed', netns)
 
     def del_namespace(self, netns):
         if netns not in self._net_namespaces:
             logging.debug("Network namespace %s doesn't exist." % netns)
             return False
-        else:
-            MNT_DETACH = 0x00000002
-            libc_name = ctypes.util.find_library("c")
-            libc = ctypes.CDLL(libc_name)
+        return self.del_namespaces([netns])
+
+    def del_namespaces(self, namespaces):
+        """deletes the network namespaces, their processes are stopped in
+        parallel"""
+        namespaces = [netns for netns in namespaces
+                      if netns in self._net_namespaces]
+
+        MNT_DETACH = 0x00000002
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name)
+
+        self._stop_netns_processes([self._net_namespaces[netns]["pid"]
+                                    for netns in namespaces])
+        for netns in namespaces:
             netns_path = "/var/run/netns/" + netns
             netns_path = netns_path.encode('ascii')
 
-            netns_pid = self._net_namespaces[netns]["pid"]
-            os.kill(netns_pid, signal.SIGUSR1)
-            os.waitpid(netns_pid, 0)
-
             # Remove named namespace
             try:
                 libc.umount2(netns_path, MNT_DETACH)
@@ -637,17 +1042,67 @@ class RemoteMethods:
             self._net_namespaces[netns]["pipe"].close()
             self._server_handler.del_netns(netns)
             del self._net_namespaces[netns]
-            return True
+        return True
+
+    def _destroy_netns_workers(self, keys):
+        self._stop_netns_processes([self._netns_pool[key]["pid"]
+                                    for key in keys])
+        for key in keys:
+            self._netns_pool.pop(key)["pipe"].close()
+            self._server_handler.del_netns(key)
+
+    def _stop_netns_processes(self, pids):
+        for pid in pids:
+            os.kill(pid, signal.SIGUSR1)
+        for pid in pids:
+            os.waitpid(pid, 0)
 
     def set_dev_netns(self, dev, dst):
-        exec_cmd("ip link set %s netns %s" % (dev.name, dst))
-        self._if_manager.rescan_devices()
-        #TODO check if device appeared in the destination namespace
+        return self.set_devs_netns([dev], dst)
+
+    def set_devs_netns(self, devs, dst):
+        """moves the devices to the named network namespace
+
+        Every device is moved by an IFLA_NET_NS_FD netlink request, the
+        device database is synced once for the whole batch which sends the
+        dev_netns_changed messages of all the devices to the Controller.
+        """
+        try:
+            netns_fd = os.open("/var/run/netns/" + dst, os.O_RDONLY)
+        except OSError as e:
+            raise DeviceConfigError("Network namespace {} can't be opened: {}"
+                                    .format(dst, str(e)))
+
+        ipr_session = self._if_manager.get_ipr_session()
+        try:
+            for dev in devs:
+                logging.debug("Moving device %s to network namespace %s" %
+                              (dev.name, dst))
+                try:
+                    ipr_session.call("link", "set", index=dev.ifindex,
+                                     net_ns_fd=netns_fd)
+                except Exception as e:
+                    raise DeviceConfigError(
+                        "Moving device {} to network namespace {} failed: {}"
+                        .format(dev.name, dst, str(e)))
+        finally:
+            os.close(netns_fd)
+            self._if_manager.sync_devices(replaces_dump=True)
         return True
 
     def remap_device(self, ifindex, clsname, args=[], kwargs={}):
         self._if_manager.remap_device(ifindex, clsname, args, kwargs)
 
+    def remap_devices(self, devices):
+        """remaps a batch of devices moved to this network namespace
+
+        devices is a list of (ifindex, clsname, args, kwargs) tuples, the
+        reply is sent once all of them are mapped.
+        """
+        for ifindex, clsname, args, kwargs in devices:
+            self._if_manager.remap_device(ifindex, clsname, args, kwargs)
+        return True
+
     # def return_if_netns(self, if_id):
         # device = self._if_manager.get_mapped_device(if_id)
         # if device.get_netns() == None:
@@ -668,91 +1123,61 @@ class RemoteMethods:
             # device.set_netns(None)
             # return True
 
-    def add_br_vlan(self, if_id, br_vlan_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def add_br_vlan(self, ifindex, br_vlan_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.add_vlan(br_vlan_info)
         return True
 
-    def del_br_vlan(self, if_id, br_vlan_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def del_br_vlan(self, ifindex, br_vlan_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.del_vlan(br_vlan_info)
         return True
 
-    def get_br_vlans(self, if_id):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def add_br_vlans(self, ifindex, br_vlan_info_list):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
+        brt.add_vlans(br_vlan_info_list)
+        return True
+
+    def del_br_vlans(self, ifindex, br_vlan_info_list):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
+        brt.del_vlans(br_vlan_info_list)
+        return True
+
+    def get_br_vlans(self, ifindex):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         return brt.get_vlans()
 
-    def add_br_fdb(self, if_id, br_fdb_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def add_br_fdb(self, ifindex, br_fdb_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.add_fdb(br_fdb_info)
         return True
 
-    def del_br_fdb(self, if_id, br_fdb_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def del_br_fdb(self, ifindex, br_fdb_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.del_fdb(br_fdb_info)
         return True
 
-    def get_br_fdbs(self, if_id):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def get_br_fdbs(self, ifindex):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         return brt.get_fdbs()
 
-    def set_br_learning(self, if_id, br_learning_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def set_br_learning(self, ifindex, br_learning_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.set_learning(br_learning_info)
         return True
 
-    def set_br_learning_sync(self, if_id, br_learning_sync_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def set_br_learning_sync(self, ifindex, br_learning_sync_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.set_learning_sync(br_learning_sync_info)
         return True
 
-    def set_br_flooding(self, if_id, br_flooding_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def set_br_flooding(self, ifindex, br_flooding_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.set_flooding(br_flooding_info)
         return True
 
-    def set_br_state(self, if_id, br_state_info):
-        dev = self._if_manager.get_mapped_device(if_id)
-        if not dev:
-            logging.error("Device with id '%s' not found." % if_id)
-            return False
-        brt = BridgeTool(dev.get_name())
+    def set_br_state(self, ifindex, br_state_info):
+        brt = BridgeTool(self._if_manager.get_device(ifindex))
         brt.set_state(br_state_info)
         return True
 
@@ -781,6 +1206,9 @@ class ServerHandler(ConnectionHandler):
 
     def accept_connection(self):
         self._c_socket, addr = self._s_socket.accept()
+        # replies often follow other small messages, don't wait for the
+        # ACKs of those
+        self._c_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._c_socket = (AgentSecSocket(self._c_socket), addr[0])
         logging.info("Recieved connection from %s" % self._c_socket[1])
 
@@ -817,11 +1245,21 @@ class ServerHandler(ConnectionHandler):
     def check_connections(self, timeout=None):
         if self._if_manager is not None:
             self._if_manager.handle_netlink_msgs()
+            if self._if_manager.get_update_events():
+                # changes not caused by a command, e.g. by linkwatch or
+                # DAD, are sent to the Controller as soon as they happen
+                nl_socket = self._if_manager.get_nl_socket()
+                connections = [c for c in self._connections if not c.closed]
+                ready, _, _ = select.select(connections + [nl_socket], [], [],
+                                            timeout)
+                if nl_socket in ready:
+                    self._if_manager.handle_netlink_msgs()
+                timeout = 0
         msgs = super(ServerHandler, self).check_connections(timeout=timeout)
         return msgs
 
-    def get_messages(self):
-        messages = self.check_connections(timeout=MAX_SERVER_HANG)
+    def get_messages(self, timeout=MAX_SERVER_HANG):
+        messages = self.check_connections(timeout=timeout)
 
         #push ctl messages to the end of message queue, this ensures that
         #update messages are handled first
@@ -879,6 +1317,9 @@ class ServerHandler(ConnectionHandler):
     def set_netns(self, netns):
         self._netns = netns
 
+    def get_netns(self):
+        return self._netns
+
     def add_netns(self, netns, connection):
         self._connections.append(connection)
         self._netns_con_mapping[netns] = connection
@@ -962,7 +1403,7 @@ class Agent:
         self._agent_config = agent_config
         die_when_parent_die()
 
-        self._job_context = JobContext()
+        self._job_context = JobContext(log_ctl)
         port = agent_config.get_option("environment", "rpcport")
         logging.info("Using RPC port %d." % port)
         self._server_handler = ServerHandler(("", port), agent_config)
@@ -994,15 +1435,33 @@ class Agent:
                         continue
                     self._log_ctl.set_connection(self._server_handler.get_ctl_sock())
 
-                msgs = self._server_handler.get_messages()
+                # the netns and job pools are refilled only when the
+                # Controller is idle, the forked processes would slow down
+                # the commands being sent
+                refill = (self._methods._netns_pool_needs_refill() or
+                          self._job_context.get_pool().needs_refill())
+                msgs = self._server_handler.get_messages(
+                    NETNS_POOL_REFILL_DELAY if refill else MAX_SERVER_HANG)
 
                 for msg in msgs:
                     self._process_msg(msg[1])
+                # one index write for all the resource cache updates made
+                # by the processed messages
+                self._methods._cache.flush()
+                if refill and not msgs:
+                    self._methods._refill_netns_pool()
+                    self._job_context.get_pool().refill()
             except SystemCallException:
                 break
 
         self._methods.machine_cleanup()
 
+    def wait_for_netns_ready(self, key):
+        """waits for the pre-forked network namespace process to initialize"""
+        while not self._methods._netns_pool[key]["ready"]:
+            for msg in self._server_handler.get_messages_from_con(key):
+                self._process_msg(msg[1])
+
     def wait_for_result(self, id):
         result = None
         while result == None:
@@ -1035,16 +1494,16 @@ class Agent:
                     log_exc_traceback()
                     response = {"type": "exception", "Exception": e}
 
-                    self._server_handler.send_data_to_ctl(response)
+                    self._send_reply(msg, response)
                     return
 
                 response = {"type": "result", "result": result}
                 response = device_to_deviceref(response)
-                self._server_handler.send_data_to_ctl(response)
+                self._send_reply(msg, response)
             else:
                 err = LnstError("Method '%s' not supported." % msg["method_name"])
                 response = {"type": "exception", "Exception": err}
-                self._server_handler.send_data_to_ctl(response)
+                self._send_reply(msg, response)
         elif msg["type"] == "log":
             logger = logging.getLogger()
             record = logging.makeLogRecord(msg["record"])
@@ -1064,14 +1523,21 @@ class Agent:
             job = self._job_context.get_job(msg["job_id"])
             job.join()
 
+            self._job_context.add_start_latency(job,
+                                                msg.pop("start_latency"))
             job.set_finished(msg["result"])
+            # a pooled worker keeps its pipe for the next job
+            self._server_handler.remove_connection_by_id(job.get_id())
+            self._flush_update_events()
             self._server_handler.send_data_to_ctl(msg)
 
             self._job_context.del_job(job)
 
         elif msg["type"] == "from_netns":
-            msg["data"]["netns"] = msg["netns"]
-            self._server_handler.send_data_to_ctl(msg["data"])
+            if not self._methods.netns_pool_message(msg["netns"],
+                                                    msg["data"]):
+                msg["data"]["netns"] = msg["netns"]
+                self._server_handler.send_data_to_ctl(msg["data"])
         elif msg["type"] == "to_netns":
             netns = msg["netns"]
             try:
@@ -1080,7 +1546,7 @@ class Agent:
                 log_exc_traceback()
                 response = {"type": "exception", "Exception": e}
 
-                self._server_handler.send_data_to_ctl(response)
+                self._send_reply(msg["data"], response)
                 return
         else:
             raise Exception("Recieved unknown command")
@@ -1088,6 +1554,18 @@ class Agent:
         pipes = self._job_context.get_parent_pipes()
         self._server_handler.update_connections(pipes)
 
+    def _send_reply(self, command, response):
+        self._flush_update_events()
+        # the controller matches replies to commands by the request id
+        if "request_id" in command:
+            response["request_id"] = command["request_id"]
+        self._server_handler.send_data_to_ctl(response)
+
+    def _flush_update_events(self):
+        if_manager = self._methods._if_manager
+        if if_manager is not None:
+            if_manager.flush_update_events()
+
     def register_die_signal(self, signum):
         signal.signal(signum, self._signal_die_handler)
 
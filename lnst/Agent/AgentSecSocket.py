@@ -19,6 +19,9 @@ import logging
 from lnst.Common.SecureSocket import SecureSocket
 from lnst.Common.SecureSocket import DH_GROUP, SRP_GROUP
 from lnst.Common.SecureSocket import SecSocketException
+from lnst.Common.SecureSocket import negotiate_framing
+from lnst.Common.SecureSocket import negotiate_cipher_suite
+from lnst.Common.ConnectionHandler import negotiate_serializer
 from lnst.Common.Utils import not_imported
 
 ser = not_imported
@@ -26,7 +29,7 @@ load_pem_private_key = not_imported
 load_pem_public_key = not_imported
 load_ssh_public_key = not_imported
 backend = not_imported
-cryptography_imported = not_imported
+cryptography_imported = False
 def cryptography_imports():
     global cryptography_imported
     if cryptography_imported:
@@ -70,7 +73,23 @@ class AgentSecSocket(SecureSocket):
 
         agent_hello = {"type": "agent_hello",
                        "agent_random": self._agent_random}
+        # controllers not aware of framing, cipher suite or serializer
+        # negotiation expect the original agent_hello message, ascii framing,
+        # CBC + HMAC and plain pickle
+        framings = ctl_hello.get("framings")
+        if framings:
+            agent_hello["framing"] = negotiate_framing(framings)
+        cipher_suites = ctl_hello.get("cipher_suites")
+        if cipher_suites:
+            agent_hello["cipher_suite"] = negotiate_cipher_suite(cipher_suites)
+            self.set_cipher_suite(agent_hello["cipher_suite"])
+        serializers = ctl_hello.get("serializers")
+        if serializers:
+            agent_hello["serializer"] = negotiate_serializer(serializers)
+            self.set_serializer(agent_hello["serializer"])
         self.send_msg(agent_hello)
+        if framings:
+            self.set_framing(agent_hello["framing"])
 
         if sec_params["auth_types"] == "none":
             logging.warning("===================================")
@@ -1,5 +1,6 @@
 """
-This module defines a class useful to work with "bridge" tool.
+This module defines a class to configure bridge VLANs, FDB entries and port
+settings of a device.
 
 Copyright 2015 Mellanox Technologies. All rights reserved.
 Licensed under the GNU General Public License, version 2 as
@@ -12,57 +13,117 @@ jiri@mellanox.com (Jiri Pirko)
 
 from lnst.Common.NetUtils import normalize_hwaddr
 from lnst.Common.ExecCmd import exec_cmd
-import re
 
-class BridgeTool:
-    def __init__(self, dev_name):
-        self._dev_name = dev_name
+# include/uapi/linux/if_bridge.h
+BRIDGE_FLAGS_MASTER = 0x1
+BRIDGE_FLAGS_SELF = 0x2
+
+BRIDGE_VLAN_INFO_PVID = 0x2
+BRIDGE_VLAN_INFO_UNTAGGED = 0x4
+BRIDGE_VLAN_INFO_RANGE_BEGIN = 0x8
+BRIDGE_VLAN_INFO_RANGE_END = 0x10
+
+# include/uapi/linux/neighbour.h
+NTF_SELF = 0x2
+NTF_MASTER = 0x4
+NTF_OFFLOADED = 0x20
 
-    def _add_del_vlan(self, op, br_vlan_info):
-        cmd = "bridge vlan %s dev %s vid %d" % (op, self._dev_name,
-                                                br_vlan_info["vlan_id"])
+class BridgeTool:
+    """bridge VLAN, FDB and port configuration of a device
+
+    VLANs and FDB entries are configured with netlink requests on the
+    persistent session of the device's InterfaceManager. A br_vlan_info
+    with a "vlan_id_end" key configures the whole range of VLANs in one
+    request, add_vlans and del_vlans send a list of them in one message.
+    """
+    def __init__(self, dev):
+        self._dev = dev
+
+    @staticmethod
+    def _bridge_flags(info):
+        flags = 0
+        if info["self"]:
+            flags |= BRIDGE_FLAGS_SELF
+        if info["master"]:
+            flags |= BRIDGE_FLAGS_MASTER
+        return flags
+
+    @staticmethod
+    def _vlan_info_attrs(br_vlan_info):
+        flags = 0
         if br_vlan_info["pvid"]:
-            cmd += " pvid"
+            flags |= BRIDGE_VLAN_INFO_PVID
         if br_vlan_info["untagged"]:
-            cmd += " untagged"
-        if br_vlan_info["self"]:
-            cmd += " self"
-        if br_vlan_info["master"]:
-            cmd += " master"
-        exec_cmd(cmd)
+            flags |= BRIDGE_VLAN_INFO_UNTAGGED
+
+        vlan_id = br_vlan_info["vlan_id"]
+        vlan_id_end = br_vlan_info.get("vlan_id_end", vlan_id)
+        if vlan_id_end == vlan_id:
+            return [["IFLA_BRIDGE_VLAN_INFO", {"flags": flags,
+                                               "vid": vlan_id}]]
+        return [["IFLA_BRIDGE_VLAN_INFO",
+                 {"flags": flags | BRIDGE_VLAN_INFO_RANGE_BEGIN,
+                  "vid": vlan_id}],
+                ["IFLA_BRIDGE_VLAN_INFO",
+                 {"flags": flags | BRIDGE_VLAN_INFO_RANGE_END,
+                  "vid": vlan_id_end}]]
+
+    def _add_del_vlans(self, op, br_vlan_info_list):
+        # the self/master flags apply to the whole message
+        messages = {}
+        for br_vlan_info in br_vlan_info_list:
+            attrs = messages.setdefault(self._bridge_flags(br_vlan_info), [])
+            attrs.extend(self._vlan_info_attrs(br_vlan_info))
+
+        for flags, attrs in messages.items():
+            if flags:
+                attrs.insert(0, ["IFLA_BRIDGE_FLAGS", flags])
+            self._dev._ipr_wrapper("vlan_filter", op, index=self._dev.ifindex,
+                                   IFLA_AF_SPEC={"attrs": attrs})
 
     def add_vlan(self, br_vlan_info):
-        return self._add_del_vlan("add", br_vlan_info)
+        return self._add_del_vlans("add", [br_vlan_info])
 
     def del_vlan(self, br_vlan_info):
-        return self._add_del_vlan("del", br_vlan_info)
+        return self._add_del_vlans("del", [br_vlan_info])
+
+    def add_vlans(self, br_vlan_info_list):
+        return self._add_del_vlans("add", br_vlan_info_list)
+
+    def del_vlans(self, br_vlan_info_list):
+        return self._add_del_vlans("del", br_vlan_info_list)
 
     def get_vlans(self):
-        output = exec_cmd("bridge vlan show dev %s" % self._dev_name,
-                          die_on_err=False)[0]
         br_vlan_info_list = []
-        for line in output.split("\n"):
-            match = re.match(r'.*\s+(\d+)', line)
-            if match:
-                vlan_id = int(match.groups()[0])
-                pvid = True if re.match(r'.*\s+PVID', line) else False
-                untagged = True if re.match(r'.*\s+Egress Untagged', line) \
-                                else False
-                br_vlan_info = {"vlan_id": vlan_id, "pvid": pvid,
-                                "untagged": untagged}
+        for msg in self._dev._ipr_wrapper("get_vlans", None):
+            if msg["index"] != self._dev.ifindex:
+                continue
+            af_spec = msg.get_attr("IFLA_AF_SPEC")
+            if af_spec is None:
+                continue
+            for attr in af_spec["attrs"]:
+                if attr[0] != "IFLA_BRIDGE_VLAN_INFO":
+                    continue
+                flags = attr[1]["flags"]
+                br_vlan_info = {
+                    "vlan_id": attr[1]["vid"],
+                    "pvid": bool(flags & BRIDGE_VLAN_INFO_PVID),
+                    "untagged": bool(flags & BRIDGE_VLAN_INFO_UNTAGGED)}
                 br_vlan_info_list.append(br_vlan_info)
         return br_vlan_info_list
 
     def _add_del_fdb(self, op, br_fdb_info):
-        cmd = "bridge fdb %s %s dev %s" % (op, br_fdb_info["hwaddr"],
-                                           self._dev_name)
+        flags = 0
         if br_fdb_info["self"]:
-            cmd += " self"
+            flags |= NTF_SELF
         if br_fdb_info["master"]:
-            cmd += " master"
+            flags |= NTF_MASTER
+        kwargs = {}
         if br_fdb_info["vlan_id"]:
-            cmd += " vlan %s" % br_fdb_info["vlan_id"]
-        exec_cmd(cmd)
+            kwargs["vlan"] = int(br_fdb_info["vlan_id"])
+        self._dev._ipr_wrapper("fdb", op, ifindex=self._dev.ifindex,
+                               lladdr=br_fdb_info["hwaddr"], flags=flags,
+                               **kwargs)
 
     def add_fdb(self, br_fdb_info):
         return self._add_del_fdb("add", br_fdb_info)
@@ -70,26 +131,26 @@ class BridgeTool:
     def del_fdb(self, br_fdb_info):
         return self._add_del_fdb("del", br_fdb_info)
 
-    def get_fdbs(_self):
-        output = exec_cmd("bridge fdb show dev %s" % _self._dev_name,
-                          die_on_err=False)[0]
+    def get_fdbs(self):
         br_fdb_info_list = []
-        for line in output.split("\n"):
-            match = re.match(r'([0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2})', line)
-            if match:
-                hwaddr = normalize_hwaddr(match.groups()[0])
-                match = re.match(r'.*\s+vlan (\d+)', line)
-                vlan_id = int(match.groups()[0]) if match else 0
-                self = True if re.match(r'.*\s+self', line) else False
-                master = True if re.match(r'.*\s+master', line) else False
-                offload = True if re.match(r'.*\s+offload', line) else False
-                br_fdb_info = {"hwaddr": hwaddr, "vlan_id": vlan_id,
-                               "self": self, "master": master, "offload": offload}
-                br_fdb_info_list.append(br_fdb_info)
+        for msg in self._dev._ipr_wrapper("fdb", "dump",
+                                          ifindex=self._dev.ifindex):
+            hwaddr = msg.get_attr("NDA_LLADDR")
+            if hwaddr is None:
+                continue
+            flags = msg["flags"]
+            br_fdb_info = {
+                "hwaddr": normalize_hwaddr(hwaddr),
+                "vlan_id": msg.get_attr("NDA_VLAN") or 0,
+                "self": bool(flags & NTF_SELF),
+                "master": bool(flags & NTF_MASTER or
+                               msg.get_attr("NDA_MASTER") is not None),
+                "offload": bool(flags & NTF_OFFLOADED)}
+            br_fdb_info_list.append(br_fdb_info)
         return br_fdb_info_list
 
     def _set_link(self, attr, br_link_info):
-        cmd = "bridge link set dev %s %s" % (self._dev_name, attr)
+        cmd = "bridge link set dev %s %s" % (self._dev.name, attr)
         if br_link_info["on"]:
             cmd += " on"
         else:
@@ -110,7 +171,7 @@ class BridgeTool:
         return self._set_link("flood", br_flooding_info)
 
     def set_state(self, br_state_info):
-        cmd = "bridge link set dev %s state %s" % (self._dev_name,
+        cmd = "bridge link set dev %s state %s" % (self._dev.name,
                                                    br_state_info["state"])
         if br_state_info["self"]:
             cmd += " self"
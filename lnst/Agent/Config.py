@@ -43,6 +43,12 @@ class AgentConfig(Config):
                 "action" : self.optionTimeval,
                 "name" : "expiration_period"}
 
+        self._options['cache']['size_limit'] = {\
+                "value" : 1024*1024*1024, # 1 GiB, 0 for no limit
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "size_limit"}
+
         self._options['security'] = dict()
         self._options['security']['auth_types'] = {\
                 "value" : "none",
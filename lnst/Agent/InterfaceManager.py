@@ -12,18 +12,21 @@ __author__ = """
 olichtne@redhat.com (Ondrej Lichtner)
 """
 
-import re
+import time
 import select
 import socket
 import logging
 from collections import deque
 from lnst.Common.NetUtils import normalize_hwaddr
-from lnst.Common.ExecCmd import exec_cmd
+from lnst.Common.HWAddress import hwaddress
+from lnst.Common.LnstError import LnstError
 from lnst.Common.ConnectionHandler import recv_data
 from lnst.Common.DeviceError import (DeviceNotFound, DeviceConfigError,
         DeviceDeleted, DeviceError)
 from lnst.Common.InterfaceManagerError import InterfaceManagerError
 from lnst.Agent.DevlinkManager import DevlinkManager
+from lnst.Agent.NetlinkSession import IPRouteSession
+from lnst.Agent.OvsdbClient import OvsdbClient, OvsdbError
 from pyroute2 import IPRSocket
 from pyroute2.netlink import NLM_F_REQUEST, NLM_F_DUMP
 from pyroute2.netlink.rtnl import RTMGRP_IPV4_IFADDR
@@ -35,6 +38,7 @@ from pyroute2.netlink.rtnl import RTM_DELLINK
 from pyroute2.netlink.rtnl import RTM_NEWADDR
 from pyroute2.netlink.rtnl import RTM_GETADDR
 from pyroute2.netlink.rtnl import RTM_DELADDR
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
 
 NL_GROUPS = RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR | RTMGRP_LINK
 PF_BRIDGE = 7
@@ -45,11 +49,38 @@ class InterfaceManager(object):
 
         self._devices = {} #ifindex to device
 
+        # secondary indexes of self._devices and cached if_data of the
+        # devices, both updated by netlink messages
+        self._name_index = {} #name to ifindex
+        self._hwaddr_index = {} #hwaddr string to list of ifindexes
+        self._index_keys = {} #ifindex to the (name, hwaddr) it's indexed by
+        self._if_data = {} #ifindex to if_data
+        self._name_counters = {} #prefix to the lowest possibly unused index
+
         self._nl_socket = IPRSocket()
         self._nl_socket.bind(groups=NL_GROUPS)
 
         self._msg_queue = deque()
 
+        # ifindexes of the devices updated by the currently handled netlink
+        # messages, sent to the Controller in a single dev_updated message
+        self._update_events = False
+        self._updated_devices = set()
+
+        # netlink requests of the Device objects share a single socket
+        self._ipr_session = IPRouteSession()
+
+        # the connection to ovsdb-server shared by the OvsBridgeDevice
+        # objects and the device name assignment
+        self._ovsdb = OvsdbClient()
+
+        # the device database is kept up to date by the netlink events of
+        # NL_GROUPS, full dumps are only done on resync or explicit request
+        self._stats = {"dumps": 0,
+                       "dumps_avoided": 0,
+                       "resyncs": 0,
+                       "events": 0}
+
         #TODO split DevlinkManager away from the InterfaceManager
         #self._dl_manager = DevlinkManager()
 
@@ -66,6 +97,7 @@ class InterfaceManager(object):
         return cls
 
     def reconnect_netlink(self):
+        self._stats["resyncs"] += 1
         if self._nl_socket != None:
             self._nl_socket.close()
             self._nl_socket = None
@@ -77,6 +109,19 @@ class InterfaceManager(object):
     def get_nl_socket(self):
         return self._nl_socket
 
+    def get_ipr_session(self):
+        return self._ipr_session
+
+    def get_ovsdb(self):
+        return self._ovsdb
+
+    def close(self):
+        self._ipr_session.close()
+        self._ovsdb.close()
+        if self._nl_socket is not None:
+            self._nl_socket.close()
+            self._nl_socket = None
+
     def pull_netlink_messages_into_queue(self):
         try:
             while True:
@@ -85,14 +130,91 @@ class InterfaceManager(object):
                     break
                 self._msg_queue.extend(self._nl_socket.get())
         except socket.error:
+            # most likely ENOBUFS, events were lost and the database has to
+            # be resynchronized with a full dump
             self.reconnect_netlink()
             return []
 
     def rescan_devices(self):
+        """synchronizes the device database with a full netlink dump"""
         self.request_netlink_dump()
         self.handle_netlink_msgs()
 
+    def sync_devices(self, replaces_dump=False):
+        """applies the pending netlink events to the device database
+
+        Netlink notifications of a change are queued on the socket before
+        the netlink request or the command that caused it returns, so this
+        is enough to see the effect of any previous configuration.
+        replaces_dump is set where a full dump used to be requested, these
+        calls are counted as dumps_avoided.
+        """
+        if replaces_dump:
+            self._stats["dumps_avoided"] += 1
+        self.handle_netlink_msgs()
+
+    def wait_for_condition(self, condition, timeout):
+        """waits until the condition is true or the timeout expires
+
+        The condition is checked after every batch of netlink messages
+        applied to the device database, e.g. to wait for an address to be
+        configured or for the end of its duplicate address detection.
+        Returns the final result of the condition.
+        """
+        deadline = time.monotonic() + timeout
+        self.handle_netlink_msgs()
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            select.select([self._nl_socket], [], [], remaining)
+            self.handle_netlink_msgs()
+        return True
+
+    def refresh_device(self, ifindex):
+        """requests the current link message of a single device
+
+        Needed for the parts of the link state that don't generate netlink
+        events, e.g. the link statistics.
+        """
+        msg = ifinfmsg()
+        msg["index"] = ifindex
+        self._nl_socket.put(msg, RTM_GETLINK, msg_flags=NLM_F_REQUEST)
+        self.handle_netlink_msgs()
+
+    def set_update_events(self, enabled):
+        """enables the dev_updated messages to the Controller
+
+        The message lists the ifindexes of the devices changed by netlink
+        messages, it is sent before the reply of the command that caused the
+        change so the Controller can keep a cache of the device attributes.
+        """
+        self._update_events = enabled
+        self._updated_devices = set()
+
+    def get_update_events(self):
+        return self._update_events
+
+    def flush_update_events(self):
+        """sends the dev_updated message for the pending netlink messages
+
+        Called before every reply to the Controller, netlink notifications
+        are queued synchronously with the change so the Controller learns
+        about every change made before it sent the command.
+        """
+        if self._update_events:
+            self.handle_netlink_msgs()
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        for key, value in self._ipr_session.get_stats().items():
+            stats["ipr_" + key] = value
+        for key, value in self._ovsdb.get_stats().items():
+            stats["ovsdb_" + key] = value
+        return stats
+
     def request_netlink_dump(self):
+        self._stats["dumps"] += 1
         self._nl_socket.put(
             None, RTM_GETLINK, msg_flags=NLM_F_REQUEST | NLM_F_DUMP
         )
@@ -105,27 +227,100 @@ class InterfaceManager(object):
 
         while len(self._msg_queue):
             msg = self._msg_queue.popleft()
+            self._stats["events"] += 1
             self._handle_netlink_msg(msg)
 
+        if self._updated_devices:
+            update_msg = {"type": "dev_updated",
+                          "ifindexes": sorted(self._updated_devices)}
+            self._updated_devices = set()
+            self._server_handler.send_data_to_ctl(update_msg)
+
         # self._dl_manager.rescan_ports()
         # for device in self._devices.values():
             # dl_port = self._dl_manager.get_port(device.name)
             # device._set_devlink(dl_port)
 
+    def _set_device(self, ifindex, dev):
+        self._devices[ifindex] = dev
+        self._index_device(ifindex)
+
+    def _remove_device(self, ifindex):
+        old_keys = self._index_keys.get(ifindex)
+        self._unindex_device(ifindex)
+        del self._devices[ifindex]
+
+        if old_keys is not None:
+            self._name_freed(old_keys[0])
+
+    def _index_device(self, ifindex):
+        old_keys = self._index_keys.get(ifindex)
+        self._unindex_device(ifindex)
+
+        dev = self._devices[ifindex]
+        name = dev.name
+        if old_keys is not None and old_keys[0] != name:
+            self._name_freed(old_keys[0])
+
+        try:
+            hwaddr = str(dev.hwaddr) if dev.hwaddr else None
+        except LnstError:
+            # e.g. tunnel devices with 4 byte link layer addresses
+            hwaddr = None
+
+        self._name_index[name] = ifindex
+        if hwaddr is not None:
+            self._hwaddr_index.setdefault(hwaddr, []).append(ifindex)
+        self._index_keys[ifindex] = (name, hwaddr)
+
+    def _unindex_device(self, ifindex):
+        self._if_data.pop(ifindex, None)
+        if ifindex not in self._index_keys:
+            return
+
+        name, hwaddr = self._index_keys.pop(ifindex)
+        if self._name_index.get(name) == ifindex:
+            del self._name_index[name]
+        if hwaddr in self._hwaddr_index:
+            self._hwaddr_index[hwaddr].remove(ifindex)
+            if len(self._hwaddr_index[hwaddr]) == 0:
+                del self._hwaddr_index[hwaddr]
+
+    def get_if_data(self, dev):
+        """returns the Device._get_if_data snapshot of the device
+
+        The snapshot is cached until a netlink message for the device
+        arrives or invalidate_if_data is called.
+        """
+        if dev.ifindex not in self._if_data:
+            self._if_data[dev.ifindex] = dev._get_if_data()
+        return dict(self._if_data[dev.ifindex])
+
+    def invalidate_if_data(self, ifindex):
+        """drops the cached if_data of the device, for configuration changes
+        not reported by netlink, e.g. ethtool settings"""
+        self._if_data.pop(ifindex, None)
+
     def _handle_netlink_msg(self, msg):
         if msg['header']['type'] in [RTM_NEWLINK, RTM_NEWADDR, RTM_DELADDR]:
             if msg['index'] in self._devices:
                 self._devices[msg['index']]._update_netlink(msg)
+                if self._update_events:
+                    self._updated_devices.add(msg['index'])
+                if msg['header']['type'] == RTM_NEWLINK:
+                    self._index_device(msg['index'])
+                else:
+                    self._if_data.pop(msg['index'], None)
             elif msg['header']['type'] == RTM_NEWLINK:
                 if msg['ifi_type'] == 772:
                     dev = self._device_classes["LoopbackDevice"](self)
                 else:
                     dev = self._device_classes["Device"](self)
                 dev._init_netlink(msg)
-                self._devices[msg['index']] = dev
+                self._set_device(msg['index'], dev)
 
                 update_msg = {"type": "dev_created",
-                              "dev_data": dev._get_if_data()}
+                              "dev_data": self.get_if_data(dev)}
                 self._server_handler.send_data_to_ctl(update_msg)
 
                 if msg['ifi_type'] != 772:
@@ -146,7 +341,7 @@ class InterfaceManager(object):
                 dev = self._devices[msg['index']]
                 dev._deleted = True
 
-                del self._devices[msg['index']]
+                self._remove_device(msg['index'])
 
                 # the event may have been a move of device to netns
                 del_msg = {"ifindex": msg['index']}
@@ -162,46 +357,81 @@ class InterfaceManager(object):
 
     def untrack_device(self, dev):
         if dev.ifindex in self._devices:
-            del self._devices[dev.ifindex]
+            self._remove_device(dev.ifindex)
 
-    def get_device(self, ifindex):
-        self.rescan_devices()
+    def get_device(self, ifindex, replaces_dump=True):
+        self.sync_devices(replaces_dump)
         if ifindex in self._devices:
             return self._devices[ifindex]
         else:
             raise DeviceNotFound()
 
     def get_devices(self):
-        self.rescan_devices()
+        self.sync_devices(replaces_dump=True)
         return list(self._devices.values())
 
     def get_device_by_hwaddr(self, hwaddr):
-        self.rescan_devices()
-        for dev in list(self._devices.values()):
-            if dev.hwaddr == hwaddr:
-                return dev
-        raise DeviceNotFound()
+        self.sync_devices(replaces_dump=True)
+        try:
+            ifindexes = self._hwaddr_index.get(str(hwaddress(hwaddr)), [])
+        except LnstError:
+            raise DeviceNotFound()
+
+        if len(ifindexes) == 0:
+            raise DeviceNotFound()
+        return self._devices[ifindexes[0]]
 
     def get_device_by_name(self, name):
-        self.rescan_devices()
-        for dev in list(self._devices.values()):
-            if dev.name == name:
-                return dev
-        raise DeviceNotFound()
+        self.sync_devices(replaces_dump=True)
+        try:
+            return self._devices[self._name_index[name]]
+        except KeyError:
+            raise DeviceNotFound()
 
     def get_device_by_params(self, params):
-        self.rescan_devices()
-        matched = None
-        for dev in list(self._devices.values()):
-            matched = dev
-            dev_data = dev.get_if_data()
+        matched = self.get_devices_by_params(params)
+        if len(matched) == 0:
+            return None
+        return matched[0]
+
+    def get_devices_by_params(self, params):
+        """returns the devices whose if_data match all of the params
+
+        The name, hwaddr and ifindex params are looked up in the indexes,
+        the params read by ethtool are only checked if required.
+        """
+        self.sync_devices(replaces_dump=True)
+        try:
+            if "ifindex" in params:
+                candidates = [params["ifindex"]]
+            elif "name" in params:
+                candidates = [self._name_index.get(params["name"])]
+            elif "hwaddr" in params:
+                candidates = self._hwaddr_index.get(
+                        str(hwaddress(params["hwaddr"])), [])
+            else:
+                candidates = list(self._devices.keys())
+        except LnstError:
+            return []
+
+        matched = []
+        for ifindex in candidates:
+            if ifindex not in self._devices:
+                continue
+
+            dev = self._devices[ifindex]
+            if ifindex in self._if_data:
+                dev_data = self._if_data[ifindex]
+            else:
+                dev_data = dev._get_nl_if_data()
+                if not set(params.keys()).issubset(dev_data.keys()):
+                    dev_data = self.get_if_data(dev)
+
             for key, value in params.items():
                 if key not in dev_data or dev_data[key] != value:
-                    matched = None
                     break
-
-            if matched:
-                break
+            else:
+                matched.append(dev)
 
         return matched
 
@@ -220,7 +450,17 @@ class InterfaceManager(object):
         device._create()
         device._bulk_enabled = False
 
+        # the RTM_NEWLINK event of the new device is usually already queued,
+        # a dump is only needed if the device appears asynchronously
+        if self._init_created_device(device):
+            return device
+
         self.request_netlink_dump()
+        if self._init_created_device(device):
+            return device
+        raise DeviceError("Device creation failed")
+
+    def _init_created_device(self, device):
         self.pull_netlink_messages_into_queue()
 
         device_found = False
@@ -229,14 +469,20 @@ class InterfaceManager(object):
             if msg.get_attr("IFLA_IFNAME") == device.name:
                 device_found = True
                 device._init_netlink(msg)
-                self._devices[msg['index']] = device
+                self._set_device(msg['index'], device)
             else:
                 self._handle_netlink_msg(msg)
 
-        if device_found:
-            return device
-        else:
-            raise DeviceError("Device creation failed")
+        if not device_found:
+            # the event may have been processed during device._create()
+            for ifindex, dev in list(self._devices.items()):
+                if dev is not device and dev.name == device.name:
+                    device._init_netlink(dev._nl_msg)
+                    device._ip_addrs = list(dev._ip_addrs)
+                    self._set_device(ifindex, device)
+                    device_found = True
+                    break
+        return device_found
 
     def remap_device(self, ifindex, clsname, args=[], kwargs={}):
         devcls = self._device_classes[clsname]
@@ -248,41 +494,71 @@ class InterfaceManager(object):
         except KeyError as e:
             raise DeviceConfigError("%s is a mandatory argument" % e)
         remapped_device._bulk_enabled = False
-        remapped_device.ifindex = ifindex
+        remapped_device._init_netlink(old_device._nl_msg)
+        remapped_device._ip_addrs = list(old_device._ip_addrs)
         self.replace_dev(ifindex, remapped_device)
-        self.rescan_devices()
+        self.sync_devices(replaces_dump=True)
 
     def replace_dev(self, if_id, dev):
-        del self._devices[if_id]
-        self._devices[if_id] = dev
+        self._remove_device(if_id)
+        self._set_device(if_id, dev)
 
-    def _is_name_used(self, name):
-        self.rescan_devices()
-        for device in self._devices.values():
-            if name == device.name:
-                return True
-
-        out, _ = exec_cmd("ovs-vsctl --columns=name list Interface",
-                          log_outputs=False, die_on_err=False)
-        for line in out.split("\n"):
-            m = re.match(r'.*: \"(.*)\"', line)
-            if m is not None:
-                if name == m.group(1):
-                    return True
-        return False
+    def _ovs_interface_names(self):
+        if not self._ovsdb.available():
+            return set()
 
-    def assign_name(self, prefix):
-        index = 0
-        while (self._is_name_used(prefix + str(index))):
+        try:
+            interfaces = self._ovsdb.get_rows("Interface")
+        except OvsdbError as e:
+            logging.debug("Reading OVS interfaces failed: {}".format(str(e)))
+            return set()
+        return set(iface["name"] for iface in interfaces.values())
+
+    def _is_name_used(self, name, ovs_names=None):
+        self.sync_devices(replaces_dump=True)
+        if name in self._name_index:
+            return True
+
+        if ovs_names is None:
+            ovs_names = self._ovs_interface_names()
+        return name in ovs_names
+
+    def _assign_names(self, prefix, count):
+        """returns count lowest unused names of the form prefix<index>
+
+        Indexes below self._name_counters[prefix] are known to be used so
+        the search starts there, the counter is lowered when a device
+        with such name disappears.
+        """
+        self.sync_devices()
+        ovs_names = self._ovs_interface_names()
+
+        names = []
+        index = self._name_counters.get(prefix, 0)
+        first_free = None
+        while len(names) < count:
+            name = prefix + str(index)
+            if not self._is_name_used(name, ovs_names):
+                names.append(name)
+                if first_free is None:
+                    first_free = index
             index += 1
-        return prefix + str(index)
+
+        # the assigned names aren't used until the devices are created
+        self._name_counters[prefix] = first_free
+        return names
+
+    def _name_freed(self, name):
+        for prefix, counter in self._name_counters.items():
+            suffix = name[len(prefix):]
+            # e.g. "veth01" was not assigned from the "veth" counter
+            if (name.startswith(prefix) and suffix.isdecimal() and
+                    suffix == str(int(suffix))):
+                if int(suffix) < counter:
+                    self._name_counters[prefix] = int(suffix)
+
+    def assign_name(self, prefix):
+        return self._assign_names(prefix, 1)[0]
 
     def _assign_name_pair(self, prefix):
-        index1 = 0
-        index2 = 0
-        while (self._is_name_used(prefix + str(index1))):
-            index1 += 1
-        index2 = index1 + 1
-        while (self._is_name_used(prefix + str(index2))):
-            index2 += 1
-        return prefix + str(index1), prefix + str(index2)
+        return tuple(self._assign_names(prefix, 2))
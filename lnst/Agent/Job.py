@@ -16,10 +16,16 @@ import sys
 import signal
 import logging
 import multiprocessing
+from time import monotonic
+from collections import deque
 from lnst.Common.JobError import JobError
 from lnst.Common.ExecCmd import exec_cmd, ExecCmdFail
 from lnst.Common.ConnectionHandler import send_data
 from lnst.Common.Logs import log_exc_traceback
+from lnst.Common.Utils import die_when_parent_die
+
+# number of the most recent job start latencies kept for the statistics
+START_LATENCY_SAMPLES = 10000
 
 def get_job_class(what):
     if what["type"] == "shell":
@@ -30,9 +36,183 @@ def get_job_class(what):
         logging.error("Unknown job type \"%s\"" % what["type"])
         raise JobError("Unknown command type \"%s\"" % what["type"])
 
+def _init_job_process(log_ctl, pipe):
+    os.setpgrp()
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    log_ctl.disable_logging()
+    log_ctl.set_connection(pipe)
+
+def _run_job(job_cls, job_id, pipe, submitted):
+    # the monotonic clock is shared by all processes of the machine
+    start_latency = monotonic() - submitted
+
+    result = {}
+    try:
+        job_cls.run()
+        job_result = job_cls.get_result()
+    except Exception as e:
+        log_exc_traceback()
+        job_result = {}
+        job_result["passed"] = False
+        job_result["type"] = "exception"
+        job_result["res_data"] = job_cls.get_result()
+        job_result["res_data"]["exception"] = e
+    finally:
+        result["type"] = "job_finished"
+        result["job_id"] = job_id
+        result["result"] = job_result
+        result["start_latency"] = start_latency
+
+    send_data(pipe, result)
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {"count": len(values), "p50": rank(0.5), "p90": rank(0.9),
+            "p99": rank(0.99), "max": values[-1]}
+
+class JobWorker(object):
+    """a pre-forked process that runs shell jobs one after another
+
+    The process is the leader of its process group like a process of a
+    single Job, signals sent to the job kill the worker and the
+    processes started by the job.
+    """
+    def __init__(self, log_ctl):
+        self.parent_pipe, self._child_pipe = multiprocessing.Pipe()
+        self._log_ctl = log_ctl
+        self.signaled = False
+
+        self.process = multiprocessing.Process(target=self._serve)
+        self.process.daemon = False
+        self.process.start()
+        self.pid = self.process.pid
+        self._child_pipe.close()
+        # also done by the worker, a job may be killed before it gets to it
+        try:
+            os.setpgid(self.pid, self.pid)
+        except OSError:
+            pass
+
+    def _serve(self):
+        self.parent_pipe.close()
+        # idle workers would otherwise outlive a killed Agent
+        die_when_parent_die()
+        _init_job_process(self._log_ctl, self._child_pipe)
+
+        while True:
+            try:
+                what, submitted = self._child_pipe.recv()
+            except EOFError:
+                break
+            _run_job(get_job_class(what), what["job_id"], self._child_pipe,
+                     submitted)
+        self._child_pipe.close()
+
+    def submit(self, what, submitted):
+        return send_data(self.parent_pipe, (what, submitted))
+
+    def is_alive(self):
+        return not self.signaled and self.process.is_alive()
+
+class JobWorkerPool(object):
+    """pre-forked processes for the shell jobs
+
+    A shell job started while an idle worker is available runs in it
+    instead of a new process, the worker returns to the pool when the job
+    finishes. Workers of killed jobs are replaced by new ones. Module jobs
+    always run in a new process, the modules may change the state of the
+    process.
+
+    Every network namespace process of the Agent keeps its own pool, the
+    workers run in the namespace of the process that forked them.
+    """
+    def __init__(self, log_ctl):
+        self._log_ctl = log_ctl
+        self._size = 0
+        self._idle = deque()
+        self._stats = {"spawned": 0, "discarded": 0}
+
+    def set_size(self, size):
+        self._size = size
+        surplus = []
+        while len(self._idle) > size:
+            surplus.append(self._idle.pop())
+        self._stop(surplus)
+
+    def get_size(self):
+        return self._size
+
+    def needs_refill(self):
+        return len(self._idle) < self._size
+
+    def refill(self):
+        while self.needs_refill():
+            self._idle.append(JobWorker(self._log_ctl))
+            self._stats["spawned"] += 1
+
+    def take(self):
+        """returns an idle worker or None when the pool is empty"""
+        while self._idle:
+            worker = self._idle.popleft()
+            if worker.is_alive():
+                return worker
+            self._discard(worker)
+        return None
+
+    def release(self, worker):
+        """returns the worker of a finished job to the pool"""
+        if worker.is_alive() and len(self._idle) < self._size:
+            self._idle.append(worker)
+        else:
+            self._discard(worker)
+
+    def _discard(self, worker):
+        self._stats["discarded"] += 1
+        self._stop([worker])
+
+    def _stop(self, workers):
+        for worker in workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
+            worker.parent_pipe.close()
+
+    def clear(self):
+        """stops the idle workers, the pool is refilled by refill()"""
+        workers = list(self._idle)
+        self._idle.clear()
+        self._stop(workers)
+
+    def detach(self):
+        """forgets the workers of the parent process in a forked process,
+        the pool is emptied and its former size is returned"""
+        for worker in self._idle:
+            worker.parent_pipe.close()
+        self._idle.clear()
+        size, self._size = self._size, 0
+        return size
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats["size"] = self._size
+        stats["idle"] = len(self._idle)
+        return stats
+
 class JobContext(object):
-    def __init__(self):
+    def __init__(self, log_ctl):
         self._dict = {}
+        self._pool = JobWorkerPool(log_ctl)
+        self._start_latencies = {
+            "pooled": deque(maxlen=START_LATENCY_SAMPLES),
+            "forked": deque(maxlen=START_LATENCY_SAMPLES)}
 
     def add_job(self, job):
         self._dict[job.get_id()] = job
@@ -55,6 +235,22 @@ class JobContext(object):
         logging.debug("Cleaning up leftover processes.")
         self._kill_all_jobs()
         self._dict = {}
+        self._pool.clear()
+
+    def get_pool(self):
+        return self._pool
+
+    def add_start_latency(self, job, latency):
+        key = "pooled" if job.is_pooled() else "forked"
+        self._start_latencies[key].append(latency)
+
+    def get_pool_stats(self):
+        """returns the statistics of the job worker pool and the percentiles
+        of the start latencies of the pooled and forked jobs in seconds"""
+        stats = self._pool.get_stats()
+        stats["start_latency"] = {key: _percentiles(values) for key, values
+                                  in self._start_latencies.items()}
+        return stats
 
     def get_parent_pipes(self):
         pipes = {}
@@ -65,7 +261,7 @@ class JobContext(object):
         return pipes
 
 class Job(object):
-    def __init__(self, what, log_ctl):
+    def __init__(self, what, log_ctl, pool=None):
         self._job_cls = get_job_class(what)
         self._what = what
 
@@ -76,6 +272,9 @@ class Job(object):
         self._pid = None
         self._log_ctl = log_ctl
         self._finished = False
+        self._pool = pool
+        self._worker = None
+        self._submitted = None
 
     def get_id(self):
         return self._id
@@ -83,7 +282,24 @@ class Job(object):
     def get_parent_pipe(self):
         return self._parent_pipe
 
+    def is_pooled(self):
+        return self._worker is not None
+
     def run(self):
+        self._submitted = monotonic()
+        if self._pool is not None and self._what["type"] == "shell":
+            worker = self._pool.take()
+            if worker is not None and worker.submit(self._what,
+                                                    self._submitted):
+                self._worker = worker
+                self._parent_pipe = worker.parent_pipe
+                self._pid = worker.pid
+                logging.debug("Running job %d in pooled worker with pid "
+                              "\"%d\"" % (self._id, self._pid))
+                return True
+            elif worker is not None:
+                self._pool.release(worker)
+
         self._parent_pipe, self._child_pipe = multiprocessing.Pipe()
         self._process = multiprocessing.Process(target=self._run)
 
@@ -96,32 +312,8 @@ class Job(object):
 
     def _run(self):
         self._parent_pipe.close()
-
-        os.setpgrp()
-        signal.signal(signal.SIGHUP, signal.SIG_DFL)
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-
-        self._log_ctl.disable_logging()
-        self._log_ctl.set_connection(self._child_pipe)
-
-        result = {}
-        try:
-            self._job_cls.run()
-            job_result = self._job_cls.get_result()
-        except Exception as e:
-            log_exc_traceback()
-            job_result = {}
-            job_result["passed"] = False
-            job_result["type"] = "exception"
-            job_result["res_data"] = self._job_cls.get_result()
-            job_result["res_data"]["exception"] = e
-        finally:
-            result["type"] = "job_finished"
-            result["job_id"] = self._id
-            result["result"] = job_result
-
-        send_data(self._child_pipe, result)
+        _init_job_process(self._log_ctl, self._child_pipe)
+        _run_job(self._job_cls, self._id, self._child_pipe, self._submitted)
         self._child_pipe.close()
 
     def kill(self, sig=signal.SIGKILL):
@@ -130,6 +322,9 @@ class Job(object):
             return True
         try:
             logging.debug("Sending signal %s to pid %d" % (sig, self._pid))
+            if self._worker is not None:
+                # the worker may not survive the signal, it's replaced
+                self._worker.signaled = True
             os.killpg(self._pid, sig)
 
             if sig == signal.SIGKILL:
@@ -146,14 +341,18 @@ class Job(object):
             return False
 
     def join(self):
-        self._process.join()
+        if self._worker is None:
+            self._process.join()
 
     def set_finished(self, result):
         self._finished = True
         self._result = result
 
-        self._parent_pipe.close()
-        self._child_pipe.close()
+        if self._worker is not None:
+            self._pool.release(self._worker)
+        else:
+            self._parent_pipe.close()
+            self._child_pipe.close()
         self._parent_pipe = None
         self._child_pipe = None
 
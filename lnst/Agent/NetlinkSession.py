@@ -0,0 +1,84 @@
+"""
+This module defines the IPRouteSession class, a long lived pyroute2 IPRoute
+socket shared by all the Device objects of a network namespace.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import os
+import logging
+import pyroute2
+from pyroute2.netlink.exceptions import NetlinkError
+
+class IPRouteSession(object):
+    """Lazily opened IPRoute socket that is reopened after a failure
+
+    Every agent process lives in a single network namespace and owns one
+    InterfaceManager, so one session per InterfaceManager is one session per
+    network namespace. The socket is opened on first use and is reopened
+    when used from a forked process, e.g. a newly created network namespace,
+    so that requests are never sent to the netns of the parent process.
+
+    Errors reported by the kernel (NetlinkError) leave the socket usable.
+    Any other error closes the socket, socket level errors (OSError) are
+    retried once on a new socket.
+    """
+    def __init__(self):
+        self._ipr = None
+        self._pid = None
+        self._stats = {"requests": 0,
+                       "connects": 0,
+                       "reconnects": 0}
+
+    def _get_ipr(self):
+        if self._ipr is not None and self._pid != os.getpid():
+            # inherited from the parent process, don't close it, the
+            # parent still uses the socket
+            self._ipr = None
+
+        if self._ipr is None:
+            self._ipr = pyroute2.IPRoute()
+            self._pid = os.getpid()
+            self._stats["connects"] += 1
+        return self._ipr
+
+    def call(self, obj_name, op_name, *args, **kwargs):
+        """calls IPRoute().obj_name(op_name, *args, **kwargs)
+
+        op_name None calls IPRoute().obj_name(*args, **kwargs)
+        """
+        try:
+            return self._call(obj_name, op_name, *args, **kwargs)
+        except OSError as e:
+            logging.debug("IPRoute session failed ({}), reconnecting"
+                          .format(str(e)))
+            self._stats["reconnects"] += 1
+            return self._call(obj_name, op_name, *args, **kwargs)
+
+    def _call(self, obj_name, op_name, *args, **kwargs):
+        obj = getattr(self._get_ipr(), obj_name)
+        self._stats["requests"] += 1
+        try:
+            if op_name is not None:
+                return obj(op_name, *args, **kwargs)
+            else:
+                return obj(*args, **kwargs)
+        except NetlinkError:
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._ipr is not None and self._pid == os.getpid():
+            try:
+                self._ipr.close()
+            except Exception:
+                pass
+        self._ipr = None
+        self._pid = None
+
+    def get_stats(self):
+        return dict(self._stats)
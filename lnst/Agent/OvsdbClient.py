@@ -0,0 +1,473 @@
+"""
+This module defines the OvsdbClient class, a persistent OVSDB JSON-RPC
+(RFC 7047) connection to the ovsdb-server of Open vSwitch that keeps a local
+replica of the bridge configuration tables.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import os
+import json
+import time
+import codecs
+import select
+import socket
+import logging
+import itertools
+from lnst.Common.LnstError import LnstError
+
+DEFAULT_DB_SOCK = "/var/run/openvswitch/db.sock"
+DEFAULT_DATABASE = "Open_vSwitch"
+# time limit of waiting for ovs-vswitchd to apply a transaction
+DEFAULT_WAIT_TIMEOUT = 30
+
+# the replicated columns, the statistics and status columns updated by
+# ovs-vswitchd all the time are left out
+MONITORED_COLUMNS = {
+    "Open_vSwitch": ["bridges", "next_cfg", "cur_cfg"],
+    "Bridge": ["name", "ports", "fail_mode", "other_config",
+               "external_ids"],
+    "Port": ["name", "interfaces", "tag", "trunks", "vlan_mode",
+             "bond_mode", "lacp", "other_config", "external_ids"],
+    "Interface": ["name", "type", "options", "ofport", "ofport_request",
+                  "mtu_request", "other_config", "external_ids", "error"],
+}
+
+class OvsdbError(LnstError):
+    pass
+
+def _atom(base_type, value):
+    """converts a Python value or an ovs-vsctl style string to an OVSDB
+    atom of the base type"""
+    atomic_type = base_type if isinstance(base_type, str) else base_type["type"]
+    try:
+        if atomic_type == "integer":
+            return int(value)
+        elif atomic_type == "real":
+            return float(value)
+        elif atomic_type == "boolean":
+            if isinstance(value, str):
+                return value.lower() == "true"
+            return bool(value)
+        elif atomic_type == "uuid":
+            return ["uuid", str(value)]
+        else:
+            return str(value)
+    except ValueError:
+        raise OvsdbError("Invalid {} value {!r}".format(atomic_type, value))
+
+def _datum(column_type, value):
+    """converts a Python value or an ovs-vsctl style string to the OVSDB
+    JSON representation of a column value
+
+    Maps are given as dicts, sets as lists or comma separated strings.
+    """
+    if isinstance(column_type, str):
+        return _atom(column_type, value)
+
+    key_type = column_type["key"]
+    if "value" in column_type:
+        if not isinstance(value, dict):
+            raise OvsdbError("Map value expected, got {!r}".format(value))
+        return ["map", [[_atom(key_type, k), _atom(column_type["value"], v)]
+                        for k, v in value.items()]]
+
+    if isinstance(value, str) and column_type.get("max", 1) != 1:
+        value = [v.strip() for v in value.strip("[]").split(",")
+                 if v.strip()]
+    if isinstance(value, (list, tuple, set)):
+        return ["set", [_atom(key_type, v) for v in value]]
+    return _atom(key_type, value)
+
+def datum_to_list(value):
+    """returns the atoms of an OVSDB set value, e.g. references"""
+    if isinstance(value, list) and value[0] == "set":
+        return [datum_to_python(v) for v in value[1]]
+    return [datum_to_python(value)]
+
+def datum_to_python(value):
+    """returns the value of an OVSDB column as a dict for maps, a list for
+    sets and the atom itself otherwise, uuids are returned as strings"""
+    if isinstance(value, list):
+        if value[0] == "map":
+            return {datum_to_python(k): datum_to_python(v)
+                    for k, v in value[1]}
+        elif value[0] == "set":
+            return [datum_to_python(v) for v in value[1]]
+        elif value[0] in ["uuid", "named-uuid"]:
+            return value[1]
+    return value
+
+class OvsdbClient(object):
+    """Persistent connection to the Open vSwitch database
+
+    The connection is opened on first use and monitors the Open_vSwitch,
+    Bridge, Port and Interface tables, the rows are kept in a local replica
+    that is read without asking the server, only the update notifications
+    already received are applied first. ovsdb-server sends the updates
+    caused by a transaction before its reply so a transaction is always
+    visible in the replica right after it returns.
+
+    Transactions run any number of operations in a single round trip. With
+    wait=True they also increment next_cfg and return once ovs-vswitchd
+    reports it applied the change, like ovs-vsctl without --no-wait.
+
+    The connection is reopened when used from a forked process and after
+    it was closed by the server.
+    """
+    def __init__(self, path=DEFAULT_DB_SOCK, database=DEFAULT_DATABASE):
+        self._path = path
+        self._database = database
+        self._sock = None
+        self._pid = None
+        self._buffer = ""
+        self._utf8 = None
+        self._json = json.JSONDecoder()
+        self._ids = itertools.count()
+
+        self._schema = None
+        self._tables = {}
+        self._stats = {"connects": 0,
+                       "requests": 0,
+                       "transactions": 0,
+                       "updates": 0}
+
+    def available(self):
+        """True when the database socket exists"""
+        return os.path.exists(self._path)
+
+    def _connect(self):
+        if self._sock is not None and self._pid != os.getpid():
+            # inherited from the parent process, don't close it, the
+            # parent still uses the socket
+            self._sock = None
+
+        if self._sock is not None:
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except OSError as e:
+            sock.close()
+            raise OvsdbError("Connection to {} failed: {}".format(
+                self._path, str(e)))
+
+        self._sock = sock
+        self._pid = os.getpid()
+        self._buffer = ""
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._stats["connects"] += 1
+        try:
+            self._schema = self._call("get_schema", [self._database])
+
+            monitor_requests = {}
+            for table, columns in MONITORED_COLUMNS.items():
+                known = self._schema["tables"][table]["columns"]
+                monitor_requests[table] = {
+                    "columns": [c for c in columns if c in known]}
+            self._tables = {}
+            self._apply_updates(self._call(
+                "monitor", [self._database, "lnst", monitor_requests]))
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None and self._pid == os.getpid():
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+        self._sock = None
+        self._pid = None
+        self._tables = {}
+
+    def _send(self, msg):
+        try:
+            self._sock.sendall(json.dumps(msg).encode())
+        except OSError as e:
+            self.close()
+            raise OvsdbError("Sending to ovsdb-server failed: {}".format(
+                str(e)))
+
+    def _recv(self, timeout=None):
+        """returns the next message, None if none arrived in timeout"""
+        while True:
+            data = self._buffer.lstrip()
+            if data:
+                try:
+                    msg, end = self._json.raw_decode(data)
+                    self._buffer = data[end:]
+                    return msg
+                except ValueError:
+                    # an incomplete message
+                    pass
+            self._buffer = data
+
+            try:
+                if timeout is not None:
+                    rl, _, _ = select.select([self._sock], [], [], timeout)
+                    if not rl:
+                        return None
+                data = self._sock.recv(65536)
+            except OSError as e:
+                self.close()
+                raise OvsdbError("Receiving from ovsdb-server failed: {}"
+                                 .format(str(e)))
+            if not data:
+                self.close()
+                raise OvsdbError("Connection to ovsdb-server closed")
+            self._buffer += self._utf8.decode(data)
+
+    def _call(self, method, params):
+        request_id = next(self._ids)
+        self._stats["requests"] += 1
+        self._send({"method": method, "params": params, "id": request_id})
+        while True:
+            msg = self._recv()
+            if "method" not in msg and msg.get("id") == request_id:
+                if msg.get("error") is not None:
+                    raise OvsdbError("OVSDB {} failed: {}".format(
+                        method, msg["error"]))
+                return msg["result"]
+            self._handle_notification(msg)
+
+    def _handle_notification(self, msg):
+        method = msg.get("method")
+        if method == "update":
+            self._apply_updates(msg["params"][1])
+        elif method == "echo":
+            self._send({"result": msg["params"], "error": None,
+                        "id": msg["id"]})
+        else:
+            logging.debug("Unexpected OVSDB message {}".format(msg))
+
+    def _apply_updates(self, table_updates):
+        self._stats["updates"] += 1
+        for table, row_updates in table_updates.items():
+            rows = self._tables.setdefault(table, {})
+            for uuid, row_update in row_updates.items():
+                if "new" in row_update:
+                    row = rows.setdefault(uuid, {"_uuid": ["uuid", uuid]})
+                    row.update(row_update["new"])
+                else:
+                    rows.pop(uuid, None)
+
+    def _sync(self):
+        """applies the update notifications received so far"""
+        for attempt in range(2):
+            try:
+                self._connect()
+                while True:
+                    msg = self._recv(timeout=0)
+                    if msg is None:
+                        return
+                    self._handle_notification(msg)
+            except OvsdbError:
+                # the replica is rebuilt on a new connection, reads can
+                # be retried safely
+                if attempt:
+                    raise
+
+    def get_rows(self, table):
+        """returns the replicated rows of the table
+
+        A dict of uuid to row, rows are dicts of column name to the OVSDB
+        JSON value, see datum_to_python.
+        """
+        self._sync()
+        return self._tables.get(table, {})
+
+    def find_row(self, table, name):
+        """returns the uuid and the row named name, (None, None) if
+        there's no such row"""
+        for uuid, row in self.get_rows(table).items():
+            if row.get("name") == name:
+                return uuid, row
+        return None, None
+
+    def _find_uuid(self, table, name):
+        uuid, _ = self.find_row(table, name)
+        if uuid is None:
+            raise OvsdbError("No {} named {}".format(table, name))
+        return uuid
+
+    def get_bridge_ports(self, bridge):
+        """returns a list of (port, interfaces) tuples of the rows of the
+        ports of the bridge and of their interfaces"""
+        _, bridge_row = self.find_row("Bridge", bridge)
+        if bridge_row is None:
+            raise OvsdbError("No Bridge named {}".format(bridge))
+
+        ports = self.get_rows("Port")
+        interfaces = self.get_rows("Interface")
+        result = []
+        for port_uuid in datum_to_list(bridge_row["ports"]):
+            if port_uuid not in ports:
+                continue
+            port = ports[port_uuid]
+            result.append((port, [interfaces[uuid] for uuid in
+                                  datum_to_list(port["interfaces"])
+                                  if uuid in interfaces]))
+        return result
+
+    def transact(self, operations, wait=False, timeout=DEFAULT_WAIT_TIMEOUT):
+        """runs the operations in a single transaction
+
+        Returns the list of operation results, OvsdbError is raised when
+        any of them fails.
+        """
+        self._connect()
+        operations = list(operations)
+        if wait:
+            operations.append({"op": "mutate", "table": "Open_vSwitch",
+                               "where": [],
+                               "mutations": [["next_cfg", "+=", 1]]})
+            operations.append({"op": "select", "table": "Open_vSwitch",
+                               "where": [], "columns": ["next_cfg"]})
+
+        self._stats["transactions"] += 1
+        results = self._call("transact", [self._database] + operations)
+        errors = ["{}: {}".format(r["error"], r.get("details", ""))
+                  for r in results if isinstance(r, dict) and "error" in r]
+        if errors:
+            raise OvsdbError("OVSDB transaction failed: {}".format(
+                "; ".join(errors)))
+
+        if wait:
+            self._wait_for_cfg(results[-1]["rows"][0]["next_cfg"], timeout)
+            results = results[:-2]
+        return results
+
+    def _wait_for_cfg(self, next_cfg, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            for row in self._tables.get("Open_vSwitch", {}).values():
+                if row.get("cur_cfg", 0) >= next_cfg:
+                    return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise OvsdbError("ovs-vswitchd didn't apply the "
+                                 "configuration in {}s".format(timeout))
+            msg = self._recv(timeout=remaining)
+            if msg is not None:
+                self._handle_notification(msg)
+
+    def make_row(self, table, options):
+        """converts ovs-vsctl style column settings to a row
+
+        options is a dict of column name (possibly abbreviated) or
+        column:key for map columns to the value, e.g.
+        {"type": "vxlan", "options:remote_ip": "192.168.0.1"}.
+        """
+        self._connect()
+        columns = self._schema["tables"][table]["columns"]
+        row = {}
+        map_values = {}
+        for spec, value in options.items():
+            name, _, key = spec.partition(":")
+            if name not in columns:
+                matches = [c for c in columns if c.startswith(name)]
+                if len(matches) != 1:
+                    raise OvsdbError("Unknown column {} of table {}".format(
+                        name, table))
+                name = matches[0]
+
+            if key:
+                map_values.setdefault(name, {})[key] = value
+            else:
+                row[name] = _datum(columns[name]["type"], value)
+
+        for name, values in map_values.items():
+            row[name] = _datum(columns[name]["type"], values)
+        return row
+
+    def add_bridge(self, name, wait=True):
+        self.transact([
+            {"op": "insert", "table": "Interface", "uuid-name": "iface",
+             "row": {"name": name, "type": "internal"}},
+            {"op": "insert", "table": "Port", "uuid-name": "port",
+             "row": {"name": name, "interfaces": ["named-uuid", "iface"]}},
+            {"op": "insert", "table": "Bridge", "uuid-name": "bridge",
+             "row": {"name": name, "ports": ["named-uuid", "port"]}},
+            {"op": "mutate", "table": "Open_vSwitch", "where": [],
+             "mutations": [["bridges", "insert",
+                            ["set", [["named-uuid", "bridge"]]]]]}],
+            wait)
+
+    def del_bridge(self, name, wait=True):
+        uuid, bridge = self.find_row("Bridge", name)
+        if uuid is None:
+            raise OvsdbError("No Bridge named {}".format(name))
+
+        operations = [
+            {"op": "mutate", "table": "Open_vSwitch", "where": [],
+             "mutations": [["bridges", "delete",
+                            ["set", [["uuid", uuid]]]]]},
+            self._delete_op("Bridge", uuid)]
+        ports = self.get_rows("Port")
+        for port_uuid in datum_to_list(bridge["ports"]):
+            operations.append(self._delete_op("Port", port_uuid))
+            if port_uuid in ports:
+                for iface_uuid in datum_to_list(
+                        ports[port_uuid]["interfaces"]):
+                    operations.append(self._delete_op("Interface",
+                                                      iface_uuid))
+        self.transact(operations, wait)
+
+    def add_port(self, bridge, name, interfaces, port_options={},
+                 wait=True):
+        """adds a port with the interfaces to the bridge
+
+        interfaces is a list of (name, options) tuples, more than one
+        interface makes a bond, the options are passed to make_row.
+        """
+        bridge_uuid = self._find_uuid("Bridge", bridge)
+
+        operations = []
+        iface_refs = []
+        for i, (iface_name, iface_options) in enumerate(interfaces):
+            row = self.make_row("Interface", iface_options)
+            row["name"] = iface_name
+            uuid_name = "iface{}".format(i)
+            operations.append({"op": "insert", "table": "Interface",
+                               "uuid-name": uuid_name, "row": row})
+            iface_refs.append(["named-uuid", uuid_name])
+
+        row = self.make_row("Port", port_options)
+        row["name"] = name
+        row["interfaces"] = ["set", iface_refs]
+        operations.append({"op": "insert", "table": "Port",
+                           "uuid-name": "port", "row": row})
+        operations.append(
+            {"op": "mutate", "table": "Bridge",
+             "where": [["_uuid", "==", ["uuid", bridge_uuid]]],
+             "mutations": [["ports", "insert",
+                            ["set", [["named-uuid", "port"]]]]]})
+        self.transact(operations, wait)
+
+    def del_port(self, bridge, name, wait=True):
+        bridge_uuid = self._find_uuid("Bridge", bridge)
+        port_uuid, port = self.find_row("Port", name)
+        if port_uuid is None:
+            raise OvsdbError("No Port named {}".format(name))
+
+        operations = [
+            {"op": "mutate", "table": "Bridge",
+             "where": [["_uuid", "==", ["uuid", bridge_uuid]]],
+             "mutations": [["ports", "delete",
+                            ["set", [["uuid", port_uuid]]]]]},
+            self._delete_op("Port", port_uuid)]
+        for iface_uuid in datum_to_list(port["interfaces"]):
+            operations.append(self._delete_op("Interface", iface_uuid))
+        self.transact(operations, wait)
+
+    def _delete_op(self, table, uuid):
+        return {"op": "delete", "table": table,
+                "where": [["_uuid", "==", ["uuid", uuid]]]}
+
+    def get_stats(self):
+        return dict(self._stats)
@@ -203,6 +203,13 @@ class Config():
             raise ConfigError(msg)
         return int(option)
 
+    def optionInt(self, option, cfg_path):
+        try:
+            return int(option)
+        except ValueError:
+            msg = "Option expects a number."
+            raise ConfigError(msg)
+
     def optionPath(self, option, cfg_path):
         exp_path = os.path.expanduser(option)
         abs_path = os.path.join(os.path.dirname(cfg_path), exp_path)
@@ -11,18 +11,117 @@ __author__ = """
 olichtne@redhat.com (Ondrej Lichtner)
 """
 
+import io
 import select
 import socket
+import struct
+import pickle
 import logging
 import traceback
 from multiprocessing.connection import Connection
 from pyroute2 import IPRSocket
 from lnst.Common.SecureSocket import SecureSocket, SecSocketException
 
+# bytes objects at least this large are sent as separate out-of-band frames
+# by the OutOfBandPickleSerializer instead of being copied into the pickle
+OOB_BUFFER_THRESHOLD = 64*1024
+
+def _bytes_from_buffer(buf):
+    return bytes(buf)
+
+class _OutOfBandPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if type(obj) is bytes and len(obj) >= OOB_BUFFER_THRESHOLD:
+            return _bytes_from_buffer, (pickle.PickleBuffer(obj),)
+        return NotImplemented
+
+class PickleSerializer(object):
+    """Serializes every message into a single pickle
+
+    The original serialization format, used by peers that don't negotiate
+    a serializer.
+    """
+    name = "pickle"
+
+    def send_msg(self, s, data):
+        s.send_msg(data)
+
+    def recv_msg(self, s):
+        return s.recv_msg()
+
+class OutOfBandPickleSerializer(object):
+    """Pickle protocol 5 serializer with out-of-band buffers
+
+    Large bytes objects (e.g. file transfer chunks) are not copied into the
+    pickle stream but sent as separate frames directly from the original
+    object. The first frame of every message carries the number of
+    out-of-band frames that follow it and the pickle itself.
+    """
+    name = "pickle5-oob"
+
+    _header = struct.Struct("!I")
+
+    def send_msg(self, s, data):
+        buffers = []
+
+        def buffer_callback(buf):
+            if buf.raw().nbytes < OOB_BUFFER_THRESHOLD:
+                return True
+            buffers.append(buf.raw())
+            return False
+
+        f = io.BytesIO()
+        f.write(self._header.pack(0))
+        _OutOfBandPickler(f, protocol=5,
+                          buffer_callback=buffer_callback).dump(data)
+        main = f.getbuffer()
+        self._header.pack_into(main, 0, len(buffers))
+
+        s.send(main)
+        for buf in buffers:
+            s.send(buf)
+
+    def recv_msg(self, s):
+        main = self._recv_frame(s)
+        n_buffers, = self._header.unpack_from(main)
+        buffers = [self._recv_frame(s) for _ in range(n_buffers)]
+        return pickle.loads(memoryview(main)[self._header.size:],
+                            buffers=buffers)
+
+    def _recv_frame(self, s):
+        frame = s.recv()
+        if frame == b"":
+            raise SecSocketException("Disconnected")
+        return frame
+
+SERIALIZERS = {serializer.name: serializer
+               for serializer in [OutOfBandPickleSerializer(),
+                                  PickleSerializer()]}
+# in order of preference
+SUPPORTED_SERIALIZERS = [OutOfBandPickleSerializer.name,
+                         PickleSerializer.name]
+
+def negotiate_serializer(peer_serializers):
+    """Select the most preferred serializer supported by both peers
+
+    Peers that don't send a list of supported serializers only know the
+    original single pickle format.
+    """
+    if not peer_serializers:
+        return PickleSerializer.name
+
+    for name in SUPPORTED_SERIALIZERS:
+        if name in peer_serializers:
+            return name
+    raise SecSocketException("No common serializer with the peer.")
+
+def get_serializer(s):
+    return SERIALIZERS[s.get_serializer()]
+
 def send_data(s, data):
     try:
         if isinstance(s, SecureSocket):
-            s.send_msg(data)
+            get_serializer(s).send_msg(s, data)
         elif isinstance(s, Connection):
             s.send(data)
         else:
@@ -34,7 +133,7 @@ def send_data(s, data):
 def recv_data(s):
     if isinstance(s, SecureSocket):
         try:
-            data = s.recv_msg()
+            data = get_serializer(s).recv_msg(s)
         except SecSocketException:
             return ""
     elif isinstance(s, Connection):
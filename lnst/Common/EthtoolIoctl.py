@@ -0,0 +1,271 @@
+"""
+In-process access to the ethtool settings of network devices through the
+SIOCETHTOOL ioctl, used instead of running and parsing the output of the
+ethtool command.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import errno
+import fcntl
+import socket
+import struct
+import ctypes
+from lnst.Common.LnstError import LnstError
+
+# linux/sockios.h
+SIOCETHTOOL = 0x8946
+IFNAMSIZ = 16
+
+# linux/ethtool.h
+ETHTOOL_GSET = 0x00000001
+ETHTOOL_SSET = 0x00000002
+ETHTOOL_GCOALESCE = 0x0000000e
+ETHTOOL_SCOALESCE = 0x0000000f
+ETHTOOL_GPAUSEPARAM = 0x00000012
+ETHTOOL_SPAUSEPARAM = 0x00000013
+ETHTOOL_GSTRINGS = 0x0000001b
+ETHTOOL_GSSET_INFO = 0x00000037
+ETHTOOL_GFEATURES = 0x0000003a
+ETHTOOL_SFEATURES = 0x0000003b
+
+ETH_SS_FEATURES = 4
+ETH_GSTRING_LEN = 32
+
+ETHTOOL_F_UNSUPPORTED = 1 << 0
+
+AUTONEG_DISABLE = 0
+AUTONEG_ENABLE = 1
+
+# the link mode bits of the legacy advertising mask, i.e. without the
+# port type, pause and FEC bits
+ALL_ADVERTISED_MODES = 0xfffe803f
+
+# struct ethtool_cmd
+_CMD_FMT = "=IIIHBBBBBBIIHBBIII"
+# struct ethtool_coalesce
+_COALESCE_FIELDS = [
+    "rx_coalesce_usecs", "rx_max_coalesced_frames",
+    "rx_coalesce_usecs_irq", "rx_max_coalesced_frames_irq",
+    "tx_coalesce_usecs", "tx_max_coalesced_frames",
+    "tx_coalesce_usecs_irq", "tx_max_coalesced_frames_irq",
+    "stats_block_coalesce_usecs",
+    "use_adaptive_rx_coalesce", "use_adaptive_tx_coalesce",
+    "pkt_rate_low",
+    "rx_coalesce_usecs_low", "rx_max_coalesced_frames_low",
+    "tx_coalesce_usecs_low", "tx_max_coalesced_frames_low",
+    "pkt_rate_high",
+    "rx_coalesce_usecs_high", "rx_max_coalesced_frames_high",
+    "tx_coalesce_usecs_high", "tx_max_coalesced_frames_high",
+    "rate_sample_interval"]
+_COALESCE_FMT = "=I" + "I" * len(_COALESCE_FIELDS)
+# struct ethtool_pauseparam
+_PAUSE_FMT = "=IIII"
+
+# the feature names accepted by 'ethtool -K' in addition to the kernel
+# feature strings
+OFFLOAD_ALIASES = {
+    "rx": ["rx-checksum"],
+    "tx": ["tx-checksum-ipv4", "tx-checksum-ip-generic",
+           "tx-checksum-ipv6", "tx-checksum-fcoe-crc",
+           "tx-checksum-sctp"],
+    "sg": ["tx-scatter-gather", "tx-scatter-gather-fraglist"],
+    "tso": ["tx-tcp-segmentation", "tx-tcp-ecn-segmentation",
+            "tx-tcp-mangleid-segmentation", "tx-tcp6-segmentation"],
+    "ufo": ["tx-udp-fragmentation"],
+    "gso": ["tx-generic-segmentation"],
+    "gro": ["rx-gro"],
+    "lro": ["rx-lro"],
+    "rxvlan": ["rx-vlan-hw-parse"],
+    "txvlan": ["tx-vlan-hw-insert"],
+    "ntuple": ["rx-ntuple-filter"],
+    "rxhash": ["rx-hashing"],
+}
+
+class EthtoolError(LnstError):
+    def __init__(self, ifname, cmd, err):
+        self.errno = err
+        super(EthtoolError, self).__init__(
+            "ethtool command 0x{:x} on {} failed: {}".format(
+                cmd, ifname, errno.errorcode.get(err, err)))
+
+class EthtoolNotSupported(EthtoolError):
+    """the device driver doesn't implement the operation"""
+    pass
+
+def _ethtool_ioctl(ifname, data):
+    """runs the ethtool command in data, returns the return value of the
+    ioctl and the data updated by the kernel"""
+    cmd = struct.unpack_from("=I", data)[0]
+    buf = ctypes.create_string_buffer(data, len(data))
+    # struct ifreq is 40 bytes on 64 bit architectures
+    ifreq = bytearray(struct.pack("16sP", ifname.encode()[:IFNAMSIZ - 1],
+                                  ctypes.addressof(buf)).ljust(40, b"\0"))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            ret = fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifreq, True)
+        except OSError as e:
+            if e.errno == errno.EOPNOTSUPP:
+                raise EthtoolNotSupported(ifname, cmd, e.errno)
+            raise EthtoolError(ifname, cmd, e.errno)
+    return ret, buf.raw
+
+def _ioctl(ifname, data):
+    return _ethtool_ioctl(ifname, data)[1]
+
+def get_link_settings(ifname):
+    """returns a dict with the speed (Mb/s), duplex and autoneg of the
+    device, speed is None when unknown"""
+    res = struct.unpack(_CMD_FMT, _ioctl(
+        ifname, struct.pack(_CMD_FMT, ETHTOOL_GSET, *([0] * 17))))
+    speed = res[3] | (res[12] << 16)
+    return {"speed": None if speed in [0, 0xffff, 0xffffffff] else speed,
+            "duplex": res[4],
+            "autoneg": res[8] == AUTONEG_ENABLE,
+            "supported": res[1],
+            "advertising": res[2]}
+
+def set_link_settings(ifname, speed=None, autoneg=None):
+    """sets the speed and/or autonegotiation of the device
+
+    Enabling autonegotiation advertises all supported link modes, the same
+    as 'ethtool -s dev autoneg on'.
+    """
+    res = list(struct.unpack(_CMD_FMT, _ioctl(
+        ifname, struct.pack(_CMD_FMT, ETHTOOL_GSET, *([0] * 17)))))
+    res[0] = ETHTOOL_SSET
+    if speed is not None:
+        res[3] = speed & 0xffff
+        res[12] = speed >> 16
+    if autoneg is not None:
+        res[8] = AUTONEG_ENABLE if autoneg else AUTONEG_DISABLE
+        if autoneg:
+            res[2] = ((res[2] & ~ALL_ADVERTISED_MODES) |
+                      (res[1] & ALL_ADVERTISED_MODES))
+    _ioctl(ifname, struct.pack(_CMD_FMT, *res))
+
+def get_coalesce(ifname):
+    res = struct.unpack(_COALESCE_FMT, _ioctl(
+        ifname, struct.pack(_COALESCE_FMT, ETHTOOL_GCOALESCE,
+                            *([0] * len(_COALESCE_FIELDS)))))
+    return dict(zip(_COALESCE_FIELDS, res[1:]))
+
+def set_coalesce(ifname, **values):
+    """updates the coalescing parameters named by the keyword arguments,
+    e.g. use_adaptive_rx_coalesce=1"""
+    coalesce = get_coalesce(ifname)
+    for name, value in values.items():
+        if name not in coalesce:
+            raise LnstError("Unknown coalescing parameter {}".format(name))
+        coalesce[name] = int(value)
+    _ioctl(ifname, struct.pack(_COALESCE_FMT, ETHTOOL_SCOALESCE,
+                               *[coalesce[f] for f in _COALESCE_FIELDS]))
+
+def get_pause(ifname):
+    res = struct.unpack(_PAUSE_FMT, _ioctl(
+        ifname, struct.pack(_PAUSE_FMT, ETHTOOL_GPAUSEPARAM, 0, 0, 0)))
+    return {"autoneg": bool(res[1]),
+            "rx": bool(res[2]),
+            "tx": bool(res[3])}
+
+def set_pause(ifname, rx=None, tx=None):
+    """sets the rx and/or tx pause frames, None keeps the current value"""
+    res = list(struct.unpack(_PAUSE_FMT, _ioctl(
+        ifname, struct.pack(_PAUSE_FMT, ETHTOOL_GPAUSEPARAM, 0, 0, 0))))
+    res[0] = ETHTOOL_SPAUSEPARAM
+    if rx is not None:
+        res[2] = int(bool(rx))
+    if tx is not None:
+        res[3] = int(bool(tx))
+    _ioctl(ifname, struct.pack(_PAUSE_FMT, *res))
+
+def _get_feature_names(ifname):
+    data = _ioctl(ifname, struct.pack("=IIQI", ETHTOOL_GSSET_INFO, 0,
+                                      1 << ETH_SS_FEATURES, 0))
+    count = struct.unpack_from("=I", data, 16)[0]
+
+    data = _ioctl(ifname, struct.pack("=III", ETHTOOL_GSTRINGS,
+                                      ETH_SS_FEATURES, count) +
+                          b"\0" * (count * ETH_GSTRING_LEN))
+    names = []
+    for i in range(count):
+        name = data[12 + i * ETH_GSTRING_LEN:12 + (i + 1) * ETH_GSTRING_LEN]
+        names.append(name.split(b"\0", 1)[0].decode())
+    return names
+
+def _get_feature_blocks(ifname, count):
+    size = (count + 31) // 32
+    data = _ioctl(ifname, struct.pack("=II", ETHTOOL_GFEATURES, size) +
+                          b"\0" * (size * 16))
+    return [struct.unpack_from("=IIII", data, 8 + i * 16)
+            for i in range(size)]
+
+def get_features(ifname):
+    """returns a dict of feature name to a (active, changeable) tuple"""
+    names = _get_feature_names(ifname)
+    blocks = _get_feature_blocks(ifname, len(names))
+
+    features = {}
+    for i, name in enumerate(names):
+        available, requested, active, never_changed = blocks[i // 32]
+        bit = 1 << (i % 32)
+        features[name] = (bool(active & bit),
+                          bool(available & bit) and not never_changed & bit)
+    return features
+
+def set_features(ifname, settings):
+    """sets the features like 'ethtool -K'
+
+    Args:
+        settings -- dict of feature names or 'ethtool -K' short names
+            (e.g. 'gro', 'tso') to True/False or 'on'/'off'
+
+    Features that can't be changed and already have the requested value are
+    skipped, LnstError is raised for the ones that can't be changed.
+    """
+    names = _get_feature_names(ifname)
+    blocks = _get_feature_blocks(ifname, len(names))
+    index = {name: i for i, name in enumerate(names)}
+
+    size = len(blocks)
+    valid = [0] * size
+    requested = [0] * size
+    for name, value in settings.items():
+        if isinstance(value, str):
+            value = value == "on"
+        features = [f for f in OFFLOAD_ALIASES.get(name, [name])
+                    if f in index]
+        if not features:
+            raise EthtoolNotSupported(ifname, ETHTOOL_SFEATURES,
+                                      errno.EOPNOTSUPP)
+
+        for feature in features:
+            i = index[feature]
+            available, _, active, never_changed = blocks[i // 32]
+            bit = 1 << (i % 32)
+            if bool(active & bit) == value:
+                continue
+            if not available & bit or never_changed & bit:
+                if name in OFFLOAD_ALIASES:
+                    # 'ethtool -K' also ignores the fixed features of
+                    # the short names
+                    continue
+                raise LnstError("Feature {} of {} can't be changed"
+                                .format(feature, ifname))
+            valid[i // 32] |= bit
+            if value:
+                requested[i // 32] |= bit
+
+    if not any(valid):
+        return
+
+    data = struct.pack("=II", ETHTOOL_SFEATURES, size)
+    for i in range(size):
+        data += struct.pack("=II", valid[i], requested[i])
+    ret, _ = _ethtool_ioctl(ifname, data)
+    if ret & ETHTOOL_F_UNSUPPORTED:
+        raise EthtoolNotSupported(ifname, ETHTOOL_SFEATURES,
+                                  errno.EOPNOTSUPP)
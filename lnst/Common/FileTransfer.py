@@ -0,0 +1,114 @@
+"""
+Common definitions of the pipelined file transfer used between the
+Controller and the Agent, the chunk size, the number of chunks in flight and
+the optional chunk compression algorithms.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import hashlib
+from lnst.Common.LnstError import LnstError
+
+# size of a single transferred chunk
+FILE_STREAM_CHUNK_SIZE = 1024*1024
+# number of chunks requested or sent before waiting for the oldest result
+FILE_STREAM_WINDOW = 16
+
+class FileTransferError(LnstError):
+    pass
+
+_compressors = {}
+
+try:
+    import zstandard
+
+    def _zstd_compress(data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def _zstd_decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    _compressors["zstd"] = (_zstd_compress, _zstd_decompress)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+
+    _compressors["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+def available_compressions():
+    return sorted(_compressors.keys())
+
+def compress(compression, data):
+    if compression is None:
+        return data
+    try:
+        return _compressors[compression][0](data)
+    except KeyError:
+        raise FileTransferError("Unsupported compression %s" % compression)
+
+def decompress(compression, data):
+    if compression is None:
+        return data
+    try:
+        return _compressors[compression][1](data)
+    except KeyError:
+        raise FileTransferError("Unsupported compression %s" % compression)
+
+def file_digest(filepath, size=None):
+    """sha256 hexdigest of the file or of its first size bytes"""
+    sha256 = hashlib.sha256()
+    _update_from_file(sha256, filepath, 0, size)
+    return sha256.hexdigest()
+
+def _update_from_file(sha256, filepath, offset=0, size=None):
+    with open(filepath, "rb") as f:
+        f.seek(offset)
+        remaining = size
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                data = f.read(FILE_STREAM_CHUNK_SIZE)
+            else:
+                data = f.read(min(FILE_STREAM_CHUNK_SIZE, remaining))
+                remaining -= len(data)
+            if not data:
+                break
+            sha256.update(data)
+
+class StreamDigest(object):
+    """sha256 digest of a file computed from the transferred chunks
+
+    Avoids reading the whole file again after the transfer when the chunks
+    are transferred in order. The part of the file skipped by a resumed
+    transfer is read from the file, out of order chunks make hexdigest fall
+    back to hashing the whole file.
+    """
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._sha256 = hashlib.sha256()
+        self._position = 0
+
+    def update(self, offset, data):
+        if self._sha256 is None:
+            return
+
+        if offset > self._position:
+            _update_from_file(self._sha256, self._filepath, self._position,
+                              offset - self._position)
+            self._position = offset
+
+        if offset == self._position:
+            self._sha256.update(data)
+            self._position += len(data)
+        else:
+            self._sha256 = None
+
+    def hexdigest(self, size):
+        if self._sha256 is not None and self._position == size:
+            return self._sha256.hexdigest()
+        return file_digest(self._filepath, size)
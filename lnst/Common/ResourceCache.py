@@ -9,18 +9,20 @@ __author__ = """
 rpazdera@redhat.com (Radek Pazdera)
 """
 
+import fcntl
 import logging
 import os
 import re
 import time
 import shutil
 import json
+from collections import OrderedDict
 from lnst.Common.ExecCmd import exec_cmd
 from lnst.Common.Utils import sha256sum
 from lnst.Common.LnstError import LnstError
 
 #current index version
-INDEX_VERSION = 1
+INDEX_VERSION = 2
 #minimal supported index version -- will be updated to current one when loaded
 MIN_INDEX_VERSION = 1
 
@@ -28,11 +30,25 @@ class ResourceCacheError(LnstError):
     pass
 
 class ResourceCache(object):
+    """Cache of files identified by their sha256 digest
+
+    The entries are kept in least recently used order. When the total size
+    of the cached files exceeds size_limit (bytes, 0 for no limit) the
+    least recently used entries are removed, entries not used for
+    expiration_period seconds are removed by del_old_entries().
+
+    The index is only updated in memory, flush() writes it to the cache
+    directory (atomically, through a rename) if it changed since the last
+    flush. The Agent flushes it after every batch of processed messages.
+    The processes of the network namespaces share the cache directory, so
+    flush() first merges the index written by the others under a lock on
+    the index and applies the size limit to the merged entries.
+    """
     _CACHE_INDEX_FILE_NAME = "index"
     _root = None
     _expiration_period = None
 
-    def __init__(self, cache_path, expiration_period):
+    def __init__(self, cache_path, expiration_period, size_limit=0):
         if os.path.exists(cache_path):
             if os.path.isdir(cache_path):
                 self._root = cache_path
@@ -43,35 +59,98 @@ class ResourceCache(object):
             self._root = cache_path
 
         self._index = {"index_version": INDEX_VERSION,
-                       "entries": {}}
+                       "entries": OrderedDict()}
+        self._dirty = False
+        self._stats = {"hits": 0,
+                       "misses": 0,
+                       "evictions": 0,
+                       "evicted_bytes": 0,
+                       "index_writes": 0}
         self._read_index()
         self._expiration_period = expiration_period
+        self._size_limit = size_limit
+        self._size = sum([entry["size"]
+                          for entry in self._index["entries"].values()])
 
-    def _read_index(self):
+    def _load_index(self):
         try:
-            with open(self.index_path, "w") as f:
+            with open(self.index_path, "r") as f:
                 index = json.load(f)
-                if index["index_version"] > INDEX_VERSION:
-                    raise ResourceCacheError("Incompatible ResourceCache index versions")
-                elif index["index_version"] == INDEX_VERSION:
-                    self._index = index
-                    logging.debug("Resource cache index loaded")
-                else:
-                    self._index = self._update_old_index(index)
-                    logging.debug("Resource cache index loaded")
-                    self._save_index()
-        except:
-            pass
+
+            if index["index_version"] > INDEX_VERSION:
+                raise ResourceCacheError("Incompatible ResourceCache index versions")
+            elif index["index_version"] < INDEX_VERSION:
+                index = self._update_old_index(index)
+                self._dirty = True
+
+            entries = sorted(index["entries"].items(),
+                             key=lambda x: x[1]["last_used"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, ResourceCacheError) as e:
+            logging.warning("Ignoring the resource cache index: %s" % str(e))
+            return None
+
+        index["entries"] = OrderedDict(entries)
+        return index
+
+    def _read_index(self):
+        index = self._load_index()
+        if index is not None:
+            self._index = index
+            logging.debug("Resource cache index loaded")
+
+    def _merge_index(self):
+        """adds the entries of the index written by other processes, the
+        entries whose files were removed in the meantime are dropped"""
+        index = self._load_index()
+        if index is None:
+            return
+
+        entries = index["entries"]
+        for entry_hash, entry in self._index["entries"].items():
+            if (entry_hash not in entries or
+                    entries[entry_hash]["last_used"] < entry["last_used"]):
+                entries[entry_hash] = entry
+
+        entries = sorted([(entry_hash, entry)
+                          for entry_hash, entry in entries.items()
+                          if os.path.exists(entry["path"])],
+                         key=lambda x: x[1]["last_used"])
+        self._index["entries"] = OrderedDict(entries)
+        self._size = sum([entry["size"] for _, entry in entries])
+        self._evict()
 
     def _update_old_index(self, old):
         if old["index_version"] < MIN_INDEX_VERSION:
             raise ResourceCacheError("ResourceCache index version too old to update")
         logging.debug("Updating old index to newer version")
+
+        if old["index_version"] < 2:
+            for entry_hash, entry in list(old["entries"].items()):
+                try:
+                    entry["size"] = os.path.getsize(entry["path"])
+                except OSError:
+                    del old["entries"][entry_hash]
+        old["index_version"] = INDEX_VERSION
         return old
 
     def _save_index(self):
-        with open(self.index_path, "w") as f:
+        tmp_path = "%s.%d" % (self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
             json.dump(self._index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self._stats["index_writes"] += 1
+
+    def flush(self):
+        if self._dirty:
+            with open(self.index_path + ".lock", "w") as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                self._merge_index()
+                self._save_index()
+            self._dirty = False
 
     @property
     def index_path(self):
@@ -81,15 +160,30 @@ class ResourceCache(object):
     def root(self):
         return self._root
 
+    @property
+    def size(self):
+        return self._size
+
     def query(self, res_hash):
-        return res_hash in self._index["entries"]
+        entry = self._index["entries"].get(res_hash)
+        if entry is not None and not os.path.exists(entry["path"]):
+            # removed by the process of another network namespace
+            self._remove_entry(res_hash)
+            entry = None
+
+        if entry is None:
+            self._stats["misses"] += 1
+            return False
+        self._stats["hits"] += 1
+        return True
 
     def get_path(self, res_hash):
         return self._index["entries"][res_hash]["path"]
 
     def renew_entry(self, entry_hash):
         self._index["entries"][entry_hash]["last_used"] = int(time.time())
-        self._save_index()
+        self._index["entries"].move_to_end(entry_hash)
+        self._dirty = True
 
     def add_file_entry(self, filepath, entry_name):
         entry_hash = sha256sum(filepath)
@@ -107,28 +201,64 @@ class ResourceCache(object):
                  "path": entry_path,
                  "last_used": int(time.time()),
                  "digest": entry_hash,
-                 "type": "file"}
+                 "type": "file",
+                 "size": os.path.getsize(entry_path)}
         self._index["entries"][entry_hash] = entry
+        self._size += entry["size"]
+        self._dirty = True
 
-        self._save_index()
+        self._evict(keep=entry_hash)
 
         return entry_hash
 
+    def _evict(self, keep=None):
+        if not self._size_limit:
+            return
+
+        for entry_hash in list(self._index["entries"].keys()):
+            if self._size <= self._size_limit:
+                break
+            if entry_hash == keep:
+                continue
+
+            logging.debug("Evicting resource cache entry %s" %
+                          self._index["entries"][entry_hash]["name"])
+            self._stats["evictions"] += 1
+            self._stats["evicted_bytes"] += \
+                self._index["entries"][entry_hash]["size"]
+            self.del_cache_entry(entry_hash)
+
+    def _remove_entry(self, entry_hash):
+        entry = self._index["entries"].pop(entry_hash)
+        self._size -= entry["size"]
+        self._dirty = True
+        return entry
+
     def del_cache_entry(self, entry_hash):
         if entry_hash in self._index["entries"]:
-            os.remove(self._index["entries"][entry_hash].path)
-            del self._index["entries"][entry_hash]
-            self._save_index()
+            entry = self._remove_entry(entry_hash)
+            try:
+                os.remove(entry["path"])
+            except FileNotFoundError:
+                pass
 
     def del_old_entries(self):
-        if self._expiration_period == 0:
-            return
+        if self._expiration_period != 0:
+            rm = []
+            now = time.time()
+            for entry_hash, entry in list(self._index["entries"].items()):
+                if entry["last_used"] <= (now - self._expiration_period):
+                    rm.append(entry_hash)
 
-        rm = []
-        now = time.time()
-        for entry_hash, entry in list(self._index["entries"].items()):
-            if entry["last_used"] <= (now - self._expiration_period):
-                rm.append(entry_hash)
+            for entry_hash in rm:
+                self.del_cache_entry(entry_hash)
 
-        for entry_hash in rm:
-            self.del_cache_entry(entry_hash)
+        self._evict()
+        self.flush()
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats["entries"] = len(self._index["entries"])
+        stats["size"] = self._size
+        stats["size_limit"] = self._size_limit
+        return stats
@@ -17,6 +17,7 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import os
 import pickle
+import struct
 import hashlib
 import hmac
 from lnst.Common.Utils import not_imported
@@ -72,9 +73,67 @@ SRP_GROUP["p_size"] = bit_length(SRP_GROUP["p"])//8
 if bit_length(SRP_GROUP["p"])%8:
     SRP_GROUP["p_size"] += 1
 
+# wire framing versions, negotiated in the ctl_hello/agent_hello exchange
+# FRAMING_ASCII - ascii decimal length followed by a space, the original format
+# FRAMING_BINARY - fixed size binary header carrying the length
+FRAMING_ASCII = 1
+FRAMING_BINARY = 2
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_ASCII]
+
+FRAME_HEADER = struct.Struct("!Q")
+# payloads smaller than this are cheaper to copy behind the header than to
+# send as a separate buffer
+FRAME_COALESCE_LIMIT = 64*1024
+
+# record protection cipher suites, negotiated in the ctl_hello/agent_hello
+# exchange, in order of preference
+# CBC_HMAC_SHA256 - the original AES-CBC + HMAC-SHA256 pickled record format
+# AES256_GCM, CHACHA20_POLY1305 - single pass AEAD over a binary record
+CIPHER_SUITE_CBC_HMAC_SHA256 = "aes256-cbc-hmac-sha256"
+CIPHER_SUITE_AES256_GCM = "aes256-gcm"
+CIPHER_SUITE_CHACHA20_POLY1305 = "chacha20-poly1305"
+SUPPORTED_CIPHER_SUITES = [CIPHER_SUITE_AES256_GCM,
+                           CIPHER_SUITE_CHACHA20_POLY1305,
+                           CIPHER_SUITE_CBC_HMAC_SHA256]
+AEAD_CIPHER_SUITES = [CIPHER_SUITE_AES256_GCM,
+                      CIPHER_SUITE_CHACHA20_POLY1305]
+
+AEAD_KEY_SIZE = 32
+AEAD_SALT_SIZE = 4
+# explicit sequence number sent in front of every AEAD record, authenticated
+# as associated data and used for the nonce together with the implicit salt
+AEAD_RECORD_HEADER = struct.Struct("!Q")
+
 class SecSocketException(LnstError):
     pass
 
+def _negotiate(supported, peer_supported, default, what):
+    if not peer_supported:
+        return default
+
+    for item in supported:
+        if item in peer_supported:
+            return item
+    raise SecSocketException("No common %s with the peer." % what)
+
+def negotiate_framing(peer_framings):
+    """Select the highest framing version supported by both peers
+
+    Peers that don't send a list of supported framings only know the
+    original ascii framing.
+    """
+    return _negotiate(SUPPORTED_FRAMINGS, peer_framings, FRAMING_ASCII,
+                      "wire framing")
+
+def negotiate_cipher_suite(peer_suites):
+    """Select the most preferred cipher suite supported by both peers
+
+    Peers that don't send a list of supported cipher suites only know the
+    original CBC + HMAC record protection.
+    """
+    return _negotiate(SUPPORTED_CIPHER_SUITES, peer_suites,
+                      CIPHER_SUITE_CBC_HMAC_SHA256, "cipher suite")
+
 cryptography = not_imported
 hashes = not_imported
 Cipher = not_imported
@@ -89,7 +148,10 @@ RSAPublicKey = not_imported
 DSAPrivateKey = not_imported
 DSAPublicKey = not_imported
 default_backend = not_imported
-cryptography_imported = not_imported
+AESGCM = not_imported
+ChaCha20Poly1305 = not_imported
+InvalidTag = not_imported
+cryptography_imported = False
 def cryptography_imports():
     global cryptography_imported
     if cryptography_imported:
@@ -109,6 +171,9 @@ def cryptography_imports():
     global DSAPrivateKey
     global DSAPublicKey
     global default_backend
+    global AESGCM
+    global ChaCha20Poly1305
+    global InvalidTag
 
     try:
         import cryptography.exceptions
@@ -122,6 +187,9 @@ def cryptography_imports():
         from cryptography.hazmat.primitives.asymmetric.dsa import DSAPrivateKey
         from cryptography.hazmat.primitives.asymmetric.dsa import DSAPublicKey
         from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        from cryptography.exceptions import InvalidTag
         cryptography_imported = True
     except ImportError:
         raise SecSocketException("Library 'cryptography' missing "\
@@ -131,24 +199,39 @@ class SecureSocket(object):
     def __init__(self, soc):
         self._role = None
         self._socket = soc
+        self._framing = FRAMING_ASCII
+        # name of the serializer used by lnst.Common.ConnectionHandler
+        self._serializer = "pickle"
+        self._header_buf = bytearray(FRAME_HEADER.size)
 
         self._master_secret = ""
 
         self._ctl_random = None
         self._agent_random = None
 
-        self._current_write_spec = {"enc_key": None,
-                                    "mac_key": None,
-                                    "seq_num": 0}
-        self._current_read_spec = {"enc_key": None,
-                                   "mac_key": None,
-                                   "seq_num": 0}
-        self._next_write_spec = {"enc_key": None,
-                                 "mac_key": None,
-                                 "seq_num": 0}
-        self._next_read_spec = {"enc_key": None,
-                                "mac_key": None,
-                                "seq_num": 0}
+        self._cipher_suite = CIPHER_SUITE_CBC_HMAC_SHA256
+
+        self._current_write_spec = self._empty_cipher_spec()
+        self._current_read_spec = self._empty_cipher_spec()
+        self._next_write_spec = self._empty_cipher_spec()
+        self._next_read_spec = self._empty_cipher_spec()
+
+    @staticmethod
+    def _empty_cipher_spec():
+        return {"enc_key": None,
+                "mac_key": None,
+                "aead": None,
+                "salt": None,
+                "seq_num": 0}
+
+    def set_cipher_suite(self, cipher_suite):
+        if cipher_suite not in SUPPORTED_CIPHER_SUITES:
+            raise SecSocketException("Unsupported cipher suite %s" %
+                                     cipher_suite)
+        self._cipher_suite = cipher_suite
+
+    def get_cipher_suite(self):
+        return self._cipher_suite
 
     def send_msg(self, msg):
         pickled_msg = pickle.dumps(msg)
@@ -213,10 +296,11 @@ class SecureSocket(object):
             return data
         cryptography_imports()
 
-        pad_length = ord(data[-1])
-        for char in data[-pad_length]:
-            if ord(char) != pad_length:
-                return None
+        pad_length = data[-1]
+        if pad_length == 0 or pad_length > len(data):
+            return None
+        if data[-pad_length:] != bytes([pad_length]) * pad_length:
+            return None
 
         return data[:-pad_length]
 
@@ -256,7 +340,45 @@ class SecureSocket(object):
 
         return decrypted_data
 
+    def _aead_protect(self, data):
+        spec = self._current_write_spec
+        header = AEAD_RECORD_HEADER.pack(spec["seq_num"])
+        nonce = spec["salt"] + header
+        encrypted = spec["aead"].encrypt(nonce, data, header)
+
+        spec["seq_num"] += 1
+        return header + encrypted
+
+    def _aead_unprotect(self, record):
+        spec = self._current_read_spec
+        if len(record) < AEAD_RECORD_HEADER.size:
+            return None
+
+        record = memoryview(record)
+        header = record[:AEAD_RECORD_HEADER.size]
+        seq_num, = AEAD_RECORD_HEADER.unpack(header)
+        if seq_num != spec["seq_num"]:
+            # replayed, reordered or dropped record
+            return None
+
+        nonce = spec["salt"] + header.tobytes()
+        try:
+            data = spec["aead"].decrypt(nonce,
+                                        record[AEAD_RECORD_HEADER.size:],
+                                        header)
+        except InvalidTag:
+            return None
+
+        spec["seq_num"] += 1
+        return data
+
     def _protect_data(self, data):
+        if self._current_write_spec["aead"] is not None:
+            return self._aead_protect(data)
+
+        if self._current_write_spec["mac_key"] and isinstance(data, memoryview):
+            data = data.tobytes()
+
         signed = self._add_mac_sign(data)
         padded = self._add_padding(signed)
         encrypted = self._add_encrypt(padded)
@@ -265,6 +387,9 @@ class SecureSocket(object):
         return encrypted
 
     def _uprotect_data(self, encrypted):
+        if self._current_read_spec["aead"] is not None:
+            return self._aead_unprotect(encrypted)
+
         padded = self._del_encrypt(encrypted)
         signed = self._del_padding(padded)
 
@@ -278,14 +403,72 @@ class SecureSocket(object):
         self._current_read_spec["seq_num"] += 1
         return data
 
+    def set_framing(self, framing):
+        if framing not in SUPPORTED_FRAMINGS:
+            raise SecSocketException("Unsupported wire framing %s" % framing)
+        self._framing = framing
+
+    def get_framing(self):
+        return self._framing
+
+    def set_serializer(self, serializer):
+        self._serializer = serializer
+
+    def get_serializer(self):
+        return self._serializer
+
     def send(self, data):
         protected_data = self._protect_data(data)
 
+        if self._framing == FRAMING_BINARY:
+            header = FRAME_HEADER.pack(len(protected_data))
+            if len(protected_data) < FRAME_COALESCE_LIMIT:
+                return self._socket.sendall(header + protected_data)
+            return self._sendall_buffers([header, protected_data])
+
         transmit_data = bytes(str(len(protected_data)).encode('ascii')) + b" " + protected_data
 
         return self._socket.sendall(transmit_data)
 
-    def recv(self):
+    def _sendall_buffers(self, buffers):
+        """sends all buffers with as few syscalls as possible
+
+        Avoids concatenating the frame header with the payload, which would
+        copy the whole payload just to prepend a few bytes.
+        """
+        views = [memoryview(buf).cast("B") for buf in buffers]
+        views = [view for view in views if len(view)]
+        while views:
+            sent = self._socket.sendmsg(views)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+
+    def _recv_into_exactly(self, view):
+        received = 0
+        length = len(view)
+        while received < length:
+            n = self._socket.recv_into(view[received:], length - received)
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def _recv_binary(self):
+        if not self._recv_into_exactly(memoryview(self._header_buf)):
+            return b""
+        length, = FRAME_HEADER.unpack(self._header_buf)
+
+        data = bytearray(length)
+        if not self._recv_into_exactly(memoryview(data)):
+            return b""
+        return data
+
+    def _recv_ascii(self):
         length = b""
         while True:
             c = self._socket.recv(1)
@@ -305,6 +488,16 @@ class SecureSocket(object):
                 return b""
             else:
                 data += c
+        return data
+
+    def recv(self):
+        if self._framing == FRAMING_BINARY:
+            data = self._recv_binary()
+        else:
+            data = self._recv_ascii()
+
+        if data == b"":
+            return b""
 
         msg = self._uprotect_data(data)
         if msg is None:
@@ -312,6 +505,11 @@ class SecureSocket(object):
         return self._handle_internal(msg)
 
     def _handle_internal(self, orig_msg):
+        # change_cipher_spec can only arrive once the next read cipher spec
+        # is initialized, avoid unpickling every message to look for it
+        if (self._next_read_spec["enc_key"] is None and
+                self._next_read_spec["aead"] is None):
+            return orig_msg
         try:
             msg = pickle.loads(orig_msg)
         except:
@@ -344,16 +542,12 @@ class SecureSocket(object):
 
     def _change_read_cipher_spec(self):
         self._current_read_spec = self._next_read_spec
-        self._next_read_spec = {"enc_key": None,
-                                "mac_key": None,
-                                "seq_num": 0}
+        self._next_read_spec = self._empty_cipher_spec()
         return
 
     def _change_write_cipher_spec(self):
         self._current_write_spec = self._next_write_spec
-        self._next_write_spec = {"enc_key": None,
-                                 "mac_key": None,
-                                 "seq_num": 0}
+        self._next_write_spec = self._empty_cipher_spec()
         return
 
     def p_SHA256(self, secret, seed, length):
@@ -369,6 +563,8 @@ class SecureSocket(object):
         return result[:length]
 
     def PRF(self, secret, label, seed, length):
+        if isinstance(label, str):
+            label = label.encode("ascii")
         return self.p_SHA256(secret, label+seed, length)
 
     def _init_cipher_spec(self):
@@ -382,7 +578,11 @@ class SecureSocket(object):
             raise SecSocketException("Socket without a role!")
         cryptography_imports()
 
-        aes_keysize = max(algorithms.AES.key_sizes)//8
+        if self._cipher_suite in AEAD_CIPHER_SUITES:
+            return self._init_aead_cipher_spec(client_spec, server_spec)
+
+        # AES.key_sizes also lists the double length XTS keys
+        aes_keysize = 256//8
         mac_keysize = hashlib.sha256().block_size
 
         prf_seq = self.PRF(self._master_secret,
@@ -401,6 +601,27 @@ class SecureSocket(object):
         prf_seq = prf_seq[mac_keysize:]
         return
 
+    def _init_aead_cipher_spec(self, client_spec, server_spec):
+        if self._cipher_suite == CIPHER_SUITE_AES256_GCM:
+            aead_cls = AESGCM
+        else:
+            aead_cls = ChaCha20Poly1305
+
+        prf_seq = self.PRF(self._master_secret,
+                           "key expansion",
+                           self._agent_random + self._ctl_random,
+                           2 * AEAD_KEY_SIZE + 2 * AEAD_SALT_SIZE)
+
+        for spec in [client_spec, server_spec]:
+            spec["enc_key"] = prf_seq[:AEAD_KEY_SIZE]
+            prf_seq = prf_seq[AEAD_KEY_SIZE:]
+            spec["aead"] = aead_cls(spec["enc_key"])
+
+        for spec in [client_spec, server_spec]:
+            spec["salt"] = prf_seq[:AEAD_SALT_SIZE]
+            prf_seq = prf_seq[AEAD_SALT_SIZE:]
+        return
+
     def _sign_data(self, data, privkey):
         cryptography_imports()
         if isinstance(privkey, DSAPrivateKey):
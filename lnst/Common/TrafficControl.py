@@ -0,0 +1,430 @@
+"""
+Netlink based snapshots of the traffic control configuration (qdiscs,
+classes and filters) of a network device, used instead of running and
+parsing the output of the tc command.
+
+A snapshot is a dictionary of plain values that can be sent to the
+Controller and restored later. The qdiscs, classes and filters are kept as
+the attributes the kernel dumped, without the statistics, so any kind of
+them can be restored without knowing its options. Restoring compares the
+snapshot with the current configuration and recreates only the qdisc trees
+that differ, all the changes are sent to the kernel in a single batch.
+
+Copyright 2026 Red Hat, Inc.
+Licensed under the GNU General Public License, version 2 as
+published by the Free Software Foundation; see COPYING for details.
+"""
+
+import struct
+from pyroute2.netlink import nlmsg
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE
+from pyroute2.netlink import NLM_F_EXCL, NLM_F_REPLACE
+from pyroute2.netlink.rtnl import RTM_NEWQDISC, RTM_DELQDISC
+from pyroute2.netlink.rtnl import RTM_NEWTCLASS, RTM_NEWTFILTER
+from pyroute2.netlink.rtnl import RTM_DELTFILTER
+from lnst.Common.LnstError import LnstError
+
+SNAPSHOT_VERSION = 1
+
+# include/uapi/linux/pkt_sched.h
+TC_H_ROOT = 0xFFFFFFFF
+TC_H_INGRESS = 0xFFFFFFF1
+TC_H_MAJ_MASK = 0xFFFF0000
+TC_H_MIN_INGRESS = 0xFFF2
+TC_H_MIN_EGRESS = 0xFFF3
+
+# include/uapi/linux/rtnetlink.h
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_CHAIN = 11
+TCA_INGRESS_BLOCK = 13
+TCA_EGRESS_BLOCK = 14
+
+NLA_TYPE_MASK = 0x3FFF
+
+# the configuration attributes, the others are statistics
+CONFIG_ATTRS = frozenset([TCA_KIND, TCA_OPTIONS, TCA_CHAIN,
+                          TCA_INGRESS_BLOCK, TCA_EGRESS_BLOCK])
+
+# include/uapi/linux/pkt_sched.h
+TCA_HTB_INIT = 2
+HTB_VER = 0x30011
+
+# include/uapi/linux/pkt_cls.h
+TCA_ACT_STATS = 4
+TCA_ACT_PAD = 5
+TCA_ACT_USED_HW_STATS = 9
+TCA_ACT_IN_HW_COUNT = 10
+TCA_U32_DIVISOR = 4
+TCA_U32_ACT = 7
+TCA_U32_PCNT = 9
+TCA_U32_FLAGS = 11
+TCA_U32_PAD = 12
+TCA_FLOWER_ACT = 3
+TCA_FLOWER_FLAGS = 22
+TCA_FLOWER_IN_HW_COUNT = 86
+TCA_MATCHALL_ACT = 2
+TCA_MATCHALL_FLAGS = 3
+TCA_MATCHALL_PCNT = 4
+TCA_MATCHALL_PAD = 5
+TCA_CLS_FLAGS_SKIP_HW = 1 << 0
+TCA_CLS_FLAGS_SKIP_SW = 1 << 1
+
+# qdiscs with classes created by the user, the classes of other qdiscs
+# (e.g. the bands of prio or the queues of mq) come with the qdisc
+CLASSFUL_KINDS = frozenset(["htb", "hfsc", "drr", "qfq", "cbq", "atm"])
+
+# nlmsghdr + struct tcmsg
+_NLMSG_HDR_LEN = 16
+_TCMSG_FMT = "=BxxxiIII"
+_TCMSG_LEN = struct.calcsize(_TCMSG_FMT)
+
+class TrafficControlError(LnstError):
+    pass
+
+class tcmsg_raw(nlmsg):
+    """struct tcmsg followed by already encoded attributes"""
+    fields = (('family', 'B'),
+              ('pad1', 'B'),
+              ('pad2', 'H'),
+              ('index', 'i'),
+              ('handle', 'I'),
+              ('parent', 'I'),
+              ('info', 'I'))
+
+    raw_attrs = b""
+
+    def encode(self):
+        nlmsg.encode(self)
+        self.data.extend(self.raw_attrs)
+        self.length = self['header']['length'] = (len(self.data) -
+                                                  self.offset)
+        struct.pack_into("=I", self.data, self.offset, self.length)
+
+def _iter_attrs(data):
+    """yields (type, encoded attribute) pairs of an NLA chain, the encoded
+    attributes include their padding"""
+    offset = 0
+    while offset + 4 <= len(data):
+        length, nla_type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        aligned = (length + 3) & ~3
+        yield nla_type & NLA_TYPE_MASK, data[offset:offset + aligned]
+        offset += aligned
+
+def _encode_attr(nla_type, payload):
+    length = 4 + len(payload)
+    return struct.pack("=HH", length, nla_type) + payload + \
+           b"\0" * (((length + 3) & ~3) - length)
+
+def _attr_payload(attr):
+    length = struct.unpack_from("=H", attr)[0]
+    return attr[4:length]
+
+def _rewrite_attrs(data, rewrites):
+    """rewrites the payloads of the attributes of an NLA chain with the
+    rewrites functions by type, a function returning None drops the
+    attribute"""
+    result = b""
+    for nla_type, attr in _iter_attrs(data):
+        if nla_type in rewrites:
+            payload = rewrites[nla_type](_attr_payload(attr))
+            if payload is None:
+                continue
+            attr = _encode_attr(struct.unpack_from("=H", attr, 2)[0],
+                                payload)
+        result += attr
+    return result
+
+def _drop(payload):
+    return None
+
+def _cls_flags(payload):
+    # the in_hw and not_in_hw flags are reported by the kernel and not
+    # accepted when creating a filter
+    flags = struct.unpack_from("=I", payload)[0]
+    return struct.pack("=I", flags & (TCA_CLS_FLAGS_SKIP_HW |
+                                      TCA_CLS_FLAGS_SKIP_SW))
+
+_ACTION_REWRITES = {TCA_ACT_STATS: _drop,
+                    TCA_ACT_PAD: _drop,
+                    TCA_ACT_USED_HW_STATS: _drop,
+                    TCA_ACT_IN_HW_COUNT: _drop}
+
+def _actions(payload):
+    # a nested attribute per action in the order of execution
+    return _rewrite_attrs(payload, {
+        nla_type: lambda action: _rewrite_attrs(action, _ACTION_REWRITES)
+        for nla_type, _ in _iter_attrs(payload)})
+
+def _htb_init(payload):
+    # dumped with the full version, htb only accepts the major one
+    return struct.pack("=I", HTB_VER >> 16) + payload[4:]
+
+# rewrites of the dumped options of the given kinds that drop the
+# statistics and make them valid for creating a new object
+OPTION_REWRITES = {
+    ("qdisc", "htb"): {TCA_HTB_INIT: _htb_init},
+    ("filter", "u32"): {TCA_U32_ACT: _actions,
+                        TCA_U32_PCNT: _drop,
+                        TCA_U32_FLAGS: _cls_flags,
+                        TCA_U32_PAD: _drop},
+    ("filter", "flower"): {TCA_FLOWER_ACT: _actions,
+                           TCA_FLOWER_FLAGS: _cls_flags,
+                           TCA_FLOWER_IN_HW_COUNT: _drop},
+    ("filter", "matchall"): {TCA_MATCHALL_ACT: _actions,
+                             TCA_MATCHALL_FLAGS: _cls_flags,
+                             TCA_MATCHALL_PCNT: _drop,
+                             TCA_MATCHALL_PAD: _drop},
+}
+
+def _entry(msg, obj_type):
+    raw = bytes(msg.data[msg.offset:msg.offset + msg['header']['length']])
+    _, _, handle, parent, info = struct.unpack_from(_TCMSG_FMT, raw,
+                                                    _NLMSG_HDR_LEN)
+    attrs = [(nla_type, attr) for nla_type, attr in
+             _iter_attrs(raw[_NLMSG_HDR_LEN + _TCMSG_LEN:])
+             if nla_type in CONFIG_ATTRS]
+    kind = None
+    for nla_type, attr in attrs:
+        if nla_type == TCA_KIND:
+            kind = _attr_payload(attr).rstrip(b"\0").decode()
+
+    rewrites = OPTION_REWRITES.get((obj_type, kind))
+    if rewrites:
+        attrs = [(nla_type, attr) if nla_type != TCA_OPTIONS else
+                 (nla_type, _encode_attr(
+                     struct.unpack_from("=H", attr, 2)[0],
+                     _rewrite_attrs(_attr_payload(attr), rewrites)))
+                 for nla_type, attr in attrs]
+
+    if obj_type != "filter":
+        # the reference count of qdiscs and the leaf qdisc of classes
+        info = 0
+    return {"kind": kind, "handle": handle, "parent": parent, "info": info,
+            "attrs": b"".join(attr for _, attr in attrs).hex()}
+
+def _options(entry):
+    """returns the options of the entry as a {type: payload} dictionary"""
+    for nla_type, attr in _iter_attrs(bytes.fromhex(entry["attrs"])):
+        if nla_type == TCA_OPTIONS:
+            return {t: _attr_payload(a)
+                    for t, a in _iter_attrs(_attr_payload(attr))}
+    return {}
+
+def _created_with_classifier(tc_filter):
+    """u32 creates a root hash table with one bucket with the classifier
+    instance, hash tables created by the user usually have more buckets"""
+    if tc_filter["kind"] != "u32" or tc_filter["handle"] & 0xFFF:
+        return False
+    divisor = _options(tc_filter).get(TCA_U32_DIVISOR)
+    return divisor is not None and struct.unpack("=I", divisor)[0] == 1
+
+def _major(handle):
+    return handle & TC_H_MAJ_MASK
+
+def _is_top(qdisc):
+    return qdisc["parent"] in (TC_H_ROOT, TC_H_INGRESS)
+
+def _dump(call, obj_type, op_name, **kwargs):
+    return [_entry(msg, obj_type) for msg in call(op_name, None, **kwargs)]
+
+def snapshot(call, ifindex):
+    """returns the traffic control configuration of the device
+
+    call is a function calling the methods of a pyroute2 IPRoute object,
+    e.g. IPRouteSession.call.
+
+    Uses one netlink dump for the qdiscs, one for the classes and one per
+    qdisc or class with filters.
+    """
+    qdiscs = []
+    kinds = {}
+    for qdisc in _dump(call, "qdisc", "get_qdiscs", index=ifindex):
+        # qdiscs without a handle are created by the kernel, either the
+        # default root qdisc or the children of a new qdisc
+        if qdisc["handle"]:
+            qdiscs.append(qdisc)
+            kinds[_major(qdisc["handle"])] = qdisc["kind"]
+
+    classes = [cls for cls in _dump(call, "class", "get_classes", index=ifindex)
+               if kinds.get(_major(cls["handle"])) in CLASSFUL_KINDS]
+
+    filter_parents = []
+    for qdisc in qdiscs:
+        if qdisc["kind"] in ["ingress", "clsact"]:
+            filter_parents.append(TC_H_INGRESS & TC_H_MAJ_MASK |
+                                  TC_H_MIN_INGRESS)
+            if qdisc["kind"] == "clsact":
+                filter_parents.append(TC_H_INGRESS & TC_H_MAJ_MASK |
+                                      TC_H_MIN_EGRESS)
+        else:
+            filter_parents.append(qdisc["handle"])
+    filter_parents.extend(cls["handle"] for cls in classes)
+
+    filters = []
+    for parent in filter_parents:
+        for tc_filter in _dump(call, "filter", "get_filters",
+                               index=ifindex, parent=parent):
+            # every filter priority starts with an entry without a handle
+            # and options for the classifier instance itself
+            if tc_filter["handle"] and \
+               not _created_with_classifier(tc_filter):
+                tc_filter["parent"] = parent
+                filters.append(tc_filter)
+
+    return {"version": SNAPSHOT_VERSION, "qdiscs": qdiscs,
+            "classes": classes, "filters": filters}
+
+def _trees(snap):
+    """splits the snapshot to the root and ingress qdisc trees"""
+    trees = {TC_H_ROOT: [], TC_H_INGRESS: []}
+    majors = {}
+    pending = list(snap["qdiscs"])
+    while pending:
+        remaining = []
+        for qdisc in pending:
+            if _is_top(qdisc):
+                top = qdisc["parent"]
+            elif _major(qdisc["parent"]) in majors:
+                top = majors[_major(qdisc["parent"])]
+            else:
+                remaining.append(qdisc)
+                continue
+            majors[_major(qdisc["handle"])] = top
+            trees[top].append(("qdisc", qdisc))
+        if len(remaining) == len(pending):
+            raise TrafficControlError("Qdiscs without a parent in the "
+                                      "snapshot: {}".format(remaining))
+        pending = remaining
+
+    for cls in snap["classes"]:
+        trees[majors[_major(cls["handle"])]].append(("class", cls))
+    for tc_filter in snap["filters"]:
+        trees[majors[_major(tc_filter["parent"])]].append(("filter",
+                                                           tc_filter))
+    return trees
+
+def _tree_key(tree):
+    return sorted((obj_type, obj["parent"], obj["handle"], obj["info"],
+                   obj["attrs"]) for obj_type, obj in tree)
+
+def _message(msg_type, flags, ifindex, obj, attrs=True):
+    msg = tcmsg_raw()
+    msg['header']['type'] = msg_type
+    msg['header']['flags'] = NLM_F_REQUEST | NLM_F_ACK | flags
+    msg['index'] = ifindex
+    msg['handle'] = obj["handle"]
+    msg['parent'] = obj["parent"]
+    msg['info'] = obj["info"]
+    if attrs:
+        msg.raw_attrs = bytes.fromhex(obj["attrs"])
+    return msg
+
+def _parent_created(obj_type, obj, created, classes):
+    parent = obj["parent"]
+    if obj_type == "qdisc" and _is_top(obj):
+        return True
+    if obj_type == "class" and parent == TC_H_ROOT:
+        # a top level class of its qdisc
+        return _major(obj["handle"]) in created
+    if parent in created:
+        return True
+    # a class of the qdisc created with it, e.g. a queue of mq
+    return parent not in classes and _major(parent) in created
+
+def _create_messages(ifindex, tree):
+    """messages that create the objects of the tree with the parents before
+    their children"""
+    create = NLM_F_CREATE | NLM_F_EXCL
+    msgs = []
+    created = set()
+    classes = set(obj["handle"] for obj_type, obj in tree
+                  if obj_type == "class")
+    pending = [(obj_type, obj) for obj_type, obj in tree
+               if obj_type != "filter"]
+    while pending:
+        remaining = []
+        for obj_type, obj in pending:
+            if _parent_created(obj_type, obj, created, classes):
+                msg_type = RTM_NEWQDISC if obj_type == "qdisc" \
+                           else RTM_NEWTCLASS
+                msgs.append(_message(msg_type, create, ifindex, obj))
+                created.add(obj["handle"])
+            else:
+                remaining.append((obj_type, obj))
+        if len(remaining) == len(pending):
+            raise TrafficControlError("Objects without a parent in the "
+                                      "snapshot: {}".format(remaining))
+        pending = remaining
+
+    for obj_type, obj in tree:
+        if obj_type == "filter":
+            msgs.append(_message(RTM_NEWTFILTER, create, ifindex, obj))
+    return msgs
+
+def restore(call, ifindex, snap):
+    """restores the snapshot on the device
+
+    The root and the ingress (or clsact) qdisc trees that differ from the
+    snapshot are deleted and created again from the snapshot. Returns the
+    number of recreated trees, 0 when the device already matches the
+    snapshot.
+    """
+    if snap.get("version") != SNAPSHOT_VERSION:
+        raise TrafficControlError("Unsupported snapshot version {}"
+                                  .format(snap.get("version")))
+
+    current = _trees(snapshot(call, ifindex))
+    target = _trees(snap)
+
+    msgs = []
+    changed = 0
+    for top in [TC_H_ROOT, TC_H_INGRESS]:
+        if _tree_key(current[top]) == _tree_key(target[top]):
+            continue
+        changed += 1
+
+        for obj_type, obj in current[top]:
+            # deleting the root qdisc reattaches the default one
+            if obj_type == "qdisc" and _is_top(obj):
+                msgs.append(_message(RTM_DELQDISC, 0, ifindex, obj,
+                                     attrs=False))
+        msgs.extend(_create_messages(ifindex, target[top]))
+
+    if msgs:
+        call("nlm_request_batch", None, msgs)
+    return changed
+
+def clear(call, ifindex):
+    """removes the root qdisc and the ingress or clsact qdisc of the device,
+    the default root qdisc is attached instead"""
+    return restore(call, ifindex, {"version": SNAPSHOT_VERSION,
+                                   "qdiscs": [], "classes": [],
+                                   "filters": []})
+
+def clear_filters(call, ifindex):
+    """removes all filters of the device, returns the number of removed
+    filter priorities"""
+    priorities = []
+    for tc_filter in snapshot(call, ifindex)["filters"]:
+        priority = {"parent": tc_filter["parent"], "handle": 0,
+                    "info": tc_filter["info"]}
+        if priority not in priorities:
+            priorities.append(priority)
+
+    if priorities:
+        call("nlm_request_batch", None,
+             [_message(RTM_DELTFILTER, 0, ifindex, priority, attrs=False)
+              for priority in priorities])
+    return len(priorities)
+
+def replace_root_qdisc(call, ifindex, kind):
+    """replaces the root qdisc of the device with a qdisc of the kind with
+    the default options"""
+    root = {"parent": TC_H_ROOT, "handle": 0, "info": 0,
+            "attrs": _encode_attr(TCA_KIND, kind.encode() + b"\0").hex()}
+    call("nlm_request_batch", None,
+         [_message(RTM_NEWQDISC, NLM_F_CREATE | NLM_F_REPLACE, ifindex,
+                   root)])
@@ -115,13 +115,31 @@ def sha256sum(file_path):
     sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
         while True:
-            data = f.read(1024)
+            data = f.read(1024*1024)
             if not data:
                 break
             sha256.update(data)
 
     return sha256.hexdigest()
 
+_sha256sum_cache = {}
+
+def sha256sum_cached(file_path):
+    """sha256sum() computed once per process for each file, recomputed when
+    the modification time or the size of the file changes"""
+    st = os.stat(file_path)
+    key = (st.st_mtime_ns, st.st_size)
+    try:
+        cached_key, digest = _sha256sum_cache[file_path]
+        if cached_key == key:
+            return digest
+    except KeyError:
+        pass
+
+    digest = sha256sum(file_path)
+    _sha256sum_cache[file_path] = (key, digest)
+    return digest
+
 def create_tar_archive(input_path, target_path, compression=False):
     if compression:
         args = "cfj"
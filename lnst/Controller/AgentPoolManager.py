@@ -19,7 +19,10 @@ import errno
 import re
 import socket
 import select
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from lnst.Common.NetUtils import normalize_hwaddr
+from lnst.Common.SecureSocket import SecSocketException
 from lnst.Controller.Common import ControllerError
 from lnst.Controller.Machine import Machine
 from lnst.Controller.AgentMachineParser import AgentMachineParser
@@ -74,11 +77,79 @@ class AgentPoolManager(object):
                 pool[m_id] = Machine(m_id, hostname, self._msg_dispatcher,
                                      ctl_config, libvirt_domain, rpc_port,
                                      m_spec["security"], params)
-                pool[m_id].init_connection()
                 #TODO check if all described devices are available
 
+        self._connect_machines()
+
         logging.info("Finished loading pools.")
 
+    def _connect_machines(self):
+        """connects to all agents of the loaded pools
+
+        The TCP connections and security handshakes run concurrently in a
+        thread pool, the hello requests are done from this thread as soon as
+        the respective handshake finishes. Machines that can't be connected
+        to within the timeout are removed from their pools.
+        """
+        concurrency = self._ctl_config.get_option("environment",
+                                                  "agent_connect_concurrency")
+        timeout = self._ctl_config.get_option("environment",
+                                              "agent_connect_timeout")
+        timeout = timeout if timeout else None
+
+        def open_connection(machine):
+            start = time.perf_counter()
+            connection = machine.open_connection(timeout)
+            return connection, time.perf_counter() - start
+
+        if concurrency <= 0:
+            # no limit, every agent is connected to at the same time
+            concurrency = sum([len(pool) for pool in self._machines.values()])
+
+        start = time.perf_counter()
+        timings = {}
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {}
+            for pool_name, pool in self._machines.items():
+                for m_id, machine in pool.items():
+                    future = executor.submit(open_connection, machine)
+                    futures[future] = (pool_name, m_id, machine)
+
+            for future in as_completed(futures):
+                pool_name, m_id, machine = futures[future]
+                try:
+                    connection, handshake_time = future.result()
+                except (socket.error, SecSocketException) as e:
+                    logging.error("Connection to machine '%s' failed: %s" %
+                                  (m_id, e))
+                    self._remove_machine(pool_name, m_id)
+                    continue
+
+                hello_start = time.perf_counter()
+                machine.post_hello(connection)
+                machine.finish_hello()
+                timings[m_id] = (handshake_time,
+                                 time.perf_counter() - hello_start)
+
+        if len(timings) == 0:
+            return
+
+        max_len = max([len(m_id) for m_id in timings])
+        logging.info("Agent connection times (handshake, hello):")
+        for m_id, (handshake_time, hello_time) in sorted(timings.items()):
+            logging.info("%s%s %8.3fs %8.3fs" % (m_id,
+                                                 (max_len - len(m_id)) * " ",
+                                                 handshake_time, hello_time))
+        logging.info("Connected to %d machines in %.3fs" %
+                     (len(timings), time.perf_counter() - start))
+
+    def _remove_machine(self, pool_name, m_id):
+        del self._machines[pool_name][m_id]
+        del self._pools[pool_name][m_id]
+        if len(self._pools[pool_name]) == 0:
+            del self._machines[pool_name]
+            del self._pools[pool_name]
+
     def get_pools(self):
         return self._pools
 
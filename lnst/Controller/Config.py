@@ -61,6 +61,45 @@ class CtlConfig(Config):
                 "action" : self.optionBool,
                 "name" : "allow_virtual"
                 }
+        # number of agents connected to concurrently when loading pools (0
+        # for no limit) and the time limit of a single agent's connection
+        # and handshake
+        self._options['environment']['agent_connect_concurrency'] = {
+                "value" : 16,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "agent_connect_concurrency"
+                }
+        self._options['environment']['agent_connect_timeout'] = {
+                "value" : 60,
+                "additive" : False,
+                "action" : self.optionTimeval,
+                "name" : "agent_connect_timeout"
+                }
+        # number of machines prepared and cleaned up concurrently when a
+        # recipe run starts and ends, 0 for no limit
+        self._options['environment']['machine_setup_concurrency'] = {
+                "value" : 16,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "machine_setup_concurrency"
+                }
+        # number of network namespaces the agents create in advance, a
+        # new namespace is then only named instead of created on demand
+        self._options['environment']['netns_pool_size'] = {
+                "value" : 2,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "netns_pool_size"
+                }
+        # number of processes the agents fork in advance for shell jobs,
+        # a short job then doesn't wait for a new process
+        self._options['environment']['job_pool_size'] = {
+                "value" : 2,
+                "additive" : False,
+                "action" : self.optionInt,
+                "name" : "job_pool_size"
+                }
 
         self._options['pools'] = dict()
 
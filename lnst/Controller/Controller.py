@@ -11,6 +11,7 @@ olichtne@redhat.com (Ondrej Lichtner)
 import os
 import sys
 from typing import Union
+import time
 import datetime
 import logging
 from lnst.Common.Logs import LoggingCtl, log_exc_traceback
@@ -21,6 +22,7 @@ from lnst.Devices.VirtualDevice import VirtualDevice
 from lnst.Controller.Common import ControllerError
 from lnst.Controller.Config import CtlConfig
 from lnst.Controller.MessageDispatcher import MessageDispatcher
+from lnst.Controller.Machine import run_concurrently
 from lnst.Controller.AgentPoolManager import AgentPoolManager
 from lnst.Controller.ContainerPoolManager import ContainerPoolManager
 from lnst.Controller.MachineMapper import MachineMapper
@@ -187,11 +189,15 @@ class Controller(object):
             machine = self._machines[m_id] = pool[m["target"]]
 
             setattr(self._hosts, m_id, Host(machine))
-            host = getattr(self._hosts, m_id)
 
             machine.set_id(m_id)
             machine.set_mapped(True)
-            self._prepare_machine(machine)
+
+        self._prepare_machines(list(self._machines.values()))
+
+        for m_id, m in list(match["machines"].items()):
+            machine = self._machines[m_id]
+            host = getattr(self._hosts, m_id)
 
             for if_id, i in list(m["interfaces"].items()):
                 host.map_device(if_id, i)
@@ -208,31 +214,61 @@ class Controller(object):
             machine.start_recipe(recipe)
 
     def _prepare_machine(self, machine):
-        self._log_ctl.add_agent(machine.get_id())
-        machine.set_mac_pool(self._mac_pool)
-        machine.set_network_bridges(self._network_bridges)
+        self._prepare_machines([machine])
+
+    def _prepare_machines(self, machines):
+        """prepares the machines concurrently
 
-        machine.prepare_machine()
+        The agents work on the preparation in parallel, at most
+        machine_setup_concurrency machines are prepared at the same time.
+        """
+        for machine in machines:
+            self._log_ctl.add_agent(machine.get_id())
+            machine.set_mac_pool(self._mac_pool)
+            machine.set_network_bridges(self._network_bridges)
+
+        start = time.perf_counter()
+        run_concurrently([machine.prepare_machine_steps()
+                          for machine in machines],
+                         self._config.get_option("environment",
+                                                 "machine_setup_concurrency"))
+        logging.debug("Prepared %d machines in %.3fs" %
+                      (len(machines), time.perf_counter() - start))
+
+    def _cleanup_steps(self, machine):
+        try:
+            yield from machine.cleanup_steps()
+        except:
+            #TODO report errors during deconfiguration as FAIL!!
+            logging.error("Cleanup of machine %s failed" % machine.get_id())
+            log_exc_traceback()
 
     def _cleanup_agents(self):
         if self._machines == None:
             return
 
+        start = time.perf_counter()
+        try:
+            run_concurrently([self._cleanup_steps(machine)
+                              for machine in self._machines.values()],
+                             self._config.get_option(
+                                 "environment", "machine_setup_concurrency"))
+        except:
+            # e.g. an agent disconnected while the others were cleaned up
+            log_exc_traceback()
+        logging.debug("Cleaned up %d machines in %.3fs" %
+                      (len(self._machines), time.perf_counter() - start))
+        self._log_phase_times()
+
         for m_id, machine in list(self._machines.items()):
-            try:
-                machine.cleanup()
-            except:
-                #TODO report errors during deconfiguration as FAIL!!
-                log_exc_traceback()
-            finally:
-                machine.stop_recipe()
-                for dev in list(machine._device_database.values()):
-                    if isinstance(dev, VirtualDevice):
-                        dev._destroy()
+            machine.stop_recipe()
+            for dev in list(machine._device_database.values()):
+                if isinstance(dev, VirtualDevice):
+                    dev._destroy()
 
-                #clean-up agent logger
-                self._log_ctl.remove_agent(m_id)
-                machine.set_mapped(False)
+            #clean-up agent logger
+            self._log_ctl.remove_agent(m_id)
+            machine.set_mapped(False)
 
         self._machines.clear()
 
@@ -244,6 +280,34 @@ class Controller(object):
         if isinstance(self._pools, ContainerPoolManager):
             self._pools.cleanup()
 
+    def _log_phase_times(self):
+        times = [(m_id, machine.get_phase_times())
+                 for m_id, machine in sorted(self._machines.items())]
+        phases = []
+        for m_id, phase_times in times:
+            # keeps the order of the phases when a machine skipped some
+            position = 0
+            for phase in phase_times:
+                if phase in phases:
+                    position = phases.index(phase) + 1
+                else:
+                    phases.insert(position, phase)
+                    position += 1
+        if len(phases) == 0:
+            return
+
+        max_len = max([len(m_id) for m_id, _ in times])
+        logging.info("Machine preparation and cleanup times:")
+        logging.info("%s %s" % (max_len * " ",
+                                " ".join(["%18s" % phase
+                                          for phase in phases])))
+        for m_id, phase_times in times:
+            logging.info("%s%s %s" % (m_id, (max_len - len(m_id)) * " ",
+                                      " ".join(["%17.3fs" % phase_times[phase]
+                                                if phase in phase_times
+                                                else "%18s" % "-"
+                                                for phase in phases])))
+
     def _load_ctl_config(self, config):
         if isinstance(config, CtlConfig):
             return config
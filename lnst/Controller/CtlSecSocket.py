@@ -17,6 +17,11 @@ import logging
 from lnst.Common.SecureSocket import SecureSocket
 from lnst.Common.SecureSocket import DH_GROUP, SRP_GROUP
 from lnst.Common.SecureSocket import SecSocketException
+from lnst.Common.SecureSocket import SUPPORTED_FRAMINGS, FRAMING_ASCII
+from lnst.Common.SecureSocket import SUPPORTED_CIPHER_SUITES
+from lnst.Common.SecureSocket import CIPHER_SUITE_CBC_HMAC_SHA256
+from lnst.Common.ConnectionHandler import SUPPORTED_SERIALIZERS
+from lnst.Common.ConnectionHandler import PickleSerializer
 from lnst.Common.Utils import not_imported
 
 ser = not_imported
@@ -24,7 +29,7 @@ load_pem_private_key = not_imported
 load_pem_public_key = not_imported
 load_ssh_public_key = not_imported
 backend = not_imported
-cryptography_imported = not_imported
+cryptography_imported = False
 def cryptography_imports():
     global cryptography_imported
     if cryptography_imported:
@@ -59,7 +64,10 @@ class CtlSecSocket(SecureSocket):
         self._ctl_random = os.urandom(28)
 
         ctl_hello = {"type": "ctl_hello",
-                     "ctl_random": self._ctl_random}
+                     "ctl_random": self._ctl_random,
+                     "framings": SUPPORTED_FRAMINGS,
+                     "cipher_suites": SUPPORTED_CIPHER_SUITES,
+                     "serializers": SUPPORTED_SERIALIZERS}
         self.send_msg(ctl_hello)
         agent_hello = self.recv_msg()
 
@@ -67,6 +75,12 @@ class CtlSecSocket(SecureSocket):
             raise SecSocketException("Handshake failed.")
 
         self._agent_random = agent_hello["agent_random"]
+        # agents not aware of framing negotiation don't send a reply to it
+        self.set_framing(agent_hello.get("framing", FRAMING_ASCII))
+        self.set_cipher_suite(agent_hello.get("cipher_suite",
+                                              CIPHER_SUITE_CBC_HMAC_SHA256))
+        self.set_serializer(agent_hello.get("serializer",
+                                            PickleSerializer.name))
 
         if sec_params["auth_type"] == "none":
             logging.warning("===================================")
@@ -11,15 +11,28 @@ __author__ = """
 rpazdera@redhat.com (Radek Pazdera)
 """
 
+import os
+import time
 import logging
 import socket
 import sys
 import signal
-from lnst.Common.Utils import sha256sum
+import copy
+import tarfile
+from tempfile import NamedTemporaryFile
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from lnst.Common.Utils import sha256sum_cached
 from lnst.Common.Utils import check_process_running
 from lnst.Common.Version import lnst_version
+from lnst.Common.Logs import log_exc_traceback
+from lnst.Common.FileTransfer import FILE_STREAM_CHUNK_SIZE
+from lnst.Common.FileTransfer import FILE_STREAM_WINDOW
+from lnst.Common.FileTransfer import available_compressions
+from lnst.Common.FileTransfer import compress, decompress, StreamDigest
 from lnst.Controller.Common import ControllerError
 from lnst.Controller.CtlSecSocket import CtlSecSocket
+from lnst.Controller.MessageDispatcher import wait_all, ConnectionError
 from lnst.Controller.RecipeResults import JobStartResult, JobFinishResult, DeviceCreateResult, DeviceMethodCallResult, DeviceAttrSetResult
 from lnst.Controller.AgentProxyObject import AgentProxyObject
 from lnst.Devices import device_classes
@@ -37,6 +50,63 @@ class MachineError(ControllerError):
 class PrefixMissingError(ControllerError):
     pass
 
+class BatchedCall(object):
+    """ A device operation queued by Machine.batch
+
+        result() sends the queued operations to the agent if this one
+        wasn't executed yet.
+    """
+    def __init__(self, machine, op, index, name, args, kwargs, netns):
+        self._machine = machine
+        self.op = op
+        self.index = index
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.netns = netns
+        self._reply = None
+
+    def done(self):
+        return self._reply is not None
+
+    def result(self):
+        if self._reply is None and self._machine._batch:
+            self._machine._flush_batch()
+
+        if self._reply is None:
+            raise MachineError("Batched operation wasn't executed.")
+
+        reply_type, value = self._reply
+        if reply_type == "exception":
+            raise value
+        if self.op == "setattr":
+            return None
+        return value
+
+    def _set_reply(self, reply_type, value):
+        self._reply = (reply_type, value)
+
+    def _recipe_result(self):
+        reply_type, value = self._reply
+        success = reply_type == "result"
+        device = self._machine._get_device_from_database(self.index,
+                                                         self.netns)
+        if self.op == "setattr":
+            return DeviceAttrSetResult(
+                success=success,
+                device=device,
+                attr_name=self.name,
+                value=self.args[0],
+                old_value=value if success else None,
+            )
+        return DeviceMethodCallResult(
+            success=success,
+            device=device,
+            method_name=self.name,
+            args=self.args,
+            kwargs=self.kwargs,
+        )
+
 class Machine(object):
     """ Agent machine abstraction
 
@@ -52,6 +122,13 @@ class Machine(object):
         self._mapped = False
         self._ctl_config = ctl_config
         self._agent_desc = None
+        self._hello = None
+        self._batch = None
+        # cached device attributes by (netns, ifindex), only used when
+        # enabled by enable_device_cache
+        self._device_cache = None
+        # wall clock times of the preparation and cleanup phases
+        self._phase_times = OrderedDict()
         self._connection = None
         self._system_config = {}
         self._security = security
@@ -130,18 +207,41 @@ class Machine(object):
         self._add_device_to_database(ret["ifindex"], dev, netns)
 
     def remote_device_set_netns(self, dev, dst, src):
-        self._add_device_to_netns_moved_devices(dev, dst, src)
-        self.rpc_call("set_dev_netns", dev, dst.name, netns=src)
-        dev_clsname = dev._dev_cls.__name__
-        dev_args = dev._dev_args
-        dev_kwargs = dev._dev_kwargs
+        self.remote_devices_set_netns([dev], dst, src)
+
+    def remote_devices_set_netns(self, devs, dst, src):
+        """moves the devices from the src to the dst namespace
 
-        self.rpc_call("remap_device",
-                dev.ifindex,
-                clsname=dev_clsname,
-                args=dev_args,
-                kwargs=dev_kwargs,
-                netns=dst)
+        All the devices are moved by one call in src and mapped to their
+        classes by one call in dst, regardless of their number.
+        """
+        # the attributes of the devices are read before the move in one
+        # call, they're read only until the devices appear in dst
+        uncached = [dev for dev in devs if not dev._cached]
+        if uncached:
+            snapshot = self.device_snapshot(uncached, expensive=True)
+            for dev in uncached:
+                dev._set_readonly_cache(snapshot[dev]["attrs"])
+
+        for dev in devs:
+            self._add_device_to_netns_moved_devices(dev, dst, src)
+        self.rpc_call("set_devs_netns", devs, dst.name, netns=src)
+
+        # the dev_netns_changed messages of the devices arrive before the
+        # result of set_devs_netns, the devices already announced by dst
+        # have their new ifindex set
+        remaps = []
+        for dev in devs:
+            moved = self._netns_moved_devices.get(dev)
+            if moved is not None and moved["new_ifindex"] is not None:
+                ifindex = moved["new_ifindex"]
+            else:
+                ifindex = dev.ifindex
+            remaps.append((ifindex,
+                           dev._dev_cls.__name__,
+                           dev._dev_args,
+                           dev._dev_kwargs))
+        self.rpc_call("remap_devices", remaps, netns=dst)
 
     def _add_device_to_netns_moved_devices(self, dev, dst, src):
         del self._device_database[src][dev.ifindex]
@@ -154,6 +254,11 @@ class Machine(object):
         }
 
     def remote_device_method(self, index, method_name, args, kwargs, netns):
+        self._invalidate_device_cache(index, netns)
+        if self._batch is not None:
+            return self._queue_batched_call("method", index, method_name,
+                                            args, kwargs, netns)
+
         config_res = DeviceMethodCallResult(
             success=True,
             device=self._get_device_from_database(index, netns),
@@ -173,6 +278,11 @@ class Machine(object):
         return res
 
     def remote_device_setattr(self, index, attr_name, value, netns):
+        if self._batch is not None:
+            self._invalidate_device_cache(index, netns)
+            return self._queue_batched_call("setattr", index, attr_name,
+                                            (value,), {}, netns)
+
         config_res = DeviceAttrSetResult(
             success=True,
             device=self._get_device_from_database(index, netns),
@@ -184,6 +294,7 @@ class Machine(object):
             ),
         )
         self._add_recipe_result(config_res)
+        self._invalidate_device_cache(index, netns)
 
         try:
             res = self.rpc_call("dev_setattr", index, attr_name, value, netns=netns)
@@ -192,9 +303,147 @@ class Machine(object):
             raise
         return res
 
+    @contextmanager
+    def batch(self):
+        """Batches device method calls and attribute sets
+
+        Inside the context device method calls and attribute sets on this
+        machine are queued and sent to the agent in a single exec_batch call
+        when the context exits. Queued calls return BatchedCall objects
+        instead of the result. Any other remote call, including reading a
+        device attribute, sends the queued operations first so they are
+        always executed in order.
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+
+        self._batch = []
+        try:
+            yield self._batch
+        except Exception:
+            # the operations queued before the error are still executed
+            # like unbatched calls would have been, the error of the body
+            # is raised even if one of them fails
+            try:
+                self._flush_batch()
+            except Exception:
+                logging.error("Batched operations failed after an error "
+                              "inside the batch context")
+                log_exc_traceback()
+            raise
+        else:
+            self._flush_batch()
+        finally:
+            self._batch = None
+
+    def _queue_batched_call(self, op, index, name, args, kwargs, netns):
+        call = BatchedCall(self, op, index, name, args, kwargs, netns)
+        self._batch.append(call)
+        return call
+
+    def _flush_batch(self):
+        """sends the queued operations, one exec_batch call per consecutive
+        group of the same namespace
+
+        Like the agent stops a batch at its first failing operation, the
+        groups after a failed one aren't sent. All of the queued calls get
+        a reply, the ones not executed fail with a MachineError, then the
+        first error is raised.
+        """
+        queued = [call for call in self._batch if not call.done()]
+        del self._batch[:]
+
+        error = None
+        while queued:
+            netns = queued[0].netns
+            group = []
+            while queued and queued[0].netns is netns:
+                group.append(queued.pop(0))
+
+            replies = []
+            if error is None:
+                operations = [(call.op, call.index, call.name, call.args,
+                               call.kwargs) for call in group]
+                try:
+                    replies = self.rpc_call("exec_batch", operations,
+                                            netns=netns)
+                except Exception as e:
+                    error = e
+
+            for call, (reply_type, value) in zip(group, replies):
+                call._set_reply(reply_type, value)
+                self._add_recipe_result(call._recipe_result())
+                if reply_type == "exception" and error is None:
+                    error = value
+
+            for call in group[len(replies):]:
+                call._set_reply("exception", MachineError(
+                    "Batched operation %s of device %d wasn't executed, a "
+                    "previous operation failed: %s" % (call.name, call.index,
+                                                       error)))
+
+        if error is not None:
+            raise error
+
     def remote_device_getattr(self, index, attr_name, netns):
         return self.rpc_call("dev_getattr", index, attr_name, netns=netns)
 
+    def remote_device_getattr_cached(self, index, attr_name, netns):
+        if self._device_cache is None:
+            return self.remote_device_getattr(index, attr_name, netns)
+
+        # state and ips change without a Controller call, e.g. by linkwatch
+        # or DAD, the notifications that already arrived are applied first
+        self._msg_dispatcher.process_pending_messages()
+
+        key = (netns if netns is not None else self._initns, index)
+        attrs = self._device_cache.setdefault(key, {})
+        if attr_name not in attrs:
+            # a dev_updated message received while waiting for the reply
+            # removes attrs from the cache, the value is still returned
+            attrs[attr_name] = self.remote_device_getattr(index, attr_name,
+                                                          netns)
+        value = attrs[attr_name]
+        if isinstance(value, (list, dict)):
+            return copy.copy(value)
+        return value
+
+    def enable_device_cache(self):
+        """Caches the device attributes derived from netlink
+
+        The Agent then sends a dev_updated message whenever a netlink message
+        changes a device, which drops the cached attributes of the device,
+        repeated reads of e.g. the name, hwaddr, mtu or ips of unchanged
+        devices don't need a round trip to the Agent.
+        """
+        if self._device_cache is not None:
+            return
+        futures = [self.rpc_call_async("set_device_update_events", True,
+                                       netns=netns)
+                   for netns in [None] + list(self._namespaces.values())]
+        wait_all(futures)
+        self._device_cache = {}
+
+    def disable_device_cache(self):
+        if self._device_cache is None:
+            return
+        self._device_cache = None
+        futures = [self.rpc_call_async("set_device_update_events", False,
+                                       netns=netns)
+                   for netns in [None] + list(self._namespaces.values())]
+        wait_all(futures)
+
+    def _invalidate_device_cache(self, index, netns):
+        if self._device_cache is not None:
+            self._device_cache.pop(
+                (netns if netns is not None else self._initns, index), None)
+
+    def device_updated(self, update_data, netns=None):
+        ns_instance = self._get_netns_by_name(netns)
+        for ifindex in update_data["ifindexes"]:
+            self._invalidate_device_cache(ifindex, ns_instance)
+
     def device_created(self, dev_data, netns=None):
         ns_instance = self._get_netns_by_name(netns)
         ifindex = dev_data["ifindex"]
@@ -228,6 +477,7 @@ class Machine(object):
                 if netns_moved:
                     del self._netns_moved_devices[new_dev]
                     new_dev.disable_readonly_cache()
+                    new_dev.ifindex = ifindex
                 else:
                     self._tmp_device_database.remove(new_dev)
                     new_dev.ifindex = dev_data["ifindex"]
@@ -238,6 +488,7 @@ class Machine(object):
         ns_instance = self._get_netns_by_name(netns)
         dev_index = dev_data["ifindex"]
 
+        self._invalidate_device_cache(dev_index, ns_instance)
         if dev_index in self._device_database[ns_instance].keys():
             dev = self._device_database[ns_instance][dev_index]
             dev.deleted = True
@@ -261,6 +512,7 @@ class Machine(object):
                 )
             )
 
+        self._invalidate_device_cache(dev_index, ns_instance)
         self._netns_moved_devices[dev_match[0]]["new_ifindex"] = dev_new_index
         if dev_index in self._device_database[ns_instance].keys():
             del self._device_database[ns_instance][dev_index]
@@ -294,6 +546,21 @@ class Machine(object):
         return None
 
     def rpc_call(self, method_name, *args, **kwargs):
+        return self.rpc_call_async(method_name, *args, **kwargs).result()
+
+    def rpc_call_async(self, method_name, *args, **kwargs):
+        """Sends the call to the agent without waiting for its result
+
+        Returns an RpcFuture, see rpc_fan_out and wait_all from
+        lnst.Controller.MessageDispatcher for calls to multiple agents.
+        """
+        if self._batch:
+            self._flush_batch()
+
+        msg = self._build_command(method_name, *args, **kwargs)
+        return self._msg_dispatcher.post_message(self, msg)
+
+    def _build_command(self, method_name, *args, **kwargs):
         if kwargs.get("netns") in self._namespaces.values():
             netns = kwargs["netns"]
             del kwargs["netns"]
@@ -310,8 +577,23 @@ class Machine(object):
                    "method_name": method_name,
                    "args": args,
                    "kwargs": kwargs}
+        return msg
 
-        return self._msg_dispatcher.send_message(self, msg)
+    def _rpc_call_pipelined(self, calls, window=FILE_STREAM_WINDOW):
+        """calls remote methods keeping up to window calls in flight
+
+        calls is an iterable of (method_name, args, kwargs) tuples, the
+        results are yielded in the same order.
+        """
+        in_flight = deque()
+        for method_name, args, kwargs in calls:
+            in_flight.append(self.rpc_call_async(method_name, *args,
+                                                 **kwargs))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
 
     def init_connection(self, timeout=None):
         """ Initialize the agent connection
@@ -319,18 +601,44 @@ class Machine(object):
         This will connect to the Agent, get it's description (should be
         usable for matching), and checks version compatibility
         """
+        connection = self.open_connection(timeout)
+        self.post_hello(connection)
+        self.finish_hello()
+
+    def open_connection(self, timeout=None):
+        """ Connects to the Agent and performs the security handshake
+
+        Doesn't touch the message dispatcher so connections to multiple
+        Agents can be opened from concurrent threads. The timeout limits
+        both the TCP connection and the handshake.
+        """
         hostname = self._hostname
         port = self._port
         m_id = self._id
 
         logging.info("Connecting to RPC on machine %s (%s)", m_id, hostname)
-        connection = CtlSecSocket(socket.create_connection((hostname, port),
-                                                           timeout))
-        connection.handshake(self._security)
+        sock = socket.create_connection((hostname, port), timeout)
+        # pipelined calls send several small messages in a row
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            connection = CtlSecSocket(sock)
+            connection.handshake(self._security)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return connection
 
+    def post_hello(self, connection):
+        """ Registers an opened connection and sends the hello request """
         self._msg_dispatcher.add_agent(self, connection)
+        self._hello = self.rpc_call_async("hello")
 
-        hello, agent_desc = self.rpc_call("hello")
+    def finish_hello(self):
+        """ Waits for the hello reply and checks version compatibility """
+        hostname = self._hostname
+        hello, agent_desc = self._hello.result()
+        self._hello = None
         if hello != "hello":
             msg = "Unable to establish RPC connection " \
                   "to machine %s, handshake failed!" % hostname
@@ -355,14 +663,54 @@ class Machine(object):
         self._agent_desc = agent_desc
 
     def prepare_machine(self):
-        self.rpc_call("prepare_machine")
+        run_steps(self.prepare_machine_steps())
+
+    def prepare_machine_steps(self):
+        """prepare_machine() as a generator of RPC steps, see run_concurrently"""
+        self._phase_times = OrderedDict()
+        with self._timed_phase("prepare"):
+            yield [self.rpc_call_async("prepare_machine")]
         self._device_database = {self._initns: {}}
-        self._send_device_classes()
-        self.rpc_call("init_if_manager")
+        self._device_cache = None
+
+        with self._timed_phase("classes"):
+            yield from self._send_device_classes_steps()
+
+        with self._timed_phase("devices"):
+            yield [self.rpc_call_async("init_if_manager")]
+            devices, = yield [self.rpc_call_async("get_devices")]
+            for ifindex, dev in list(devices.items()):
+                self.device_created(dev)
+
+        # the job pool size is set first, the pre-forked network namespaces
+        # inherit it
+        pool_calls = []
+        job_pool_size = self._ctl_config.get_option("environment",
+                                                    "job_pool_size")
+        if job_pool_size:
+            pool_calls.append(self.rpc_call_async("set_job_pool_size",
+                                                  job_pool_size))
+        netns_pool_size = self._ctl_config.get_option("environment",
+                                                      "netns_pool_size")
+        if netns_pool_size:
+            pool_calls.append(self.rpc_call_async("set_netns_pool_size",
+                                                  netns_pool_size))
+        if pool_calls:
+            yield pool_calls
+
+    @contextmanager
+    def _timed_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._phase_times[name] = (self._phase_times.get(name, 0) +
+                                       time.perf_counter() - start)
 
-        devices = self.rpc_call("get_devices")
-        for ifindex, dev in list(devices.items()):
-            self.device_created(dev)
+    def get_phase_times(self):
+        """Wall clock times of the phases of the last preparation and cleanup
+        of the machine as an ordered dictionary of phase name to seconds"""
+        return OrderedDict(self._phase_times)
 
     def start_recipe(self, recipe):
         self._recipe = recipe
@@ -376,32 +724,82 @@ class Machine(object):
         if self._recipe:
             self._recipe.current_run.add_result(result)
 
-    def _send_device_classes(self):
-        for cls_name, cls in device_classes:
-            self.send_class(cls)
+    def _send_device_classes_steps(self):
+        yield from self._send_classes_steps(
+            [cls for cls_name, cls in device_classes])
 
-        for cls_name, cls in device_classes:
-            module_name = cls.__module__
-            self.rpc_call("map_device_class", cls_name, module_name)
+        yield [self.rpc_call_async("map_device_classes",
+                                   [(cls_name, cls.__module__)
+                                    for cls_name, cls in device_classes])]
 
     def send_class(self, cls, netns=None):
-        classes = [cls]
-        classes.extend(self._get_base_classes(cls))
+        self.send_classes([cls], netns)
 
-        for cls in reversed(classes):
-            module_name = cls.__module__
+    def send_classes(self, classes, netns=None):
+        """Loads the modules of the classes and their base classes on the agent
 
-            if module_name == "builtins":
-                continue
+        The module files are hashed once per Controller process, the Agent
+        reports which of them are missing from its resource cache and these
+        are sent as a single compressed archive. The modules are then loaded
+        in one call, base class modules first.
+        """
+        run_steps(self._send_classes_steps(classes, netns))
+
+    def _send_classes_steps(self, classes, netns=None):
+        modules = OrderedDict()
+        for cls in classes:
+            for base in reversed(self._get_base_classes(cls)):
+                module_name = base.__module__
+
+                if module_name == "builtins" or module_name in modules:
+                    continue
 
-            module = sys.modules[module_name]
-            filename = module.__file__
+                filename = sys.modules[module_name].__file__
+                if filename[-3:] == "pyc":
+                    filename = filename[:-1]
 
-            if filename[-3:] == "pyc":
-                filename = filename[:-1]
+                modules[module_name] = (filename, sha256sum_cached(filename))
 
-            res_hash = self.sync_resource(module_name, filename, netns=netns)
-            self.rpc_call("load_cached_module", module_name, res_hash, netns=netns)
+        yield from self._sync_module_resources_steps(modules, netns)
+        yield [self.rpc_call_async(
+            "load_cached_modules",
+            [(module_name, res_hash)
+             for module_name, (_, res_hash) in modules.items()],
+            netns=netns)]
+
+    def sync_module_resources(self, modules, netns=None):
+        """Adds the module files missing from the Agent resource cache
+
+        modules is a dictionary of module name to a (file path, sha256
+        digest) tuple.
+        """
+        run_steps(self._sync_module_resources_steps(modules, netns))
+
+    def _sync_module_resources_steps(self, modules, netns=None):
+        missing, = yield [self.rpc_call_async(
+            "missing_resources",
+            [res_hash for _, res_hash in modules.values()],
+            netns=netns)]
+        if not missing:
+            return
+
+        entries = {}
+        with NamedTemporaryFile(suffix=".tar.gz") as archive_file:
+            with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+                for module_name, (filename, res_hash) in modules.items():
+                    if res_hash in missing and res_hash not in entries:
+                        archive.add(filename, arcname=res_hash)
+                        entries[res_hash] = module_name
+            archive_file.flush()
+
+            logging.debug("Transfering %d modules to machine %s" %
+                          (len(entries), self.get_id()))
+            # the archive is only sent to agents with an empty or outdated
+            # cache
+            remote_path = yield from self._copy_file_to_machine_steps(
+                archive_file.name, netns=netns)
+        yield [self.rpc_call_async("add_resource_archive", remote_path,
+                                   entries, netns=netns)]
 
     def is_git_version(self, version):
         try:
@@ -411,15 +809,24 @@ class Machine(object):
             return True
 
     def cleanup_devices(self):
-        for netns in self._namespaces.values():
-            self._set_readonly_cache_for_all_devices(netns)
-
-        self._set_readonly_cache_for_all_devices(self._initns)
-
-        for netns in self._namespaces.values():
-            self.rpc_call("destroy_devices", netns=netns)
-
-        self.rpc_call("destroy_devices")
+        run_steps(self._cleanup_devices_steps())
+
+    def _cleanup_devices_steps(self):
+        devices = [dev
+                   for netns in list(self._namespaces.values()) + [self._initns]
+                   for dev in self._device_database[netns].values()
+                   if not dev._cached]
+        if devices:
+            # like the attributes read one by one before, the read only
+            # cache includes the ones read by running external commands
+            snapshots = yield from self._device_snapshot_steps(
+                devices, expensive=True)
+            for dev, snapshot in snapshots.items():
+                dev._set_readonly_cache(snapshot["attrs"])
+
+        yield [self.rpc_call_async("destroy_devices", netns=netns)
+               for netns in self._namespaces.values()]
+        yield [self.rpc_call_async("destroy_devices")]
 
     def _set_readonly_cache_for_device(self, ifindex, netns):
         try:
@@ -433,9 +840,48 @@ class Machine(object):
 
         dev.enable_readonly_cache()
 
-    def _set_readonly_cache_for_all_devices(self, netns):
-        for dev in self._device_database[netns].values():
-            dev.enable_readonly_cache()
+    def device_snapshot(self, devices, expensive=False):
+        """Reads all attributes of the devices in one call per namespace
+
+        Returns a dictionary of device to {"attrs": {name: value},
+        "costs": {name: seconds}}, the costs are the times the Agent spent
+        reading each attribute. Attributes read by running external commands
+        are only included if expensive is True.
+        """
+        return run_steps(self._device_snapshot_steps(devices, expensive))
+
+    def _device_snapshot_steps(self, devices, expensive=False):
+        groups = {}
+        for dev in devices:
+            groups.setdefault(dev.netns, []).append(dev)
+
+        futures = []
+        for netns, devs in groups.items():
+            skip = set()
+            for dev in devs:
+                skip.update(dev._local_attrs())
+            futures.append(self.rpc_call_async(
+                "dev_snapshot", [dev.ifindex for dev in devs], expensive,
+                sorted(skip), netns=netns))
+
+        results = yield futures
+        snapshots = {}
+        for devs, result in zip(groups.values(), results):
+            for dev in devs:
+                snapshots[dev] = result[dev.ifindex]
+
+        costs = sorted([(cost, name, dev)
+                        for dev, snapshot in snapshots.items()
+                        for name, cost in snapshot["costs"].items()],
+                       key=lambda x: x[0], reverse=True)
+        logging.debug("Snapshot of {} devices took {:.3f}s on the agent, "
+                      "slowest attributes: {}".format(
+                          len(snapshots), sum([x[0] for x in costs]),
+                          ", ".join(["{}.{} {:.3f}s".format(dev._id or
+                                                            dev.ifindex,
+                                                            name, cost)
+                                     for cost, name, dev in costs[:5]])))
+        return snapshots
 
     def cleanup(self):
         """ Clean the machine up
@@ -445,24 +891,32 @@ class Machine(object):
             all the interfaces that have been configured on the machine,
             and finalize and close the rpc connection to the machine.
         """
+        run_steps(self.cleanup_steps())
+
+    def cleanup_steps(self):
+        """cleanup() as a generator of RPC steps, see run_concurrently"""
         # connection to the agent was closed
         if not self._msg_dispatcher.get_connection(self):
             return
 
         try:
-            for netns in self._namespaces.values():
-                self.rpc_call("kill_jobs", netns=netns)
-            self.rpc_call("kill_jobs")
-
-            self.restore_system_config()
-            self.cleanup_devices()
-            self.del_namespaces()
-            self.rpc_call("bye")
+            with self._timed_phase("kill jobs"):
+                yield [self.rpc_call_async("kill_jobs", netns=netns)
+                       for netns in self._namespaces.values()] + \
+                      [self.rpc_call_async("kill_jobs")]
+
+            with self._timed_phase("restore config"):
+                yield from self._restore_system_config_steps()
+            with self._timed_phase("devices cleanup"):
+                yield from self._cleanup_devices_steps()
+            with self._timed_phase("namespaces cleanup"):
+                yield from self._del_namespaces_steps()
+            yield [self.rpc_call_async("bye")]
         except:
             # cleanup is only meaningful on dynamic interfaces, and should
             # always be called when deconfiguration happens- especially
             # when something on the agent breaks during deconfiguration
-            self.cleanup_devices()
+            yield from self._cleanup_devices_steps()
             raise
 
     def _get_base_classes(self, cls):
@@ -565,11 +1019,14 @@ class Machine(object):
         self._mac_pool = mac_pool
 
     def restore_system_config(self):
-        self.rpc_call("restore_system_config")
-        for netns in self._namespaces.values():
-            self.rpc_call("restore_system_config", netns=netns)
+        run_steps(self._restore_system_config_steps())
         return True
 
+    def _restore_system_config_steps(self):
+        yield [self.rpc_call_async("restore_system_config")] + \
+              [self.rpc_call_async("restore_system_config", netns=netns)
+               for netns in self._namespaces.values()]
+
     def set_network_bridges(self, bridges):
         self._network_bridges = bridges
 
@@ -603,7 +1060,105 @@ class Machine(object):
         for netns in namespaces:
             self.rpc_call("stop_packet_capture", netns=netns)
 
-    def copy_file_to_machine(self, local_path, remote_path=None, netns=None):
+    def copy_file_to_machine(self, local_path, remote_path=None, netns=None,
+                             compression=None, resume=False):
+        """copies a local file to the agent
+
+        Agents supporting it receive the file through a pipelined stream of
+        chunks, optionally compressed, continued from the size of an already
+        existing remote file if resume is True and verified by its sha256
+        digest. Older agents fall back to one synchronous call per chunk.
+        """
+        if not self._supports_file_stream(compression):
+            return self._copy_file_to_machine_legacy(local_path, remote_path,
+                                                     netns)
+
+        remote_path, offset = self.rpc_call("start_stream_to", remote_path,
+                                            resume, netns=netns)
+        size = os.path.getsize(local_path)
+        if offset > size:
+            offset = 0
+
+        digest = StreamDigest(local_path)
+        try:
+            with open(local_path, "rb") as f:
+                def parts():
+                    part_offset = offset
+                    while True:
+                        data = os.pread(f.fileno(), FILE_STREAM_CHUNK_SIZE,
+                                        part_offset)
+                        if not data:
+                            break
+                        digest.update(part_offset, data)
+                        yield ("stream_part_to",
+                               (remote_path, part_offset,
+                                compress(compression, data), compression),
+                               {"netns": netns})
+                        part_offset += len(data)
+
+                for _ in self._rpc_call_pipelined(parts()):
+                    pass
+
+            self.rpc_call("finish_stream_to", remote_path, size,
+                          digest.hexdigest(size), netns=netns)
+        except Exception:
+            self._abort_stream(remote_path, netns)
+            raise
+
+        return remote_path
+
+    def _copy_file_to_machine_steps(self, local_path, remote_path=None,
+                                    netns=None):
+        """copy_file_to_machine as steps for run_concurrently, the chunks
+        are sent in windows of FILE_STREAM_WINDOW calls and the other
+        machines' steps run while this one waits for the replies"""
+        streamed = self._supports_file_stream(None)
+        if streamed:
+            (remote_path, offset), = yield [self.rpc_call_async(
+                "start_stream_to", remote_path, False, netns=netns)]
+        else:
+            remote_path, = yield [self.rpc_call_async(
+                "start_copy_to", remote_path, netns=netns)]
+
+        size = os.path.getsize(local_path)
+        digest = StreamDigest(local_path)
+        try:
+            with open(local_path, "rb") as f:
+                part_offset = 0
+                while part_offset < size:
+                    window = []
+                    while (len(window) < FILE_STREAM_WINDOW and
+                           part_offset < size):
+                        data = os.pread(f.fileno(), FILE_STREAM_CHUNK_SIZE,
+                                        part_offset)
+                        if streamed:
+                            digest.update(part_offset, data)
+                            window.append(self.rpc_call_async(
+                                "stream_part_to", remote_path, part_offset,
+                                data, None, netns=netns))
+                        else:
+                            window.append(self.rpc_call_async(
+                                "copy_part_to", remote_path, data,
+                                netns=netns))
+                        part_offset += len(data)
+                    yield window
+
+            if streamed:
+                yield [self.rpc_call_async("finish_stream_to", remote_path,
+                                           size, digest.hexdigest(size),
+                                           netns=netns)]
+        except Exception:
+            if streamed:
+                self._abort_stream(remote_path, netns)
+            raise
+
+        if not streamed:
+            yield [self.rpc_call_async("finish_copy_to", remote_path,
+                                       netns=netns)]
+        return remote_path
+
+    def _copy_file_to_machine_legacy(self, local_path, remote_path=None,
+                                     netns=None):
         remote_path = self.rpc_call("start_copy_to", remote_path, netns=netns)
 
         f = open(local_path, "rb")
@@ -619,8 +1174,59 @@ class Machine(object):
 
         return remote_path
 
-    def copy_file_from_machine(self, remote_path, local_path):
-        status = self.rpc_call("start_copy_from", remote_path)
+    def copy_file_from_machine(self, remote_path, local_path, netns=None,
+                               compression=None, resume=False):
+        """copies a file from the agent to a local file
+
+        With resume set to True an existing local file is extended from its
+        current size instead of being overwritten, see copy_file_to_machine.
+        """
+        if not self._supports_file_stream(compression):
+            return self._copy_file_from_machine_legacy(remote_path,
+                                                       local_path, netns)
+
+        size = self.rpc_call("start_stream_from", remote_path, netns=netns)
+        if size is None:
+            raise MachineError("The requested file cannot be transfered." \
+                       "It does not exist on machine %s" % self.get_id())
+
+        offset = 0
+        if resume and os.path.exists(local_path):
+            offset = min(os.path.getsize(local_path), size)
+            local_file = open(local_path, "r+b")
+        else:
+            local_file = open(local_path, "w+b")
+
+        local_digest = StreamDigest(local_path)
+        try:
+            with local_file:
+                parts = (("stream_part_from",
+                          (remote_path, part_offset, FILE_STREAM_CHUNK_SIZE,
+                           compression),
+                          {"netns": netns})
+                         for part_offset in range(offset, size,
+                                                  FILE_STREAM_CHUNK_SIZE))
+
+                part_offset = offset
+                for data in self._rpc_call_pipelined(parts):
+                    data = decompress(compression, data)
+                    os.pwrite(local_file.fileno(), data, part_offset)
+                    local_digest.update(part_offset, data)
+                    part_offset += len(data)
+                local_file.truncate(size)
+
+            digest = self.rpc_call("finish_stream_from", remote_path, size,
+                                   netns=netns)
+        except Exception:
+            self._abort_stream(remote_path, netns)
+            raise
+        if local_digest.hexdigest(size) != digest:
+            raise MachineError("Integrity check of %s copied from machine %s "
+                               "failed" % (local_path, self.get_id()))
+
+    def _copy_file_from_machine_legacy(self, remote_path, local_path,
+                                       netns=None):
+        status = self.rpc_call("start_copy_from", remote_path, netns=netns)
         if not status:
             raise MachineError("The requested file cannot be transfered." \
                        "It does not exist on machine %s" % self.get_id())
@@ -629,16 +1235,41 @@ class Machine(object):
 
         buf_size = 1024*1024 # 1MB buffer
         while True:
-            data: bytes = self.rpc_call("copy_part_from", remote_path, buf_size)
+            data: bytes = self.rpc_call("copy_part_from", remote_path,
+                                        buf_size, netns=netns)
             if not data:
                 break
             local_file.write(data)
 
         local_file.close()
-        self.rpc_call("finish_copy_from", remote_path)
+        self.rpc_call("finish_copy_from", remote_path, netns=netns)
+
+    def _abort_stream(self, remote_path, netns=None):
+        """releases the agent side of a failed transfer so it can be
+        started again"""
+        try:
+            self.rpc_call("abort_stream", remote_path, netns=netns)
+        except Exception as exc:
+            logging.debug("Couldn't abort the transfer of %s on machine %s: "
+                          "%s", remote_path, self.get_id(), exc)
+
+    def _supports_file_stream(self, compression=None):
+        compressions = self._agent_desc.get("file_stream_compressions")
+        if compressions is None:
+            if compression is not None:
+                raise MachineError("Machine %s doesn't support compressed "
+                                   "file transfers" % self.get_id())
+            return False
+
+        if compression is not None and (
+                compression not in compressions or
+                compression not in available_compressions()):
+            raise MachineError("Compression %s is not available for machine "
+                               "%s" % (compression, self.get_id()))
+        return True
 
     def sync_resource(self, res_name, file_path, netns=None):
-        digest = sha256sum(file_path)
+        digest = sha256sum_cached(file_path)
 
         if not self.rpc_call("has_resource", digest, netns=netns):
             msg = "Transfering %s to machine %s as '%s'" % (file_path,
@@ -651,6 +1282,16 @@ class Machine(object):
                            "file", remote_path, res_name, netns=netns)
         return digest
 
+    def get_resource_cache_stats(self, netns=None):
+        """Statistics of the Agent resource cache
+
+        Returns a dictionary with the hits, misses, evictions,
+        evicted_bytes and index_writes counters and the current number of
+        entries, size and size_limit of the cache. Each network namespace
+        process of the Agent keeps its own counters.
+        """
+        return self.rpc_call("get_resource_cache_stats", netns=netns)
+
     def init_remote_class(self, cls, *args, **kwargs):
         module_name = cls.__module__
         cls_name = cls.__name__
@@ -665,17 +1306,59 @@ class Machine(object):
     def add_netns(self, netns):
         self._namespaces[netns.name] = netns
         self._device_database[netns] = {}
-        return self.rpc_call("add_namespace", netns.name)
+        res = self.rpc_call("add_namespace", netns.name)
+        if self._device_cache is not None:
+            self.rpc_call("set_device_update_events", True, netns=netns)
+        return res
 
     def del_netns(self, netns):
         return self.rpc_call("del_namespace", netns.name)
 
     def del_namespaces(self):
-        for netns in self._namespaces.values():
-            self.del_netns(netns)
-        self._namespaces = {}
+        run_steps(self._del_namespaces_steps())
         return True
 
+    def _del_namespaces_steps(self):
+        yield [self.rpc_call_async("del_namespaces",
+                                   [netns.name
+                                    for netns in self._namespaces.values()])]
+        self._namespaces = {}
+
+    def get_netns_pool_stats(self):
+        """Statistics of the pre-forked network namespaces of the Agent
+
+        Returns a dictionary with the number of forked processes (spawned),
+        namespaces created from the pool (claims), of them the ones that
+        waited for the initialization of a process (claims_waited) and
+        namespaces created with an empty pool (cold_starts), the total and
+        maximum initialization times of the processes (init_time_*) and
+        creation times of the namespaces (claim_time_*) in seconds and the
+        configured (size), idle and ready numbers of processes.
+        """
+        return self.rpc_call("get_netns_pool_stats")
+
+    def get_job_pool_stats(self, netns=None):
+        """Statistics of the pre-forked shell job processes of the Agent
+
+        Returns a dictionary with the configured (size) and idle numbers of
+        processes, the number of forked (spawned) and replaced (discarded)
+        processes and the start latencies of the jobs that ran in a pooled
+        process (start_latency["pooled"]) or in a new one
+        (start_latency["forked"]). The latencies are the count, p50, p90,
+        p99 and max of the time in seconds from the run_job request to the
+        start of the job. Each network namespace process of the Agent keeps
+        its own pool.
+        """
+        return self.rpc_call("get_job_pool_stats", netns=netns)
+
+    def wait_tentative_ips_async(self, ifindexes, timeout, netns=None):
+        """Waits for the end of duplicate address detection of the ip
+        addresses of the devices, returns a future resolved to False if the
+        timeout expired first
+        """
+        return self.rpc_call_async("wait_tentative_ips", ifindexes, timeout,
+                                   netns=netns)
+
     def get_security(self):
         return self._security
 
@@ -715,3 +1398,88 @@ class Machine(object):
                 )
 
         return dev
+
+def rpc_fan_out(machines, method_name, *args, **kwargs):
+    """Calls the same remote method on all of the machines in parallel
+
+    Returns the list of results in the order of machines, the first
+    exception is raised after all of the calls finished.
+    """
+    futures = [machine.rpc_call_async(method_name, *args, **kwargs)
+               for machine in machines]
+    return wait_all(futures)
+
+def run_steps(steps):
+    """Runs a generator of RPC steps to completion, see run_concurrently"""
+    return run_concurrently([steps])[0]
+
+def run_concurrently(steps_list, concurrency=0):
+    """Runs generators of RPC steps of several machines concurrently
+
+    Every step is a list of RpcFutures yielded by the generator, the
+    generator is resumed with the list of their results once all of them
+    are resolved, or the exception of the first failed one is thrown into
+    it. While one generator waits for its replies the others send their
+    next commands, so the agents work in parallel. At most concurrency
+    generators run at the same time, 0 means no limit.
+
+    Returns the list of the return values of the generators, the first
+    exception is raised after all of them finished.
+    """
+    results = [None] * len(steps_list)
+    errors = []
+    waiting = deque(enumerate(steps_list))
+    running = OrderedDict()
+
+    def resume(i, steps, values=None, exception=None):
+        try:
+            while True:
+                if exception is not None:
+                    futures = list(steps.throw(exception))
+                else:
+                    futures = list(steps.send(values))
+                if futures:
+                    running[i] = (steps, futures)
+                    return
+                # nothing to wait for
+                values, exception = [], None
+        except StopIteration as e:
+            results[i] = e.value
+        except Exception as e:
+            errors.append(e)
+
+    while waiting or running:
+        while waiting and (not concurrency or len(running) < concurrency):
+            i, steps = waiting.popleft()
+            resume(i, steps)
+
+        if not running:
+            continue
+
+        groups = list(running.items())
+        dispatcher = groups[0][1][1][0]._dispatcher
+        try:
+            resolved = dispatcher.wait_for_any([futures for _, (_, futures)
+                                                in groups])
+        except ConnectionError:
+            # the pending futures of a hard-disconnected agent are failed
+            # by the dispatcher, the error goes only to the steps of its
+            # machine and the other machines continue
+            resolved = [j for j, (_, (_, futures)) in enumerate(groups)
+                        if all([future.done() for future in futures])]
+            if not resolved:
+                raise
+        for j in resolved:
+            i, (steps, futures) = groups[j]
+            del running[i]
+
+            exceptions = [future.exception() for future in futures
+                          if future.exception() is not None]
+            if exceptions:
+                resume(i, steps, exception=exceptions[0])
+            else:
+                resume(i, steps, [future.result() for future in futures])
+
+    if errors:
+        raise errors[0]
+    return results
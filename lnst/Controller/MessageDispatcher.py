@@ -17,6 +17,8 @@ olichtne@redhat.com (Ondrej Lichtner)
 import logging
 import copy
 import signal
+import itertools
+from collections import OrderedDict
 from lnst.Common.ConnectionHandler import send_data
 from lnst.Common.ConnectionHandler import ConnectionHandler
 from lnst.Common.Parameters import Parameters, DeviceParam
@@ -93,47 +95,176 @@ def _timeout_handler(signum, frame):
     msg = "Timeout expired"
     raise WaitTimeoutError(msg)
 
+class RpcFuture(object):
+    """Result of a command sent to an agent by MessageDispatcher.post_message
+
+    The reply is received while the dispatcher processes agent messages,
+    calling result() processes them until this reply arrives.
+    """
+    def __init__(self, dispatcher, machine, request_id, netns=None):
+        self._dispatcher = dispatcher
+        self._machine = machine
+        self._request_id = request_id
+        self._netns = netns
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    @property
+    def machine(self):
+        return self._machine
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self._dispatcher.wait_for_futures([self])
+
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            self._dispatcher.wait_for_futures([self])
+        return self._exception
+
+    def _set_reply(self, reply):
+        if reply["type"] == "exception":
+            self._set_exception(reply["Exception"])
+        else:
+            self._result = deviceref_to_remote_device(self._machine,
+                                                      reply["result"],
+                                                      self._netns)
+            self._done = True
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+def wait_all(futures):
+    """Waits for all of the RpcFutures and returns their results in order
+
+    The agents work on the commands in parallel. If any of the commands
+    failed the first exception is raised after all of them finished.
+    """
+    futures = list(futures)
+    if len(futures) == 0:
+        return []
+
+    futures[0]._dispatcher.wait_for_futures(futures)
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
+
 class MessageDispatcher(ConnectionHandler):
     def __init__(self, log_ctl):
         super(MessageDispatcher, self).__init__()
         self._log_ctl = log_ctl
         self._machines = dict()
 
+        # RpcFutures of the commands waiting for a reply, by machine and
+        # request id
+        self._pending = dict()
+        self._request_ids = itertools.count()
+
     def add_agent(self, machine, connection):
         self._machines[machine] = machine
         self.add_connection(machine, connection)
 
     def send_message(self, machine, data):
+        return self.post_message(machine, data).result()
+
+    def post_message(self, machine, data):
+        """sends a command to the agent without waiting for its result
+
+        The command is tagged with a request id that the agent copies to its
+        reply. Returns an RpcFuture resolved once the reply is received.
+        """
         soc = self.get_connection(machine)
         data = remote_device_to_deviceref(data)
 
+        request_id = next(self._request_ids)
+        if data["type"] == "to_netns":
+            data["data"]["request_id"] = request_id
+        else:
+            data["request_id"] = request_id
+
+        future = RpcFuture(self, machine, request_id, data.get("netns", None))
         if send_data(soc, data) == False:
             msg = "Connection error from agent %s" % machine.get_id()
             raise ConnectionError(msg)
 
-        result = None
-        while True:
-            connected_agents = list(self._connection_mapping.keys())
-
-            messages = self.check_connections()
-            for msg in messages:
-                if msg[1]["type"] == "result" and msg[0] == machine:
-                    if result is not None:
-                        msg = ("Multiple result messages from the same agent "
-                               "'{}'".format(machine.get_id()))
-                        raise ConnectionError(msg)
-                    result = msg[1]
-                else:
-                    self._process_message(msg)
-
-            remaining_agents = list(self._connection_mapping.keys())
-            if connected_agents != remaining_agents:
-                self._handle_disconnects(set(connected_agents)-
-                                         set(remaining_agents))
-
-            if result is not None:
-                netns = data.get("netns", None)
-                return deviceref_to_remote_device(machine, result["result"], netns)
+        self._pending.setdefault(machine, OrderedDict())[request_id] = future
+        return future
+
+    def wait_for_futures(self, futures):
+        """processes agent messages until all of the futures are resolved"""
+        self._wait_until(lambda: all([future.done() for future in futures]))
+
+    def wait_for_any(self, future_groups):
+        """processes agent messages until all of the futures of at least one
+        of the groups are resolved, returns the indexes of the resolved
+        groups"""
+        def resolved():
+            return [i for i, futures in enumerate(future_groups)
+                    if all([future.done() for future in futures])]
+
+        self._wait_until(lambda: len(resolved()) > 0)
+        return resolved()
+
+    def process_pending_messages(self):
+        """processes the agent messages that already arrived without
+        waiting for more, e.g. the dev_updated notifications"""
+        self._process_messages(timeout=0)
+
+    def _wait_until(self, condition):
+        while not condition():
+            self._process_messages()
+
+    def _process_messages(self, timeout=None):
+        connected_agents = list(self._connection_mapping.keys())
+
+        messages = self.check_connections(timeout)
+        for msg in messages:
+            if not self._resolve_reply(msg):
+                self._process_message(msg)
+
+        remaining_agents = list(self._connection_mapping.keys())
+        if connected_agents != remaining_agents:
+            self._handle_disconnects(set(connected_agents)-
+                                     set(remaining_agents))
+
+    def _resolve_reply(self, message):
+        machine, msg = message
+        if msg["type"] == "result":
+            pass
+        elif msg["type"] == "exception" and "job_id" not in msg:
+            # exceptions of background jobs carry the job_id
+            pass
+        else:
+            return False
+
+        pending = self._pending.get(machine)
+        if not pending:
+            return False
+
+        if "request_id" in msg:
+            future = pending.pop(msg["request_id"], None)
+            if future is None:
+                return False
+        else:
+            # agents not tagging replies process commands in order
+            _, future = pending.popitem(last=False)
+
+        future._set_reply(msg)
+        return True
+
+    def _fail_pending(self, machine, exception):
+        for future in self._pending.pop(machine, {}).values():
+            future._set_exception(exception)
 
     def wait_for_condition(self, condition_check, timeout=0):
         res = True
@@ -156,7 +287,8 @@ class MessageDispatcher(ConnectionHandler):
                 messages = self.check_connections(timeout=1)
                 for msg in messages:
                     try:
-                        self._process_message(msg)
+                        if not self._resolve_reply(msg):
+                            self._process_message(msg)
                         wait = wait and not condition_wrapper()
                     except WaitTimeoutError as exc:
                         logging.error("Waiting for condition timed out!")
@@ -184,7 +316,8 @@ class MessageDispatcher(ConnectionHandler):
         messages = self.check_connections()
 
         for msg in messages:
-            self._process_message(msg)
+            if not self._resolve_reply(msg):
+                self._process_message(msg)
 
         remaining_agents = list(self._connection_mapping.keys())
         if connected_agents != remaining_agents:
@@ -220,6 +353,13 @@ class MessageDispatcher(ConnectionHandler):
             except KeyError:
                 netns = None
             machine.device_netns_change(message[1], netns)
+        elif message[1]["type"] == "dev_updated":
+            machine = self._machines[message[0]]
+            try:
+                netns = message[1]["netns"]
+            except KeyError:
+                netns = None
+            machine.device_updated(message[1], netns)
         elif message[1]["type"] == "exception":
             raise message[1]["Exception"]
         elif message[1]["type"] == "job_finished":
@@ -231,6 +371,10 @@ class MessageDispatcher(ConnectionHandler):
 
     def _handle_disconnects(self, disconnected_agents):
         disconnected_agents = set(disconnected_agents)
+        for agent in disconnected_agents:
+            msg = "Agent %s disconnected" % agent.get_id()
+            self._fail_pending(agent, ConnectionError(msg))
+
         for agent in list(disconnected_agents):
             if not agent.get_mapped():
                 logging.warn("Agent {} soft-disconnected from the "
@@ -248,3 +392,5 @@ class MessageDispatcher(ConnectionHandler):
         soc = self.get_connection(machine)
         self.remove_connection(soc)
         del self._machines[machine]
+        msg = "Agent %s disconnected" % machine.get_id()
+        self._fail_pending(machine, ConnectionError(msg))
@@ -89,12 +89,22 @@ class Namespace(object):
     def copy_file_to_machine(
         self,
         local_path: str,
-        remote_path: Optional[str] = None
+        remote_path: Optional[str] = None,
+        compression: Optional[str] = None,
+        resume: bool = False,
     ) -> str:
-        return self._machine.copy_file_to_machine(local_path, remote_path, self)
+        return self._machine.copy_file_to_machine(local_path, remote_path,
+                                                  self, compression, resume)
 
-    def copy_file_from_machine(self, remote_path: str, local_path: str):
-        self._machine.copy_file_from_machine(remote_path, local_path)
+    def copy_file_from_machine(
+        self,
+        remote_path: str,
+        local_path: str,
+        compression: Optional[str] = None,
+        resume: bool = False,
+    ):
+        self._machine.copy_file_from_machine(remote_path, local_path, self,
+                                             compression, resume)
 
     def prepare_job(self, what, fail=False, json=False, desc=None,
                     job_level=ResultLevel.DEBUG):
@@ -130,6 +140,101 @@ class Namespace(object):
         job.start(bg, timeout)
         return job
 
+    def batch(self):
+        """Batch device configuration of the machine
+
+        Returns a context manager, device method calls and attribute sets on
+        any namespace of the machine made inside the context are sent to the
+        Agent in a single round trip when the context exits::
+
+            with host.batch():
+                host.eth0.mtu = 9000
+                host.eth0.up()
+                host.eth0.ip_add("192.168.0.1/24")
+
+        Calls made inside the context return
+        :py:class:`lnst.Controller.Machine.BatchedCall` objects, their
+        result() method returns the result of the call. Any other remote
+        operation sends the queued calls first.
+        """
+        return self._machine.batch()
+
+    def enable_device_cache(self):
+        """Cache device attributes of the machine on the Controller
+
+        Reading the attributes derived from netlink (name, hwaddr, state,
+        ips, mtu, master, driver, link_header_type) of any device of the
+        machine is then
+        answered from a cache, the Agent notifies the Controller about
+        every netlink change of a device and its cached attributes are
+        dropped. Other attributes are always read from the Agent.
+        """
+        self._machine.enable_device_cache()
+
+    def disable_device_cache(self):
+        self._machine.disable_device_cache()
+
+    def resource_cache_stats(self):
+        """Statistics of the resource cache of the Agent, see
+        :py:meth:`lnst.Controller.Machine.Machine.get_resource_cache_stats`
+        """
+        return self._machine.get_resource_cache_stats(self)
+
+    def job_pool_stats(self):
+        """Statistics of the pre-forked shell job processes of the
+        Namespace, see
+        :py:meth:`lnst.Controller.Machine.Machine.get_job_pool_stats`
+        """
+        return self._machine.get_job_pool_stats(self)
+
+    def wait_tentative_ips_async(self, devices, timeout):
+        """Starts waiting for the end of duplicate address detection of the
+        devices of the Namespace, see
+        :py:meth:`lnst.Controller.Machine.Machine.wait_tentative_ips_async`
+        """
+        return self._machine.wait_tentative_ips_async(
+            [dev.ifindex for dev in devices], timeout, self)
+
+    def move_devices(self, **devices):
+        """Move devices to the Namespace in bulk
+
+        The same as assigning every device to the Namespace attribute of
+        the keyword name, e.g.::
+
+            netns.move_devices(vf0=host.vf0, vf1=host.vf1)
+
+        but all the devices coming from one namespace are moved by a single
+        request to the Agent instead of one per device.
+        """
+        moves = {}
+        for name, value in devices.items():
+            if not isinstance(value, RemoteDevice) or value.ifindex is None:
+                raise HostError("'{}' is not an existing device".format(name))
+            if isinstance(value, LoopbackDevice):
+                raise HostError("Cannot move loopback device between network namespaces")
+
+            if name in self._objects:
+                if self._objects[name] is not value:
+                    raise HostError("Name '%s' already assigned." % name)
+                continue
+            if hasattr(self, name):
+                raise HostError("Name '%s' already assigned." % name)
+
+            if value.netns is self:
+                self._objects[name] = value
+                continue
+            moves.setdefault(value.netns, []).append((name, value))
+
+        for old_ns, ns_moves in moves.items():
+            for name, value in ns_moves:
+                old_ns._unset(value)
+            self._machine.remote_devices_set_netns(
+                [value for name, value in ns_moves], self, old_ns)
+            for name, value in ns_moves:
+                value.netns = self
+                self._objects[name] = value
+                self._update_device_id(value, name)
+
     def __getattr__(self, name):
         """direct access to Device objects
 
@@ -13,13 +13,13 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import re
 import ethtool
-import pyroute2
 import logging
 import pprint
 import time
 from abc import ABCMeta
 from pyroute2.netlink.rtnl import ifinfmsg
 from lnst.Common.Logs import log_exc_traceback
+from lnst.Common.LnstError import LnstError
 from lnst.Common.NetUtils import normalize_hwaddr
 from lnst.Common.ExecCmd import exec_cmd, ExecCmdFail
 from lnst.Common.DeviceError import DeviceError, DeviceDeleted, DeviceDisabled
@@ -27,11 +27,18 @@ from lnst.Common.DeviceError import DeviceConfigError, DeviceConfigValueError
 from lnst.Common.DeviceError import DeviceFeatureNotSupported
 from lnst.Common.IpAddress import ipaddress, AF_INET
 from lnst.Common.HWAddress import hwaddress
+from lnst.Common import EthtoolIoctl
+from lnst.Common.EthtoolIoctl import EthtoolError, EthtoolNotSupported
+from lnst.Common import TrafficControl
+from lnst.Common.TrafficControl import TrafficControlError
 
 from pyroute2.netlink.rtnl import RTM_NEWLINK
 from pyroute2.netlink.rtnl import RTM_NEWADDR
 from pyroute2.netlink.rtnl import RTM_DELADDR
 
+# seconds to wait for the netlink notification of an added ip address
+IP_ADD_TIMEOUT = 5
+
 class DeviceMeta(ABCMeta):
     def __instancecheck__(self, other):
         try:
@@ -52,6 +59,16 @@ class Device(object, metaclass=DeviceMeta):
     as a tester facing API.
     """
 
+    # attributes that only change with the netlink link and address
+    # messages of the device, cached by the Controller while it receives the
+    # dev_updated messages of the Agent, see Machine.enable_device_cache
+    _nl_cached_attrs = frozenset(["name", "hwaddr", "state", "ips", "mtu",
+                                  "master", "driver", "link_header_type"])
+
+    # attributes that are read by running an external command, left out of
+    # device snapshots unless explicitly requested
+    _subprocess_attrs = frozenset()
+
     def __init__(self, if_manager):
         self.ifindex = None
         self._nl_msg = None
@@ -119,19 +136,14 @@ class Device(object, metaclass=DeviceMeta):
         logging.debug("Performing pyroute.IPRoute().{}({}, *args, **kwargs)".format(obj_name, op_name))
         logging.debug("{}".format(pretty_attrs))
 
-        ret_val = None
-        with pyroute2.IPRoute() as ipr:
-            try:
-                obj = getattr(ipr, obj_name)
-                if op_name is not None:
-                    ret_val = obj(op_name, *args, **kwargs)
-                else:
-                    ret_val = obj(*args, **kwargs)
-                self._if_manager.rescan_devices()
-            except Exception as e:
-                log_exc_traceback()
-                raise DeviceConfigError("Object {} operation {} on link {} failed: {}"
-                        .format(obj_name, op_name, self.name, str(e)))
+        try:
+            ret_val = self._if_manager.get_ipr_session().call(
+                obj_name, op_name, *args, **kwargs)
+            self._if_manager.sync_devices(replaces_dump=True)
+        except Exception as e:
+            log_exc_traceback()
+            raise DeviceConfigError("Object {} operation {} on link {} failed: {}"
+                    .format(obj_name, op_name, self.name, str(e)))
         return ret_val
 
     def _enable(self):
@@ -240,17 +252,21 @@ class Device(object, metaclass=DeviceMeta):
             if addr in self._ip_addrs:
                 self._ip_addrs.remove(addr)
 
+    def _get_nl_if_data(self):
+        """the part of the if_data that doesn't require running ethtool"""
+        return {"ifindex": self.ifindex,
+                "hwaddr": self.hwaddr,
+                "name": self.name,
+                "ip_addrs": self.ips,
+                "link_header_type": self.link_header_type,
+                "state": self.state,
+                "master": self.master,
+                "mtu": self.mtu,
+                "driver": self.driver,
+                "devlink": self._devlink}
+
     def _get_if_data(self):
-        if_data = {"ifindex": self.ifindex,
-                   "hwaddr": self.hwaddr,
-                   "name": self.name,
-                   "ip_addrs": self.ips,
-                   "link_header_type": self.link_header_type,
-                   "state": self.state,
-                   "master": self.master,
-                   "mtu": self.mtu,
-                   "driver": self.driver,
-                   "devlink": self._devlink}
+        if_data = self._get_nl_if_data()
         try:
             ad_rx_coal, ad_tx_coal = self._read_adaptive_coalescing()
         except DeviceError:
@@ -277,24 +293,41 @@ class Device(object, metaclass=DeviceMeta):
                 ret[k] = v
         return ret
 
+    def _tc(self, func, *args):
+        try:
+            return func(self._ipr_wrapper, self.ifindex, *args)
+        except TrafficControlError as e:
+            raise DeviceConfigError("Traffic control configuration of {} "
+                                    "failed: {}".format(self.name, str(e)))
+
     def _clear_tc_qdisc(self):
-        exec_cmd("tc qdisc del dev %s root" % self.name, die_on_err=False)
-        out, _ = exec_cmd("tc filter show dev %s" % self.name)
-        ingress_handles = re.findall("ingress (\\d+):", out)
-        for ingress_handle in ingress_handles:
-            exec_cmd("tc qdisc del dev %s handle %s: ingress" %
-                     (self.name, ingress_handle))
-        out, _ = exec_cmd("tc qdisc show dev %s" % self.name)
-        ingress_qdiscs = re.findall("qdisc ingress (\\w+):", out)
-        if len(ingress_qdiscs) != 0:
-                exec_cmd("tc qdisc del dev %s ingress" % self.name)
+        self._tc(TrafficControl.clear)
 
     def _clear_tc_filters(self):
-        out, _ = exec_cmd("tc filter show dev %s" % self.name)
-        egress_prefs = re.findall("pref (\\d+) .* handle", out)
+        self._tc(TrafficControl.clear_filters)
+
+    def tc_snapshot(self):
+        """snapshot of the traffic control configuration
+
+        Returns a dictionary of the qdiscs, classes and filters of the
+        device that can be passed to tc_restore later, it only contains
+        plain values so it can be stored by the Controller.
+        """
+        return self._tc(TrafficControl.snapshot)
 
-        for egress_pref in egress_prefs:
-            exec_cmd("tc filter del dev %s pref %s" % (self.name, egress_pref))
+    def tc_restore(self, snapshot):
+        """restores the traffic control configuration from a snapshot
+
+        Only the root and ingress qdisc trees that differ from the snapshot
+        are recreated. Returns the number of recreated trees.
+        """
+        return self._tc(TrafficControl.restore, snapshot)
+
+    def tc_root_qdisc_replace(self, kind):
+        """replaces the root qdisc with a qdisc of the kind with the default
+        options, e.g. "mq"
+        """
+        self._tc(TrafficControl.replace_root_qdisc, kind)
 
     def store_cleanup_data(self):
         """Stores initial configuration for later cleanup"""
@@ -559,6 +592,7 @@ class Device(object, metaclass=DeviceMeta):
 
         Returns dictionary of interface statistics, IFLA_STATS
         """
+        self._if_manager.refresh_device(self.ifindex)
         return self._nl_msg.get_attr("IFLA_STATS")
 
     @property
@@ -567,6 +601,7 @@ class Device(object, metaclass=DeviceMeta):
 
         Returns dictionary of interface statistics, IFLA_STATS64
         """
+        self._if_manager.refresh_device(self.ifindex)
         return self._nl_msg.get_attr("IFLA_STATS64")
 
     @property
@@ -598,13 +633,9 @@ class Device(object, metaclass=DeviceMeta):
 
             self._ipr_wrapper("addr", "add", **kwargs)
 
-        for i in range(5):
-            logging.debug("Waiting for ip address to be added {} of 5".format(i))
-            time.sleep(1)
-            self._if_manager.rescan_devices()
-            if addr in self.ips:
-                break
-        else:
+        logging.debug("Waiting for ip address {} to be added".format(str(ip)))
+        if not self._if_manager.wait_for_condition(lambda: ip in self.ips,
+                                                   IP_ADD_TIMEOUT):
             raise DeviceError("Failed to configure ip address {}".format(str(ip)))
 
     def ip_del(self, addr):
@@ -647,8 +678,20 @@ class Device(object, metaclass=DeviceMeta):
         self._nl_link_update["state"] = "down"
         self._nl_link_sync("set")
 
-    #TODO looks like python ethtool module doesn't support these so we'll keep
-    #exec_cmd for now...
+    def _ethtool(self, ioctl_func, fallback, *args, **kwargs):
+        """calls the EthtoolIoctl function for the device
+
+        The ethtool command is used as a fallback if the ioctl fails for a
+        different reason than missing support in the driver.
+        """
+        try:
+            return ioctl_func(self.name, *args, **kwargs)
+        except EthtoolNotSupported as e:
+            raise DeviceFeatureNotSupported(str(e))
+        except EthtoolError as e:
+            logging.debug("{}, falling back to the ethtool command".format(e))
+            return fallback()
+
     def speed_set(self, speed):
         """set the device speed
 
@@ -658,38 +701,77 @@ class Device(object, metaclass=DeviceMeta):
             speed -- string accepted by the 'ethtool -s dev speed ' command
         """
         try:
-            int(speed)
+            speed = int(speed)
         except:
             raise DeviceConfigValueError("Invalid link speed value %s" %
                                          str(speed))
-        exec_cmd("ethtool -s %s speed %d" % (self.name, speed))
+        self._ethtool(EthtoolIoctl.set_link_settings,
+                      lambda: exec_cmd("ethtool -s %s speed %d" %
+                                       (self.name, speed)),
+                      speed=speed, autoneg=False)
 
     def autoneg_on(self):
         """enable automatic negotiation of speed for this device"""
-        exec_cmd("ethtool -s %s autoneg on" % self.name)
+        self._ethtool(EthtoolIoctl.set_link_settings,
+                      lambda: exec_cmd("ethtool -s %s autoneg on" % self.name),
+                      autoneg=True)
 
     def autoneg_off(self):
         """disable automatic negotiation of speed for this device"""
-        exec_cmd("ethtool -s %s autoneg off" % self.name)
+        self._ethtool(EthtoolIoctl.set_link_settings,
+                      lambda: exec_cmd("ethtool -s %s autoneg off" % self.name),
+                      autoneg=False)
 
-    def _read_adaptive_coalescing(self):
-        res, _ = exec_cmd("ethtool -c %s" % self.name, die_on_err=False)
+    def offloads_set(self, offloads):
+        """set the offload features of the device
+
+        Args:
+            offloads -- dict of feature names accepted by 'ethtool -K' (e.g.
+                gro, tso or rx-checksum) to 'on'/'off' or True/False
+        """
+        def run_ethtool():
+            opts = " ".join(["{} {}".format(name, value) if isinstance(value, str)
+                             else "{} {}".format(name, "on" if value else "off")
+                             for name, value in offloads.items()])
+            exec_cmd("ethtool -K {} {}".format(self.name, opts))
 
-        regex = "Adaptive RX: (on|off)  TX: (on|off)"
         try:
-            res = re.search(regex, res).groups()
-        except AttributeError:
-            raise DeviceFeatureNotSupported(
-                "No values for coalescence of %s." % self.name
-            )
-        return list(res)
+            self._ethtool(EthtoolIoctl.set_features, run_ethtool, offloads)
+        except DeviceError:
+            raise
+        except LnstError as e:
+            raise DeviceConfigError(str(e))
+
+    def _read_adaptive_coalescing(self):
+        def run_ethtool():
+            res, _ = exec_cmd("ethtool -c %s" % self.name, die_on_err=False)
+
+            regex = "Adaptive RX: (on|off)  TX: (on|off)"
+            try:
+                res = re.search(regex, res).groups()
+            except AttributeError:
+                raise DeviceFeatureNotSupported(
+                    "No values for coalescence of %s." % self.name
+                )
+            return list(res)
+
+        def read_ioctl(ifname):
+            coalesce = EthtoolIoctl.get_coalesce(ifname)
+            return ["on" if coalesce["use_adaptive_rx_coalesce"] else "off",
+                    "on" if coalesce["use_adaptive_tx_coalesce"] else "off"]
+
+        return self._ethtool(read_ioctl, run_ethtool)
 
     def _write_adaptive_coalescing(self, rx_val, tx_val):
         if self._read_adaptive_coalescing() == [rx_val, tx_val]:
             return
         try:
-            exec_cmd("ethtool -C %s adaptive-rx %s adaptive-tx %s" %
-                     (self.name, rx_val, tx_val))
+            self._ethtool(EthtoolIoctl.set_coalesce,
+                          lambda: exec_cmd(
+                              "ethtool -C %s adaptive-rx %s adaptive-tx %s" %
+                              (self.name, rx_val, tx_val)),
+                          use_adaptive_rx_coalesce=rx_val == "on",
+                          use_adaptive_tx_coalesce=tx_val == "on")
         except:
             raise DeviceFeatureNotSupported(
                 "Not allowed to modify coalescence settings for %s." % self.name
@@ -728,48 +810,67 @@ class Device(object, metaclass=DeviceMeta):
         self._write_pause_frames(None, value)
 
     def _read_pause_frames(self):
-        try:
-            res, _ = exec_cmd("ethtool -a %s" % self.name)
-        except:
-            raise DeviceFeatureNotSupported(
-                "No values for pause frames of %s." % self.name
-                )
+        def run_ethtool():
+            try:
+                res, _ = exec_cmd("ethtool -a %s" % self.name)
+            except:
+                raise DeviceFeatureNotSupported(
+                    "No values for pause frames of %s." % self.name
+                    )
+
+            # TODO: add autonegotiate
+            pause_settings = []
+            regex = "(RX|TX):.*(on|off)"
+
+            for line in res.split('\n'):
+                m = re.search(regex, line)
+                if m:
+                    setting = True if m.group(2) == 'on' else False
+                    pause_settings.append(setting)
 
-        # TODO: add autonegotiate
-        pause_settings = []
-        regex = "(RX|TX):.*(on|off)"
+            if len(pause_settings) != 2:
+                raise Exception("Could not fetch pause frame settings. %s" % res)
 
-        for line in res.split('\n'):
-            m = re.search(regex, line)
-            if m:
-                setting = True if m.group(2) == 'on' else False
-                pause_settings.append(setting)
+            return pause_settings
 
-        if len(pause_settings) != 2:
-            raise Exception("Could not fetch pause frame settings. %s" % res)
+        def read_ioctl(ifname):
+            pause = EthtoolIoctl.get_pause(ifname)
+            return [pause["rx"], pause["tx"]]
 
-        return pause_settings
+        return self._ethtool(read_ioctl, run_ethtool)
 
     def _write_pause_frames(self, rx_val, tx_val):
-        ethtool_cmd = "ethtool -A {}".format(self.name)
-        ethtool_opts = ""
+        def run_ethtool():
+            ethtool_cmd = "ethtool -A {}".format(self.name)
+            ethtool_opts = ""
 
-        for feature, value in [('rx', rx_val), ('tx', tx_val)]:
-            if value is None:
-                continue
+            for feature, value in [('rx', rx_val), ('tx', tx_val)]:
+                if value is None:
+                    continue
+
+                ethtool_opts += " {} {}".format(feature, 'on' if value else 'off')
 
-            ethtool_opts += " {} {}".format(feature, 'on' if value else 'off')
+            if len(ethtool_opts) == 0:
+                return
 
-        if len(ethtool_opts) == 0:
+            try:
+                exec_cmd(ethtool_cmd + ethtool_opts)
+            except ExecCmdFail as e:
+                if e.get_retval() == 79:
+                    raise DeviceConfigError(
+                        "Could not modify pause settings for %s." % self.name
+                    )
+
+        if (rx_val, tx_val) == (None, None):
             return
 
         try:
-            exec_cmd(ethtool_cmd + ethtool_opts)
-        except ExecCmdFail as e:
-            if e.get_retval() == 79:
-                raise DeviceConfigError(
-                    "Could not modify pause settings for %s." % self.name
-                )
+            self._ethtool(EthtoolIoctl.set_pause, run_ethtool,
+                          rx=rx_val, tx=tx_val)
+        except DeviceFeatureNotSupported:
+            raise DeviceConfigError(
+                "Could not modify pause settings for %s." % self.name
+            )
 
         timeout=5
         while timeout > 0:
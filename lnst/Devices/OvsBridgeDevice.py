@@ -12,14 +12,144 @@ olichtne@redhat.com (Ondrej Lichtner)
 
 import re
 import pprint
+import tempfile
 from lnst.Common.Utils import check_process_running
-from lnst.Common.ExecCmd import exec_cmd
-from lnst.Common.DeviceError import DeviceError
+from lnst.Common.ExecCmd import exec_cmd, ExecCmdFail
+from lnst.Common.DeviceError import DeviceError, DeviceConfigError
 from lnst.Devices.Device import Device
 from lnst.Devices.SoftDevice import SoftDevice
 
+# fields of dump-flows output that are not part of the match
+FLOW_FIELDS = ["cookie", "duration", "table", "n_packets", "n_bytes",
+               "idle_age", "hard_age", "idle_timeout", "hard_timeout",
+               "importance", "priority", "send_flow_rem", "check_overlap",
+               "reset_counts", "no_packet_counts", "no_byte_counts"]
+
+class OvsFlowError(DeviceConfigError):
+    """raised when ovs-ofctl rejects flow entries
+
+    errors is a list of (index, entry, message) tuples, index and entry
+    are None for errors ovs-ofctl doesn't relate to a line of the input.
+    """
+    def __init__(self, msg, errors=None):
+        if errors is None:
+            errors = []
+        super(OvsFlowError, self).__init__(msg, errors)
+        self.msg = msg
+        self.errors = errors
+
+    def __str__(self):
+        lines = [self.msg]
+        for index, entry, message in self.errors:
+            if index is None:
+                lines.append("  {}".format(message))
+            else:
+                lines.append("  flow {} '{}': {}".format(index, entry,
+                                                         message))
+        return "\n".join(lines)
+
+def ofctl_add_flows(bridge, entries, bundle=True):
+    """adds the flow entries to the bridge with a single ovs-ofctl call
+
+    The entries are passed in a file, with bundle=True they are added in
+    an OpenFlow 1.4 bundle so either all of them or none are installed.
+    """
+    entries = list(entries)
+    for entry in entries:
+        if "\n" in entry:
+            raise OvsFlowError("Invalid flow entry {!r}".format(entry))
+
+    with tempfile.NamedTemporaryFile("w", prefix="lnst-flows-",
+                                     suffix=".txt") as flows_file:
+        flows_file.write("\n".join(entries) + "\n")
+        flows_file.flush()
+
+        cmd = "ovs-ofctl {}add-flows {} {}".format(
+            "--bundle " if bundle else "", bridge, flows_file.name)
+        try:
+            exec_cmd(cmd, log_outputs=False)
+        except ExecCmdFail as e:
+            errors = _ofctl_errors(e.get_stderr(), flows_file.name, entries)
+            raise OvsFlowError("Adding {} flows to {} failed{}".format(
+                len(entries), bridge,
+                ", none were added" if bundle else ""), errors)
+
+def _ofctl_errors(stderr, file_name, entries):
+    line_error = re.compile(r"{}:(\d+): (.*)".format(re.escape(file_name)))
+    errors = []
+    for line in stderr.splitlines():
+        if not line.strip():
+            continue
+        match = line_error.search(line)
+        if match:
+            index = int(match.group(1)) - 1
+            if 0 <= index < len(entries):
+                errors.append((index, entries[index], match.group(2)))
+                continue
+        errors.append((None, None, line.strip()))
+    return errors
+
+def _split_actions(actions):
+    """splits the actions on commas outside of parentheses and brackets"""
+    result = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(actions):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            result.append(actions[start:i])
+            start = i + 1
+    if actions[start:]:
+        result.append(actions[start:])
+    return result
+
+def _flow_value(value):
+    if value.endswith("s"):
+        try:
+            return float(value[:-1])
+        except ValueError:
+            return value
+    try:
+        return int(value, 0)
+    except ValueError:
+        return value
+
+def parse_dump_flows(output):
+    """parses the output of ovs-ofctl dump-flows
+
+    Returns a list of dictionaries, one per flow, with the FLOW_FIELDS
+    that are present converted to numbers (duration in seconds), a
+    "match" dictionary (fields without a value, e.g. "ip", map to None)
+    and an "actions" list.
+    """
+    flows = []
+    actions_re = re.compile(r"(?:^|[ ,])actions=")
+    for line in output.splitlines():
+        match = actions_re.search(line)
+        if not match:
+            # the reply header
+            continue
+
+        flow = {"match": {},
+                "actions": _split_actions(line[match.end():].strip())}
+        for field in re.split(r"[,\s]+", line[:match.start()]):
+            if not field:
+                continue
+            name, sep, value = field.partition("=")
+            if name in FLOW_FIELDS:
+                flow[name] = _flow_value(value) if sep else True
+            else:
+                flow["match"][name] = value if sep else None
+        flows.append(flow)
+    return flows
+
 class OvsBridgeDevice(SoftDevice):
     _name_template = "t_ovsbr"
+    _subprocess_attrs = SoftDevice._subprocess_attrs | frozenset(
+        ["flows_str"])
 
     def __init__(self, ifmanager, *args, **kwargs):
         super(OvsBridgeDevice, self).__init__(ifmanager)
@@ -29,26 +159,14 @@ class OvsBridgeDevice(SoftDevice):
     def _type_init(cls):
         exec_cmd("systemctl start openvswitch.service", die_on_err=False)
 
+    def _ovsdb(self):
+        return self._if_manager.get_ovsdb()
+
     def _create(self):
-        exec_cmd("ovs-vsctl add-br %s" % self.name)
+        self._ovsdb().add_bridge(self.name)
 
     def destroy(self):
-        exec_cmd("ovs-vsctl del-br %s" % self.name)
-
-    def _dict_to_keyvalues(self, options):
-        opts = ""
-        for opt_name, opt_value in options.items():
-            opts += " %s=%s" % (opt_name, opt_value)
-
-        return opts
-
-    def _interface_cmd(self, interface, options):
-        keyvalues = self._dict_to_keyvalues(options)
-        cmd = ""
-        if len(keyvalues):
-            cmd = " -- set Interface {} {}".format(interface, keyvalues)
-
-        return cmd
+        self._ovsdb().del_bridge(self.name)
 
     def _format_ovs_json_value(self, value):
         formatted_value = None
@@ -69,42 +187,18 @@ class OvsBridgeDevice(SoftDevice):
 
         return formatted_value
 
-    def _format_ovs_json(self, ovs_json):
-        headings = ovs_json['headings']
-        data = ovs_json['data']
-
-        formatted_data = []
-
-        for data_entry in data:
-            formatted_fields = {}
-            for i, entry_value in enumerate(data_entry):
-                formatted_fields[headings[i]] = self._format_ovs_json_value(entry_value)
-            formatted_data.append(formatted_fields)
-
-        return formatted_data
-
-    def _list_ports(self):
-        out_json = exec_cmd("ovs-vsctl --format json list port",
-                log_outputs=False, json=True)[0]
-
-        return self._format_ovs_json(out_json)
-
-    def _list_interfaces(self):
-        out_json = exec_cmd("ovs-vsctl --format json list interface",
-                log_outputs=False, json=True)[0]
-
-        return self._format_ovs_json(out_json)
-
     def port_add(self, device=None, port_options={}, interface_options={}):
+        interface_options = dict(interface_options)
+        name = interface_options.pop('name', None)
         if device is None:
-            dev_name = interface_options.get('name',
-                self._if_manager.assign_name(interface_options['type']))
+            if name is None:
+                name = self._if_manager.assign_name(interface_options['type'])
+            dev_name = name
         else:
             dev_name = device.name
 
-        exec_cmd("ovs-vsctl add-port {} {}{}{}".format(self.name, dev_name,
-            self._dict_to_keyvalues(port_options),
-            self._interface_cmd(dev_name, interface_options)))
+        self._ovsdb().add_port(self.name, dev_name,
+                               [(dev_name, interface_options)], port_options)
 
         iface = None
         if 'type' in interface_options and interface_options['type'] == 'internal':
@@ -115,23 +209,15 @@ class OvsBridgeDevice(SoftDevice):
 
     def port_del(self, dev):
         if isinstance(dev, Device):
-            exec_cmd("ovs-vsctl del-port %s %s" % (self.name, dev.name))
+            self._ovsdb().del_port(self.name, dev.name)
         elif isinstance(dev, str):
-            exec_cmd("ovs-vsctl del-port %s %s" % (self.name, dev))
+            self._ovsdb().del_port(self.name, dev)
         else:
             raise DeviceError("Invalid port_del argument %s" % str(dev))
 
     def bond_add(self, port_name, devices, **kwargs):
-        dev_names = ""
-        for dev in devices:
-            dev_names += " %s" % dev.name
-
-        options = ""
-        for opt_name, opt_value in kwargs.items():
-            options += " %s=%s" % (opt_name, opt_value)
-
-        exec_cmd("ovs-vsctl add-bond %s %s %s %s" % (self.name, port_name,
-                                                     dev_names, options))
+        self._ovsdb().add_port(self.name, port_name,
+                               [(dev.name, {}) for dev in devices], kwargs)
 
     def bond_del(self, dev):
         self.port_del(dev)
@@ -147,38 +233,44 @@ class OvsBridgeDevice(SoftDevice):
     def flow_add(self, entry):
         exec_cmd("ovs-ofctl add-flow %s '%s'" % (self.name, entry))
 
-    def flows_add(self, entries):
-        for entry in entries:
-            self.flow_add(entry)
+    def flows_add(self, entries, bundle=True):
+        """adds the flow entries with a single ovs-ofctl call
+
+        With bundle=True the entries are added atomically, OvsFlowError
+        lists the rejected entries.
+        """
+        ofctl_add_flows(self.name, entries, bundle)
+
+    def flows_dump(self):
+        """returns the flows of the bridge parsed by parse_dump_flows"""
+        out = exec_cmd("ovs-ofctl dump-flows %s" % self.name,
+            log_outputs=False)[0]
+        return parse_dump_flows(out)
 
     def flows_del(self, entry):
         exec_cmd("ovs-ofctl del-flows %s" % (self.name))
 
     @property
     def ports(self):
-        ports = self._list_ports()
-        interfaces = self._list_interfaces()
-
         filtered_ports = {}
 
-        for port in ports:
-            port_iface_uuid = port['interfaces']
-            port_ifaces = [ iface for iface in interfaces if iface['_uuid'] == port_iface_uuid ]
-            if len(port_ifaces):
+        for port, port_ifaces in self._ovsdb().get_bridge_ports(self.name):
+            if len(port_ifaces) == 1:
                 port_iface = port_ifaces[0]
                 filtered_ports[port['name']] = {
                         'interface': port_iface['name'],
                         'type': port_iface['type'],
-                        'options': port_iface['options'],
+                        'options': self._format_ovs_json_value(
+                            port_iface['options']),
                         }
 
         return filtered_ports
 
     @property
     def tunnels(self):
-        tunnels = self.ports.copy()
+        tunnels = self.ports
 
-        for port in self.ports.keys():
+        for port in list(tunnels.keys()):
             if tunnels[port]['type'] in ['', 'internal']:
                 del tunnels[port]
 
@@ -187,15 +279,16 @@ class OvsBridgeDevice(SoftDevice):
     @property
     def bonds(self):
         bonds = {}
-        bond_list = []
-        out = exec_cmd("ovs-appctl bond/list", log_outputs=False)[0]
-
-        for line in out.split('\n'):
-            if line:
-                bond_list.append(line.split('\t'))
 
-        for bond in bond_list[1:]:
-            bonds[bond[0]] = {'type' : bond[1], 'slaves' : bond[3]}
+        for port, port_ifaces in self._ovsdb().get_bridge_ports(self.name):
+            if len(port_ifaces) > 1:
+                # an unset bond_mode is the default active-backup
+                bond_mode = self._format_ovs_json_value(port['bond_mode'])
+                bonds[port['name']] = {
+                        'type': bond_mode or 'active-backup',
+                        'slaves': ", ".join(iface['name']
+                                            for iface in port_ifaces),
+                        }
 
         return bonds
 
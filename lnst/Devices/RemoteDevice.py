@@ -56,12 +56,33 @@ class RemoteDevice(object):
         newone._inited = deepcopy(self._inited, memo)
         return newone
 
-    def enable_readonly_cache(self):
+    def enable_readonly_cache(self, expensive=True):
+        """Caches all attributes of the device and makes it read only
+
+        The attributes are read with a single dev_snapshot call, expensive
+        attributes (read by running external commands on the agent) are only
+        cached if expensive is True.
+        """
         if self._cached:
             return
-        self._cache = {}
-        for name, val in self:
-            self._cache[name] = val
+        snapshot = self._machine.device_snapshot([self], expensive)
+        self._set_readonly_cache(snapshot[self]["attrs"])
+
+    def _local_attrs(self):
+        """public attributes of the device class that are overriden on the
+        Controller side, e.g. peer_name"""
+        return [name for name in dir(type(self))
+                if name[0] != '_' and hasattr(self._dev_cls, name)]
+
+    def _set_readonly_cache(self, attrs):
+        self._cache = dict(attrs)
+        for name in self._local_attrs():
+            if callable(getattr(self._dev_cls, name)):
+                continue
+            try:
+                self._cache[name] = getattr(self, name)
+            except DeviceFeatureNotSupported as e:
+                logging.debug(str(e))
         self._cached = True
 
     def disable_readonly_cache(self):
@@ -141,7 +162,16 @@ class RemoteDevice(object):
             return dev_method
         else:
             if self._cached:
-                return self._cache[name]
+                try:
+                    return self._cache[name]
+                except KeyError:
+                    raise DeviceReadOnly("Attribute {} wasn't cached before "
+                                         "the device became read only."
+                                         .format(name))
+
+            if name in self._dev_cls._nl_cached_attrs:
+                return self._machine.remote_device_getattr_cached(
+                        self.ifindex, name, self.netns)
 
             return self._machine.remote_device_getattr(self.ifindex, name, self.netns)
 
@@ -1,8 +1,10 @@
 import pprint
 import copy
+import logging
 from contextlib import contextmanager
 
 from lnst.Common.LnstError import LnstError
+from lnst.Controller.MessageDispatcher import wait_all
 from lnst.Common.Parameters import (
     Param,
     IntParam,
@@ -485,13 +487,23 @@ class BaseEnrtRecipe(
         """
         return [NonzeroFlowEvaluator()]
 
-    def wait_tentative_ips(self, devices):
-        def condition():
-            return all(
-                [not ip.is_tentative for dev in devices for ip in dev.ips]
-            )
+    def wait_tentative_ips(self, devices, timeout=5):
+        """Waits for the end of duplicate address detection
+
+        The agents wait for the netlink notifications of the finished
+        detection of all ip addresses of the devices, the devices of all
+        hosts and network namespaces are waited for in parallel.
+        """
+        netns_devices = {}
+        for dev in devices:
+            netns_devices.setdefault(dev.netns, []).append(dev)
 
-        self.ctl.wait_for_condition(condition, timeout=5)
+        futures = [
+            netns.wait_tentative_ips_async(devs, timeout)
+            for netns, devs in netns_devices.items()
+        ]
+        if not all(wait_all(futures)):
+            logging.error("Waiting for tentative ips timed out!")
 
     def _create_reverse_ping(self, pconf):
         return PingConf(
@@ -1,7 +1,8 @@
 import copy
+import logging
 
 from lnst.Common.Parameters import Param
-from lnst.Controller.RecipeResults import ResultLevel
+from lnst.Common.DeviceError import DeviceError
 from lnst.Recipes.ENRT.ConfigMixins.BaseSubConfigMixin import BaseSubConfigMixin
 
 
@@ -40,15 +41,21 @@ class OffloadSubConfigMixin(BaseSubConfigMixin):
 
         offload_settings = getattr(config, "offload_settings", None)
         if offload_settings:
-            ethtool_offload_string = ""
-            for name, value in list(offload_settings.items()):
-                ethtool_offload_string += " %s %s" % (name, value)
-
             for nic in self.offload_nics:
-                nic.netns.run(
-                    "ethtool -K {} {}".format(nic.name, ethtool_offload_string),
-                    job_level=ResultLevel.NORMAL,
+                self._offloads_set(nic, offload_settings)
+
+    def _offloads_set(self, nic, offload_settings):
+        # like with the former 'ethtool -K' jobs an unsupported or fixed
+        # feature only fails the recorded device method call result, the
+        # recipe continues
+        try:
+            nic.offloads_set(offload_settings)
+        except DeviceError as e:
+            logging.error(
+                "Setting offloads {} of {} failed: {}".format(
+                    offload_settings, nic.name, e
                 )
+            )
 
     def generate_sub_configuration_description(self, config):
         description = super().generate_sub_configuration_description(config)
@@ -65,20 +72,17 @@ class OffloadSubConfigMixin(BaseSubConfigMixin):
         return description
 
     def remove_sub_configuration(self, config):
-        offload_settings = getattr(config, "offload_settings", None)
-        if offload_settings:
-            ethtool_offload_string = ""
-            for name, value in list(offload_settings.items()):
-                ethtool_offload_string += " %s %s" % (name, "on")
-
-            for nic in self.offload_nics:
-                # set all the offloads back to 'on' state
-                nic.netns.run(
-                    "ethtool -K {} {}".format(nic.name, ethtool_offload_string),
-                    job_level=ResultLevel.NORMAL,
-                )
-
-        return super().remove_sub_configuration(config)
+        try:
+            offload_settings = getattr(config, "offload_settings", None)
+            if offload_settings:
+                for nic in self.offload_nics:
+                    # set all the offloads back to 'on' state
+                    self._offloads_set(
+                        nic, {name: "on" for name in offload_settings.keys()}
+                    )
+        finally:
+            result = super().remove_sub_configuration(config)
+        return result
 
     def generate_flow_combinations(self, config):
         for flows in super().generate_flow_combinations(config):
@@ -28,17 +28,23 @@ class ParallelStreamQDiscHWConfigMixin(BaseHWConfigMixin):
         parallel_streams = getattr(self.params, "perf_parallel_streams", None)
         if parallel_streams is not None and parallel_streams > 1:
             hw_config["parallel_stream_devs"] = []
+            hw_config["parallel_stream_tc_snapshots"] = []
             for dev in self.parallel_stream_qdisc_hw_config_dev_list:
-                dev.host.run("tc qdisc replace dev %s root mq" % dev.name)
+                hw_config["parallel_stream_tc_snapshots"].append(
+                    dev.tc_snapshot()
+                )
+                dev.tc_root_qdisc_replace("mq")
                 hw_config["parallel_stream_devs"].append(dev)
 
     def hw_deconfig(self, config):
         hw_config = config.hw_config
         parallel_devs = hw_config.get("parallel_stream_devs", None)
         if parallel_devs is not None:
-            for dev in parallel_devs:
-                dev.host.run("tc qdisc del dev %s root" % dev.name)
+            snapshots = hw_config["parallel_stream_tc_snapshots"]
+            for dev, snapshot in zip(parallel_devs, snapshots):
+                dev.tc_restore(snapshot)
             del hw_config["parallel_stream_devs"]
+            del hw_config["parallel_stream_tc_snapshots"]
 
         super().hw_deconfig(config)
 
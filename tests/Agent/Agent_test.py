@@ -0,0 +1,66 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lnst.Common.FileTransfer import FileTransferError
+from tests.Agent import import_agent, restore_packages
+
+RemoteMethods = None
+
+def setUpModule():
+    global RemoteMethods
+    RemoteMethods = import_agent().RemoteMethods
+
+def tearDownModule():
+    restore_packages()
+
+class CacheConfig(object):
+    """keeps the resource cache of the agent in a temporary directory"""
+    def __init__(self, cache_dir):
+        self._options = {"dir": cache_dir, "expiration_period": 0,
+                         "size_limit": 0}
+
+    def get_option(self, section, option):
+        return self._options[option]
+
+class FileStreamTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.methods = RemoteMethods(None, None, {}, None,
+                                     CacheConfig(os.path.join(self.tmpdir,
+                                                              "cache")),
+                                     None)
+        self.path = os.path.join(self.tmpdir, "target")
+        self.data = os.urandom(4096)
+
+    def tearDown(self):
+        self.methods.reset_file_transfers()
+        shutil.rmtree(self.tmpdir)
+
+    def test_retry_after_failure(self):
+        self.methods.start_stream_to(self.path)
+        with self.assertRaises(FileTransferError):
+            self.methods.stream_part_to(self.path, 0, b"lnst", "unknown")
+        self.assertEqual(self.methods._copy_targets, {})
+        self.assertEqual(self.methods._stream_digests, {})
+
+        self.assertEqual(self.methods.start_stream_to(self.path),
+                         (self.path, 0))
+        self.methods.stream_part_to(self.path, 0, self.data)
+        self.assertTrue(self.methods.finish_stream_to(
+            self.path, len(self.data),
+            hashlib.sha256(self.data).hexdigest()))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_abort_stream_from(self):
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        self.assertEqual(self.methods.start_stream_from(self.path),
+                         len(self.data))
+        self.assertTrue(self.methods.abort_stream(self.path))
+        self.assertEqual(self.methods._copy_sources, {})
+        self.assertEqual(self.methods.start_stream_from(self.path),
+                         len(self.data))
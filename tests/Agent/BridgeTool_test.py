@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from lnst.Agent.BridgeTool import BridgeTool
+
+class RecordingDevice(object):
+    name = "eth0"
+    ifindex = 5
+
+    def __init__(self):
+        self.calls = []
+
+    def _ipr_wrapper(self, obj_name, op_name, *args, **kwargs):
+        self.calls.append((obj_name, op_name, kwargs))
+
+def vlan(vlan_id, vlan_id_end=None, pvid=False, untagged=False,
+         self=False, master=False):
+    info = {"vlan_id": vlan_id, "pvid": pvid, "untagged": untagged,
+            "self": self, "master": master}
+    if vlan_id_end is not None:
+        info["vlan_id_end"] = vlan_id_end
+    return info
+
+class BridgeToolVlanTest(TestCase):
+    def test_vlans_in_one_message(self):
+        dev = RecordingDevice()
+        BridgeTool(dev).add_vlans([vlan(100, 199, master=True),
+                                   vlan(5, pvid=True, untagged=True,
+                                        master=True)])
+        self.assertEqual(dev.calls, [("vlan_filter", "add", {
+            "index": 5,
+            "IFLA_AF_SPEC": {"attrs": [
+                ["IFLA_BRIDGE_FLAGS", 0x1],
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0x8, "vid": 100}],
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0x10, "vid": 199}],
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0x6, "vid": 5}]]}})])
+
+    def test_one_message_per_flags(self):
+        dev = RecordingDevice()
+        BridgeTool(dev).del_vlans([vlan(10), vlan(11, self=True),
+                                   vlan(12)])
+        self.assertEqual(dev.calls, [
+            ("vlan_filter", "del", {"index": 5, "IFLA_AF_SPEC": {"attrs": [
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0, "vid": 10}],
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0, "vid": 12}]]}}),
+            ("vlan_filter", "del", {"index": 5, "IFLA_AF_SPEC": {"attrs": [
+                ["IFLA_BRIDGE_FLAGS", 0x2],
+                ["IFLA_BRIDGE_VLAN_INFO", {"flags": 0, "vid": 11}]]}})])
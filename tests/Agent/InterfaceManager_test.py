@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from lnst.Agent.InterfaceManager import InterfaceManager
+from lnst.Common.DeviceError import DeviceNotFound
+
+
+class QuietServerHandler(object):
+    def send_data_to_ctl(self, data):
+        pass
+
+class DumpsAvoidedTest(TestCase):
+    def setUp(self):
+        self.if_manager = InterfaceManager(QuietServerHandler())
+        # the events of the host's devices need the agent's device classes
+        self.if_manager.handle_netlink_msgs = lambda: None
+
+    def tearDown(self):
+        self.if_manager.close()
+
+    def _dumps_avoided(self):
+        return self.if_manager.get_stats()["dumps_avoided"]
+
+    def test_counted_lookups(self):
+        self.assertEqual(self.if_manager.get_devices(), [])
+        with self.assertRaises(DeviceNotFound):
+            self.if_manager.get_device_by_name("lnst-none")
+        self.assertEqual(self._dumps_avoided(), 2)
+
+        self.if_manager.sync_devices()
+        with self.assertRaises(DeviceNotFound):
+            self.if_manager.get_device(1, replaces_dump=False)
+        self.assertEqual(self._dumps_avoided(), 2)
+
+        self.assertFalse(self.if_manager._is_name_used("lnst-none",
+                                                       ovs_names=set()))
+        self.assertEqual(self.if_manager.get_stats()["dumps"], 0)
+        self.assertEqual(self._dumps_avoided(), 3)
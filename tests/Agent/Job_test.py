@@ -0,0 +1,91 @@
+import signal
+from unittest import TestCase
+
+from lnst.Agent.Job import Job, JobContext, JobWorkerPool, _percentiles
+
+
+class QuietLogCtl(object):
+    """the job processes log to the stderr of the test"""
+    def disable_logging(self):
+        pass
+
+    def set_connection(self, target):
+        pass
+
+def shell_job(job_id, command):
+    return {"type": "shell", "job_id": job_id, "command": command,
+            "json": False}
+
+class JobWorkerPoolTest(TestCase):
+    def setUp(self):
+        self.log_ctl = QuietLogCtl()
+        self.context = JobContext(self.log_ctl)
+        self.pool = self.context.get_pool()
+        self.pool.set_size(1)
+        self.pool.refill()
+
+    def tearDown(self):
+        self.context.cleanup()
+
+    def _run(self, job_id, command):
+        job = Job(shell_job(job_id, command), self.log_ctl, self.pool)
+        self.context.add_job(job)
+        job.run()
+        return job
+
+    def _finish(self, job):
+        msg = job.get_parent_pipe().recv()
+        job.join()
+        self.context.add_start_latency(job, msg.pop("start_latency"))
+        job.set_finished(msg["result"])
+        return msg
+
+    def test_worker_reuse(self):
+        job = self._run(1, "echo out; echo err >&2; exit 3")
+        self.assertTrue(job.is_pooled())
+        pid = job._pid
+
+        msg = self._finish(job)
+        self.assertEqual(msg["job_id"], 1)
+        self.assertFalse(msg["result"]["passed"])
+        self.assertEqual(msg["result"]["res_data"],
+                         {"stdout": "out\n", "stderr": "err\n"})
+
+        job = self._run(2, "true")
+        self.assertEqual(job._pid, pid)
+        self.assertTrue(self._finish(job)["result"]["passed"])
+
+        stats = self.context.get_pool_stats()
+        self.assertEqual(stats["spawned"], 1)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(stats["start_latency"]["pooled"]["count"], 2)
+        self.assertEqual(stats["start_latency"]["forked"], {"count": 0})
+
+    def test_killed_worker_is_replaced(self):
+        job = self._run(1, "sleep 10")
+        self.assertTrue(job.kill(signal.SIGKILL))
+        self.assertEqual(job.get_result()["result"]["res_data"], "Job killed")
+        self.assertEqual(self.pool.get_stats()["discarded"], 1)
+
+        # the pool is empty until refilled, the job runs in a new process
+        job = self._run(2, "true")
+        self.assertFalse(job.is_pooled())
+        self.assertTrue(self._finish(job)["result"]["passed"])
+
+        self.pool.refill()
+        job = self._run(3, "true")
+        self.assertTrue(job.is_pooled())
+        self._finish(job)
+        self.assertEqual(self.pool.get_stats()["spawned"], 2)
+
+    def test_set_size(self):
+        self.pool.set_size(3)
+        self.pool.refill()
+        self.assertEqual(self.pool.get_stats()["idle"], 3)
+        self.pool.set_size(1)
+        self.assertEqual(self.pool.get_stats()["idle"], 1)
+
+    def test_percentiles(self):
+        stats = _percentiles([i / 100 for i in range(100, 0, -1)])
+        self.assertEqual(stats, {"count": 100, "p50": 0.51, "p90": 0.91,
+                                 "p99": 1.0, "max": 1.0})
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+from unittest import TestCase, skipUnless
+
+from lnst.Agent.OvsdbClient import OvsdbClient, OvsdbError
+from lnst.Agent.OvsdbClient import datum_to_python
+
+VSWITCH_SCHEMA = "/usr/share/openvswitch/vswitch.ovsschema"
+
+_OPTIONAL_INT = {"key": "integer", "min": 0, "max": 1}
+_OPTIONAL_STR = {"key": "string", "min": 0, "max": 1}
+_STR_MAP = {"key": "string", "value": "string", "min": 0, "max": "unlimited"}
+
+def _refs(table, min_refs=0):
+    return {"key": {"type": "uuid", "refTable": table},
+            "min": min_refs, "max": "unlimited"}
+
+FAKE_SCHEMA = {"name": "Open_vSwitch", "tables": {
+    "Open_vSwitch": {"columns": {
+        "bridges": {"type": _refs("Bridge")},
+        "next_cfg": {"type": "integer"},
+        "cur_cfg": {"type": "integer"}}},
+    "Bridge": {"columns": {
+        "name": {"type": "string"},
+        "ports": {"type": _refs("Port")},
+        "external_ids": {"type": _STR_MAP}}},
+    "Port": {"columns": {
+        "name": {"type": "string"},
+        "interfaces": {"type": _refs("Interface", 1)},
+        "tag": {"type": _OPTIONAL_INT},
+        "trunks": {"type": {"key": "integer", "min": 0, "max": 4096}},
+        "bond_mode": {"type": _OPTIONAL_STR}}},
+    "Interface": {"columns": {
+        "name": {"type": "string"},
+        "type": {"type": "string"},
+        "options": {"type": _STR_MAP},
+        "ofport_request": {"type": _OPTIONAL_INT}}},
+}}
+
+def _default(column_type):
+    if isinstance(column_type, dict):
+        if "value" in column_type:
+            return ["map", []]
+        return ["set", []]
+    return {"integer": 0, "string": "", "boolean": False}[column_type]
+
+def _atoms(value):
+    if isinstance(value, list) and value[0] == "set":
+        return value[1]
+    return [value]
+
+class FakeOvsdbServer(object):
+    """a minimal ovsdb-server with the operations used by OvsdbClient
+
+    With vswitchd=True cur_cfg follows next_cfg like when ovs-vswitchd
+    runs.
+    """
+    def __init__(self, path, vswitchd=False):
+        self.vswitchd = vswitchd
+        self.transactions = 0
+        self.tables = {name: {} for name in FAKE_SCHEMA["tables"]}
+        self.tables["Open_vSwitch"][str(uuid.uuid4())] = self._row(
+            "Open_vSwitch", {})
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._sock.close()
+
+    def _row(self, table, row):
+        columns = FAKE_SCHEMA["tables"][table]["columns"]
+        new_row = {name: _default(column["type"])
+                   for name, column in columns.items()}
+        new_row.update(row)
+        return new_row
+
+    def _serve(self):
+        conn, _ = self._sock.accept()
+        decoder = json.JSONDecoder()
+        buf = ""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            buf += data.decode()
+            while buf.strip():
+                try:
+                    msg, end = decoder.raw_decode(buf.lstrip())
+                except ValueError:
+                    break
+                buf = buf.lstrip()[end:]
+                for reply in self._handle(msg):
+                    conn.sendall(json.dumps(reply).encode())
+
+    def _handle(self, msg):
+        method, params = msg["method"], msg["params"]
+        if method == "get_schema":
+            return [{"id": msg["id"], "result": FAKE_SCHEMA, "error": None}]
+        elif method == "monitor":
+            updates = {}
+            for table, request in params[2].items():
+                updates[table] = {
+                    row_uuid: {"new": {c: row[c] for c in request["columns"]}}
+                    for row_uuid, row in self.tables[table].items()}
+            return [{"id": msg["id"], "result": updates, "error": None}]
+        elif method == "transact":
+            self.transactions += 1
+            results, changes = self._transact(params[1:])
+            # the updates go before the reply like from ovsdb-server
+            update = {"method": "update", "id": None,
+                      "params": ["lnst", changes]}
+            return [update, {"id": msg["id"], "result": results,
+                             "error": None}]
+
+    def _match(self, table, where):
+        matched = []
+        for row_uuid, row in self.tables[table].items():
+            for column, _, value in where:
+                if column == "_uuid":
+                    if ["uuid", row_uuid] != value:
+                        break
+                elif row[column] != value:
+                    break
+            else:
+                matched.append(row_uuid)
+        return matched
+
+    def _transact(self, operations):
+        names = {}
+        changes = {}
+
+        def resolve(value):
+            if isinstance(value, dict):
+                return {k: resolve(v) for k, v in value.items()}
+            if isinstance(value, list):
+                if value[0] == "named-uuid":
+                    return ["uuid", names[value[1]]]
+                return [resolve(v) for v in value]
+            return value
+
+        def changed(table, row_uuid):
+            row = self.tables[table].get(row_uuid)
+            update = {"new": row} if row is not None else {"old": {}}
+            changes.setdefault(table, {})[row_uuid] = update
+
+        results = []
+        for op in operations:
+            table = op["table"]
+            if op["op"] == "insert":
+                row_uuid = str(uuid.uuid4())
+                names[op["uuid-name"]] = row_uuid
+        for op in operations:
+            table = op["table"]
+            if op["op"] == "insert":
+                row_uuid = names[op["uuid-name"]]
+                self.tables[table][row_uuid] = self._row(
+                    table, resolve(op["row"]))
+                changed(table, row_uuid)
+                results.append({"uuid": ["uuid", row_uuid]})
+            elif op["op"] == "select":
+                rows = [{c: self.tables[table][u][c] for c in op["columns"]}
+                        for u in self._match(table, op["where"])]
+                results.append({"rows": rows})
+            elif op["op"] == "delete":
+                matched = self._match(table, op["where"])
+                for row_uuid in matched:
+                    del self.tables[table][row_uuid]
+                    changed(table, row_uuid)
+                results.append({"count": len(matched)})
+            elif op["op"] == "mutate":
+                matched = self._match(table, op["where"])
+                for row_uuid in matched:
+                    row = self.tables[table][row_uuid]
+                    for column, mutator, value in op["mutations"]:
+                        value = resolve(value)
+                        if mutator == "+=":
+                            row[column] += value
+                        elif mutator == "insert":
+                            row[column] = ["set", _atoms(row[column]) +
+                                           _atoms(value)]
+                        elif mutator == "delete":
+                            row[column] = ["set", [a for a in
+                                                   _atoms(row[column])
+                                                   if a not in _atoms(value)]]
+                    if self.vswitchd and table == "Open_vSwitch":
+                        row["cur_cfg"] = row["next_cfg"]
+                    changed(table, row_uuid)
+                results.append({"count": len(matched)})
+        return results, changes
+
+class OvsdbClientScenario(object):
+    def test_bridge_ports(self):
+        client = self.client
+        client.add_bridge("br0", wait=self.wait)
+        client.add_port("br0", "vx0",
+                        [("vx0", {"type": "vxlan",
+                                  "option:remote_ip": "192.168.0.2",
+                                  "options:key": "flow",
+                                  "ofport_request": "10"})],
+                        {"tag": "5"}, wait=self.wait)
+        client.add_port("br0", "bond0", [("eth0", {}), ("eth1", {})],
+                        {"bond_mode": "balance-slb"}, wait=self.wait)
+
+        ports = {port["name"]: (port, ifaces)
+                 for port, ifaces in client.get_bridge_ports("br0")}
+        self.assertEqual(sorted(ports), ["bond0", "br0", "vx0"])
+
+        port, ifaces = ports["vx0"]
+        self.assertEqual(port["tag"], 5)
+        self.assertEqual(ifaces[0]["type"], "vxlan")
+        self.assertEqual(ifaces[0]["ofport_request"], 10)
+        self.assertEqual(datum_to_python(ifaces[0]["options"]),
+                         {"remote_ip": "192.168.0.2", "key": "flow"})
+        self.assertEqual(ports["br0"][1][0]["type"], "internal")
+        self.assertEqual(sorted(i["name"] for i in ports["bond0"][1]),
+                         ["eth0", "eth1"])
+
+        client.del_port("br0", "vx0", wait=self.wait)
+        self.assertEqual(sorted(p["name"] for p, _ in
+                                client.get_bridge_ports("br0")),
+                         ["bond0", "br0"])
+        self.assertEqual(client.find_row("Interface", "vx0"), (None, None))
+
+        client.del_bridge("br0", wait=self.wait)
+        self.assertEqual(client.get_rows("Bridge"), {})
+        self.assertEqual(client.get_rows("Port"), {})
+        self.assertEqual(client.get_rows("Interface"), {})
+
+    def test_errors(self):
+        with self.assertRaises(OvsdbError):
+            self.client.add_port("nobr", "p0", [("p0", {})], wait=self.wait)
+        with self.assertRaises(OvsdbError):
+            self.client.make_row("Port", {"tag": "x"})
+
+class FakeServerTest(OvsdbClientScenario, TestCase):
+    wait = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        path = os.path.join(self.root, "db.sock")
+        self.server = FakeOvsdbServer(path, vswitchd=True)
+        self.client = OvsdbClient(path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.root)
+
+    def test_reads_are_local(self):
+        self.client.add_bridge("br0")
+        requests = self.client.get_stats()["requests"]
+        for i in range(10):
+            self.client.get_bridge_ports("br0")
+        self.assertEqual(self.client.get_stats()["requests"], requests)
+        # one transaction per bridge or port
+        self.assertEqual(self.server.transactions, 1)
+
+    def test_wait_timeout(self):
+        self.server.vswitchd = False
+        with self.assertRaises(OvsdbError):
+            self.client.transact([], wait=True, timeout=0.1)
+
+@skipUnless(shutil.which("ovsdb-server") and shutil.which("ovsdb-tool") and
+            os.path.exists(VSWITCH_SCHEMA), "ovsdb-server not installed")
+class OvsdbServerTest(OvsdbClientScenario, TestCase):
+    """runs against a local ovsdb-server, there's no ovs-vswitchd so the
+    transactions don't wait for it"""
+    wait = False
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        db = os.path.join(self.root, "conf.db")
+        path = os.path.join(self.root, "db.sock")
+        subprocess.run(["ovsdb-tool", "create", db, VSWITCH_SCHEMA],
+                       check=True)
+        self.server = subprocess.Popen(
+            ["ovsdb-server", db, "--remote=punix:" + path,
+             "--unixctl=" + os.path.join(self.root, "ctl"),
+             "--pidfile=" + os.path.join(self.root, "pid")])
+        for i in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.05)
+
+        self.client = OvsdbClient(path)
+        self.client.transact([{"op": "insert", "table": "Open_vSwitch",
+                               "row": {}}])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.root)
@@ -0,0 +1,21 @@
+import sys
+
+# importing the agent replaces these packages with the agent's dynamic ones
+AGENT_PACKAGES = ["lnst.Devices", "lnst.Tests", "lnst.RecipeCommon"]
+_saved_packages = {}
+
+def import_agent():
+    """imports lnst.Agent.Agent after the collection of the tests, the
+    packages it replaces are put back by restore_packages()"""
+    for name in AGENT_PACKAGES:
+        _saved_packages.setdefault(name, sys.modules.get(name))
+    import lnst.Agent.Agent
+    return lnst.Agent.Agent
+
+def restore_packages():
+    for name, module in _saved_packages.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+    _saved_packages.clear()
@@ -0,0 +1,50 @@
+import socket
+import threading
+from unittest import TestCase
+
+from lnst.Common.SecureSocket import SecureSocket, FRAMING_BINARY
+from lnst.Common.ConnectionHandler import send_data, recv_data
+from lnst.Common.ConnectionHandler import negotiate_serializer
+from lnst.Common.ConnectionHandler import SUPPORTED_SERIALIZERS
+from lnst.Common.ConnectionHandler import PickleSerializer
+from lnst.Common.ConnectionHandler import OutOfBandPickleSerializer
+
+
+class SerializerTest(TestCase):
+    msg = {"type": "command",
+           "method_name": "copy_part_to",
+           "args": ("/tmp/file", b"x" * 1024*1024, bytearray(70000), b"small"),
+           "kwargs": {}}
+
+    def _roundtrip(self, serializer, framing=FRAMING_BINARY):
+        a, b = socket.socketpair()
+        sender = SecureSocket(a)
+        receiver = SecureSocket(b)
+        for s in [sender, receiver]:
+            s.set_framing(framing)
+            s.set_serializer(serializer)
+
+        t = threading.Thread(target=send_data, args=(sender, self.msg))
+        t.start()
+        received = recv_data(receiver)
+        t.join()
+
+        sender.close()
+        self.assertEqual(recv_data(receiver), "")
+        receiver.close()
+        return received
+
+    def test_roundtrip(self):
+        for serializer in SUPPORTED_SERIALIZERS:
+            with self.subTest(serializer=serializer):
+                self.assertEqual(self._roundtrip(serializer), self.msg)
+
+    def test_oob_keeps_types(self):
+        received = self._roundtrip(OutOfBandPickleSerializer.name)
+        self.assertIs(type(received["args"][1]), bytes)
+        self.assertIs(type(received["args"][2]), bytearray)
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate_serializer(None), PickleSerializer.name)
+        self.assertEqual(negotiate_serializer(SUPPORTED_SERIALIZERS),
+                         OutOfBandPickleSerializer.name)
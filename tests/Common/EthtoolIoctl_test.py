@@ -0,0 +1,17 @@
+from unittest import TestCase
+
+from lnst.Common import EthtoolIoctl
+from lnst.Common.EthtoolIoctl import EthtoolError
+
+
+class EthtoolIoctlTest(TestCase):
+    def test_loopback_features(self):
+        features = EthtoolIoctl.get_features("lo")
+        self.assertIn("rx-checksum", features)
+        for active, changeable in features.values():
+            self.assertIsInstance(active, bool)
+            self.assertIsInstance(changeable, bool)
+
+    def test_missing_device(self):
+        with self.assertRaises(EthtoolError):
+            EthtoolIoctl.get_pause("lnstnodev0")
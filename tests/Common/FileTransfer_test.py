@@ -0,0 +1,61 @@
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+
+from lnst.Common.FileTransfer import StreamDigest, file_digest
+from lnst.Common.FileTransfer import compress, decompress
+from lnst.Common.FileTransfer import available_compressions
+
+
+class StreamDigestTest(TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(self.data)
+        f.close()
+        self.path = f.name
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _chunks(self, offset=0, size=1024 * 1024):
+        for part_offset in range(offset, len(self.data), size):
+            yield part_offset, self.data[part_offset:part_offset + size]
+
+    def test_in_order(self):
+        digest = StreamDigest(self.path)
+        for offset, data in self._chunks():
+            digest.update(offset, data)
+        self.assertEqual(digest.hexdigest(len(self.data)),
+                         file_digest(self.path))
+
+    def test_resumed(self):
+        digest = StreamDigest(self.path)
+        for offset, data in self._chunks(offset=12345):
+            digest.update(offset, data)
+        self.assertEqual(digest.hexdigest(len(self.data)),
+                         file_digest(self.path))
+
+    def test_out_of_order(self):
+        digest = StreamDigest(self.path)
+        for offset, data in reversed(list(self._chunks())):
+            digest.update(offset, data)
+        self.assertEqual(digest.hexdigest(len(self.data)),
+                         file_digest(self.path))
+
+    def test_prefix(self):
+        self.assertEqual(file_digest(self.path, 1000),
+                         hashlib.sha256(self.data[:1000]).hexdigest())
+        self.assertNotEqual(file_digest(self.path, 1000),
+                            file_digest(self.path))
+
+
+class CompressionTest(TestCase):
+    def test_roundtrip(self):
+        data = b"lnst" * 100000
+        for compression in [None] + available_compressions():
+            with self.subTest(compression=compression):
+                self.assertEqual(
+                    decompress(compression, compress(compression, data)),
+                    data)
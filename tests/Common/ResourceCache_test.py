@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lnst.Common.ResourceCache import ResourceCache
+
+
+class ResourceCacheTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.root, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _add(self, cache, name, size):
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as f:
+            f.write(name.encode().ljust(size, b"x"))
+        return cache.add_file_entry(path, name)
+
+    def test_lru_eviction(self):
+        cache = ResourceCache(self.cache_path, 0, size_limit=3000)
+        a = self._add(cache, "a", 1000)
+        b = self._add(cache, "b", 1000)
+        c = self._add(cache, "c", 1000)
+        cache.renew_entry(a)
+        d = self._add(cache, "d", 1000)
+
+        self.assertFalse(cache.query(b))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_path, b)))
+        for res_hash in [a, c, d]:
+            self.assertTrue(cache.query(res_hash))
+        self.assertEqual(cache.size, 3000)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["evicted_bytes"], 1000)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_entry_larger_than_limit_is_kept(self):
+        cache = ResourceCache(self.cache_path, 0, size_limit=100)
+        a = self._add(cache, "a", 1000)
+        self.assertTrue(cache.query(a))
+
+    def test_flush(self):
+        cache = ResourceCache(self.cache_path, 0)
+        a = self._add(cache, "a", 10)
+        for i in range(10):
+            cache.renew_entry(a)
+        self.assertFalse(os.path.exists(cache.index_path))
+
+        cache.flush()
+        cache.flush()
+        self.assertEqual(cache.get_stats()["index_writes"], 1)
+
+        reloaded = ResourceCache(self.cache_path, 0)
+        self.assertTrue(reloaded.query(a))
+        self.assertEqual(reloaded.size, 10)
+
+    def test_old_index_update(self):
+        cache = ResourceCache(self.cache_path, 0)
+        a = self._add(cache, "a", 10)
+        cache.flush()
+
+        with open(cache.index_path) as f:
+            index = json.load(f)
+        index["index_version"] = 1
+        del index["entries"][a]["size"]
+        with open(cache.index_path, "w") as f:
+            json.dump(index, f)
+
+        reloaded = ResourceCache(self.cache_path, 0)
+        self.assertTrue(reloaded.query(a))
+        self.assertEqual(reloaded.size, 10)
+
+    def test_flush_merges_other_processes(self):
+        cache = ResourceCache(self.cache_path, 0, size_limit=2500)
+        netns_cache = ResourceCache(self.cache_path, 0, size_limit=2500)
+        a = self._add(cache, "a", 1000)
+        cache.flush()
+        b = self._add(netns_cache, "b", 1000)
+        netns_cache.flush()
+        c = self._add(cache, "c", 1000)
+        cache.flush()
+
+        self.assertFalse(cache.query(a))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_path, a)))
+        reloaded = ResourceCache(self.cache_path, 0)
+        self.assertFalse(reloaded.query(a))
+        self.assertTrue(reloaded.query(b))
+        self.assertTrue(reloaded.query(c))
+        self.assertEqual(reloaded.size, 2000)
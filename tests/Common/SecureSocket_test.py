@@ -0,0 +1,139 @@
+import os
+import socket
+import threading
+from unittest import TestCase
+
+from lnst.Common.SecureSocket import SecureSocket, SecSocketException
+from lnst.Common.SecureSocket import FRAMING_ASCII, FRAMING_BINARY
+from lnst.Common.SecureSocket import negotiate_framing, negotiate_cipher_suite
+from lnst.Common.SecureSocket import SUPPORTED_CIPHER_SUITES, AEAD_CIPHER_SUITES
+from lnst.Common.SecureSocket import CIPHER_SUITE_AES256_GCM
+from lnst.Common.SecureSocket import CIPHER_SUITE_CHACHA20_POLY1305
+from lnst.Common.SecureSocket import CIPHER_SUITE_CBC_HMAC_SHA256
+
+
+class SecureSocketFramingTest(TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.sender = SecureSocket(a)
+        self.receiver = SecureSocket(b)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def _roundtrip(self, framing, msgs):
+        self.sender.set_framing(framing)
+        self.receiver.set_framing(framing)
+
+        t = threading.Thread(target=lambda: [self.sender.send_msg(m) for m in msgs])
+        t.start()
+        received = [self.receiver.recv_msg() for _ in msgs]
+        t.join()
+        return received
+
+    def test_ascii_roundtrip(self):
+        msgs = [{"type": "result", "result": i} for i in range(10)]
+        self.assertEqual(self._roundtrip(FRAMING_ASCII, msgs), msgs)
+
+    def test_binary_roundtrip(self):
+        msgs = [{"type": "result", "result": b"x" * size}
+                for size in [0, 1, 1024, 4*1024*1024]]
+        self.assertEqual(self._roundtrip(FRAMING_BINARY, msgs), msgs)
+
+    def test_binary_disconnect(self):
+        self.receiver.set_framing(FRAMING_BINARY)
+        self.sender.close()
+        with self.assertRaises(SecSocketException):
+            self.receiver.recv_msg()
+
+
+class NegotiateFramingTest(TestCase):
+    def test_legacy_peer(self):
+        self.assertEqual(negotiate_framing(None), FRAMING_ASCII)
+
+    def test_highest_common(self):
+        self.assertEqual(negotiate_framing([FRAMING_ASCII, FRAMING_BINARY]),
+                         FRAMING_BINARY)
+        self.assertEqual(negotiate_framing([FRAMING_ASCII]), FRAMING_ASCII)
+
+    def test_no_common(self):
+        with self.assertRaises(SecSocketException):
+            negotiate_framing([42])
+
+
+def keyed_socket_pair(cipher_suite):
+    a, b = socket.socketpair()
+    client = SecureSocket(a)
+    server = SecureSocket(b)
+    client._role = "client"
+    server._role = "server"
+
+    master_secret = os.urandom(48)
+    ctl_random = os.urandom(28)
+    agent_random = os.urandom(28)
+    for s in [client, server]:
+        s._master_secret = master_secret
+        s._ctl_random = ctl_random
+        s._agent_random = agent_random
+        s.set_framing(FRAMING_BINARY)
+        s.set_cipher_suite(cipher_suite)
+        s._init_cipher_spec()
+        s._change_read_cipher_spec()
+        s._change_write_cipher_spec()
+    return client, server
+
+
+class SecureSocketCipherSuiteTest(TestCase):
+    def _roundtrip(self, cipher_suite):
+        client, server = keyed_socket_pair(cipher_suite)
+        msgs = [{"type": "result", "result": os.urandom(size)}
+                for size in [0, 15, 16, 1024, 1024*1024]]
+
+        t = threading.Thread(target=lambda: [client.send_msg(m) for m in msgs])
+        t.start()
+        received = [server.recv_msg() for _ in msgs]
+        t.join()
+
+        server.send_msg(msgs[0])
+        self.assertEqual(client.recv_msg(), msgs[0])
+
+        client.close()
+        server.close()
+        return msgs, received
+
+    def test_roundtrip(self):
+        for cipher_suite in SUPPORTED_CIPHER_SUITES:
+            with self.subTest(cipher_suite=cipher_suite):
+                msgs, received = self._roundtrip(cipher_suite)
+                self.assertEqual(received, msgs)
+
+    def test_aead_rejects_tampered_record(self):
+        for cipher_suite in AEAD_CIPHER_SUITES:
+            with self.subTest(cipher_suite=cipher_suite):
+                client, server = keyed_socket_pair(cipher_suite)
+                record = bytearray(client._protect_data(b"payload"))
+                record[-1] ^= 1
+                self.assertIsNone(server._uprotect_data(record))
+                client.close()
+                server.close()
+
+    def test_aead_rejects_replayed_record(self):
+        client, server = keyed_socket_pair(CIPHER_SUITE_AES256_GCM)
+        record = client._protect_data(b"payload")
+        self.assertEqual(server._uprotect_data(record), b"payload")
+        self.assertIsNone(server._uprotect_data(record))
+        client.close()
+        server.close()
+
+
+class NegotiateCipherSuiteTest(TestCase):
+    def test_legacy_peer(self):
+        self.assertEqual(negotiate_cipher_suite(None),
+                         CIPHER_SUITE_CBC_HMAC_SHA256)
+
+    def test_preferred_common(self):
+        self.assertEqual(
+            negotiate_cipher_suite([CIPHER_SUITE_CBC_HMAC_SHA256,
+                                    CIPHER_SUITE_CHACHA20_POLY1305]),
+            CIPHER_SUITE_CHACHA20_POLY1305)
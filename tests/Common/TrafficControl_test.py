@@ -0,0 +1,106 @@
+import struct
+from unittest import TestCase
+
+from lnst.Common import TrafficControl as TC
+from pyroute2.netlink.rtnl import RTM_NEWQDISC, RTM_DELQDISC
+from pyroute2.netlink.rtnl import RTM_NEWTCLASS, RTM_NEWTFILTER
+
+
+def _attrs(kind, options=b""):
+    attrs = TC._encode_attr(TC.TCA_KIND, kind.encode() + b"\0")
+    if options:
+        attrs += TC._encode_attr(TC.TCA_OPTIONS, options)
+    return attrs.hex()
+
+def _obj(kind, handle, parent, options=b"", info=0):
+    return {"kind": kind, "handle": handle, "parent": parent, "info": info,
+            "attrs": _attrs(kind, options)}
+
+HTB_OPTIONS = TC._encode_attr(TC.TCA_HTB_INIT,
+                              struct.pack("=IIIII", TC.HTB_VER, 10, 0x10,
+                                          0, 0))
+
+SNAPSHOT = {"version": TC.SNAPSHOT_VERSION,
+            "qdiscs": [_obj("tbf", 0x200000, 0x10020),
+                       _obj("htb", 0x10000, TC.TC_H_ROOT, HTB_OPTIONS),
+                       _obj("clsact", 0xFFFF0000, TC.TC_H_INGRESS)],
+            "classes": [_obj("htb", 0x10020, TC.TC_H_ROOT),
+                        _obj("htb", 0x10010, TC.TC_H_ROOT)],
+            "filters": [_obj("u32", 0x80000800, 0x10000, info=0x10000008)]}
+
+class FakeIPRoute(object):
+    """answers the dumps from a snapshot and records the batched requests"""
+    def __init__(self, snap):
+        self.snap = snap
+        self.batches = []
+
+    def _dump(self, objs, msg_type):
+        msgs = []
+        for obj in objs:
+            msg = TC._message(msg_type, 0, 1, obj)
+            msg.encode()
+            msgs.append(msg)
+        return msgs
+
+    def __call__(self, op_name, _, *args, **kwargs):
+        if op_name == "get_qdiscs":
+            return self._dump(self.snap["qdiscs"], RTM_NEWQDISC)
+        elif op_name == "get_classes":
+            return self._dump(self.snap["classes"], RTM_NEWTCLASS)
+        elif op_name == "get_filters":
+            return self._dump([f for f in self.snap["filters"]
+                               if f["parent"] == kwargs["parent"]],
+                              RTM_NEWTFILTER)
+        elif op_name == "nlm_request_batch":
+            self.batches.append(args[0])
+
+class TrafficControlTest(TestCase):
+    def test_option_rewrites(self):
+        flags = TC._encode_attr(TC.TCA_U32_FLAGS, struct.pack("=I", 0xA))
+        pcnt = TC._encode_attr(TC.TCA_U32_PCNT, b"\1" * 24)
+        rewrites = TC.OPTION_REWRITES[("filter", "u32")]
+        self.assertEqual(TC._rewrite_attrs(flags + pcnt, rewrites),
+                         TC._encode_attr(TC.TCA_U32_FLAGS,
+                                         struct.pack("=I", 0x2)))
+
+        init = TC._rewrite_attrs(HTB_OPTIONS,
+                                 TC.OPTION_REWRITES[("qdisc", "htb")])
+        self.assertEqual(struct.unpack_from("=I", init, 4)[0], 3)
+        self.assertEqual(len(init), len(HTB_OPTIONS))
+
+    def test_snapshot(self):
+        snap = TC.snapshot(FakeIPRoute(SNAPSHOT), 1)
+        self.assertEqual(snap["qdiscs"][1]["attrs"],
+                         _attrs("htb", TC._rewrite_attrs(
+                             HTB_OPTIONS,
+                             TC.OPTION_REWRITES[("qdisc", "htb")])))
+        self.assertEqual(len(snap["classes"]), 2)
+        self.assertEqual(snap["filters"], SNAPSHOT["filters"])
+
+    def test_create_order(self):
+        trees = TC._trees(SNAPSHOT)
+        self.assertEqual(len(trees[TC.TC_H_INGRESS]), 1)
+        msgs = TC._create_messages(1, trees[TC.TC_H_ROOT])
+        self.assertEqual([(m['header']['type'], m['handle']) for m in msgs],
+                         [(RTM_NEWQDISC, 0x10000),
+                          (RTM_NEWTCLASS, 0x10020),
+                          (RTM_NEWTCLASS, 0x10010),
+                          (RTM_NEWQDISC, 0x200000),
+                          (RTM_NEWTFILTER, 0x80000800)])
+
+    def test_restore(self):
+        snap = TC.snapshot(FakeIPRoute(SNAPSHOT), 1)
+        ipr = FakeIPRoute(snap)
+        self.assertEqual(TC.restore(ipr, 1, snap), 0)
+        self.assertEqual(ipr.batches, [])
+
+        ipr.snap = dict(snap, qdiscs=snap["qdiscs"][:2], filters=[])
+        self.assertEqual(TC.restore(ipr, 1, snap), 2)
+        msgs = ipr.batches[0]
+        self.assertEqual([m['header']['type'] for m in msgs],
+                         [RTM_DELQDISC] + [RTM_NEWQDISC, RTM_NEWTCLASS,
+                                           RTM_NEWTCLASS, RTM_NEWQDISC,
+                                           RTM_NEWTFILTER, RTM_NEWQDISC])
+
+        with self.assertRaises(TC.TrafficControlError):
+            TC.restore(ipr, 1, {"version": 0})
@@ -0,0 +1,187 @@
+import threading
+import multiprocessing
+from unittest import TestCase
+
+from lnst.Common.LnstError import LnstError
+from lnst.Controller.Machine import Machine, MachineError, run_concurrently
+from lnst.Controller.MessageDispatcher import MessageDispatcher
+from lnst.Controller.MessageDispatcher import ConnectionError
+from tests.Agent import import_agent, restore_packages
+
+
+class FakeMachine(object):
+    def __init__(self, m_id):
+        self._id = m_id
+
+    def get_id(self):
+        return self._id
+
+    def get_mapped(self):
+        return True
+
+def serve(connection, replies):
+    """replies to the commands and then closes the connection like a
+    crashed agent"""
+    try:
+        for i in range(replies):
+            msg = connection.recv()
+            connection.send({"type": "result", "result": msg["method_name"],
+                             "request_id": msg["request_id"]})
+    except EOFError:
+        pass
+    connection.close()
+
+class RunConcurrentlyTest(TestCase):
+    def setUp(self):
+        self.dispatcher = MessageDispatcher(None)
+        self.threads = []
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        for thread in self.threads:
+            thread.join()
+
+    def _agent(self, m_id, replies):
+        machine = FakeMachine(m_id)
+        local, remote = multiprocessing.Pipe()
+        self.dispatcher.add_agent(machine, local)
+        self.connections.append(local)
+        thread = threading.Thread(target=serve, args=(remote, replies))
+        thread.start()
+        self.threads.append(thread)
+        return machine
+
+    def _call(self, machine, method_name):
+        return self.dispatcher.post_message(machine, {
+            "type": "command", "method_name": method_name,
+            "args": [], "kwargs": {}})
+
+    def _cleanup_steps(self, machine, log):
+        try:
+            for method_name in ["destroy_devices", "del_namespaces", "bye"]:
+                result, = yield [self._call(machine, method_name)]
+                log.append(result)
+        except ConnectionError as e:
+            log.append(e)
+
+    def test_disconnect_during_cleanup(self):
+        stable = self._agent("stable", 3)
+        crashing = self._agent("crashing", 1)
+
+        stable_log = []
+        crashing_log = []
+        run_concurrently([self._cleanup_steps(crashing, crashing_log),
+                          self._cleanup_steps(stable, stable_log)])
+
+        self.assertEqual(stable_log, ["destroy_devices", "del_namespaces",
+                                      "bye"])
+        self.assertEqual(crashing_log[0], "destroy_devices")
+        self.assertIsInstance(crashing_log[1], ConnectionError)
+
+class BatchMachine(Machine):
+    """executes exec_batch locally, operations named "fail" fail and stop
+    the batch like on the agent"""
+    def __init__(self):
+        self._batch = None
+        self.sent = []
+        self.results = []
+
+    def rpc_call(self, method_name, operations, netns=None):
+        self.sent.append((netns, [op[2] for op in operations]))
+        replies = []
+        for op, index, name, args, kwargs in operations:
+            if name == "fail":
+                replies.append(("exception", LnstError("failed")))
+                break
+            replies.append(("result", name))
+        return replies
+
+    def _add_recipe_result(self, result):
+        self.results.append(result)
+
+    def _get_device_from_database(self, index, netns):
+        return None
+
+class BatchTest(TestCase):
+    def _queue(self, machine, name, netns=None):
+        return machine._queue_batched_call("method", 1, name, (), {}, netns)
+
+    def test_failed_batch(self):
+        machine = BatchMachine()
+        with self.assertRaises(LnstError):
+            with machine.batch():
+                calls = [self._queue(machine, "up"),
+                         self._queue(machine, "fail"),
+                         self._queue(machine, "down"),
+                         self._queue(machine, "up", "ns1")]
+
+        self.assertEqual(machine.sent, [(None, ["up", "fail", "down"])])
+        self.assertEqual(calls[0].result(), "up")
+        self.assertRaises(LnstError, calls[1].result)
+        for call in calls[2:]:
+            self.assertRaises(MachineError, call.result)
+        self.assertEqual(len(machine.results), 2)
+
+    def test_error_in_body(self):
+        machine = BatchMachine()
+        with self.assertRaises(KeyError):
+            with machine.batch():
+                call = self._queue(machine, "up")
+                self._queue(machine, "fail")
+                raise KeyError("body")
+
+        self.assertEqual(call.result(), "up")
+        self.assertIsNone(machine._batch)
+
+class FakeDevice(object):
+    def up(self):
+        return "up"
+
+class FakeInterfaceManager(object):
+    def __init__(self):
+        self.invalidated = []
+
+    def sync_devices(self, replaces_dump=False):
+        pass
+
+    def get_device(self, ifindex, replaces_dump=True):
+        return FakeDevice()
+
+    def invalidate_if_data(self, ifindex):
+        self.invalidated.append(ifindex)
+
+class AgentBatchMachine(BatchMachine):
+    """runs the batches by exec_batch of the agent on fake devices"""
+    def __init__(self, remote_methods):
+        super().__init__()
+        self._if_manager = FakeInterfaceManager()
+        self._exec_batch = remote_methods.exec_batch
+
+    def rpc_call(self, method_name, operations, netns=None):
+        self.sent.append((netns, [op[2] for op in operations]))
+        return self._exec_batch(self, operations)
+
+class AgentBatchTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.remote_methods = import_agent().RemoteMethods
+
+    @classmethod
+    def tearDownClass(cls):
+        restore_packages()
+
+    def test_non_lnst_error(self):
+        machine = AgentBatchMachine(self.remote_methods)
+        with self.assertRaises(AttributeError):
+            with machine.batch():
+                calls = [machine._queue_batched_call("method", i, name, (),
+                                                     {}, None)
+                         for i, name in enumerate(["up", "upp", "up"])]
+
+        self.assertEqual(calls[0].result(), "up")
+        self.assertRaises(AttributeError, calls[1].result)
+        self.assertRaises(MachineError, calls[2].result)
+        self.assertEqual(len(machine.results), 2)
+        self.assertEqual(machine._if_manager.invalidated, [0, 1])
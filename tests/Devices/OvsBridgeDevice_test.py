@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from lnst.Devices.OvsBridgeDevice import parse_dump_flows, _ofctl_errors
+from lnst.Devices.OvsBridgeDevice import OvsFlowError
+
+DUMP_FLOWS = """\
+NXST_FLOW reply (xid=0x4):
+ cookie=0x1f, duration=12.345s, table=0, n_packets=10, n_bytes=980, idle_age=3, priority=100,ip,in_port=1,nw_dst=10.0.0.1 actions=ct(commit,zone=1,exec(load:0x1->NXM_NX_CT_MARK[])),output:2
+ cookie=0x0, duration=1.5s, table=1, n_packets=0, n_bytes=0, idle_timeout=60, send_flow_rem tun_id=0x5 actions=drop
+ cookie=0x0, duration=20.01s, table=0, n_packets=5, n_bytes=300, actions=NORMAL
+"""
+
+class ParseDumpFlowsTest(TestCase):
+    def test_parse(self):
+        flows = parse_dump_flows(DUMP_FLOWS)
+        self.assertEqual(len(flows), 3)
+
+        self.assertEqual(flows[0]["cookie"], 0x1f)
+        self.assertEqual(flows[0]["duration"], 12.345)
+        self.assertEqual(flows[0]["n_bytes"], 980)
+        self.assertEqual(flows[0]["priority"], 100)
+        self.assertEqual(flows[0]["match"], {"ip": None, "in_port": "1",
+                                             "nw_dst": "10.0.0.1"})
+        self.assertEqual(flows[0]["actions"],
+                         ["ct(commit,zone=1,exec(load:0x1->NXM_NX_CT_MARK[]))",
+                          "output:2"])
+
+        self.assertEqual(flows[1]["table"], 1)
+        self.assertEqual(flows[1]["idle_timeout"], 60)
+        self.assertTrue(flows[1]["send_flow_rem"])
+        self.assertEqual(flows[1]["match"], {"tun_id": "0x5"})
+        self.assertEqual(flows[1]["actions"], ["drop"])
+
+        self.assertNotIn("priority", flows[2])
+        self.assertEqual(flows[2]["match"], {})
+        self.assertEqual(flows[2]["actions"], ["NORMAL"])
+
+class OfctlErrorsTest(TestCase):
+    def test_errors(self):
+        entries = ["ip,actions=drop", "ip,nw_dst=10.0.0.300,actions=drop"]
+        stderr = ("ovs-ofctl: /tmp/lnst-flows-x.txt:2: 10.0.0.300: "
+                  "invalid IP address\n"
+                  "OFPT_ERROR (OF1.4): OFPBFC_MSG_FAILED\n")
+        errors = _ofctl_errors(stderr, "/tmp/lnst-flows-x.txt", entries)
+        self.assertEqual(errors, [
+            (1, entries[1], "10.0.0.300: invalid IP address"),
+            (None, None, "OFPT_ERROR (OF1.4): OFPBFC_MSG_FAILED")])
+
+        error = OvsFlowError("failed", errors)
+        self.assertIn("flow 1 '{}'".format(entries[1]), str(error))
+        # exceptions are pickled by the Agent
+        self.assertEqual(OvsFlowError(*error.args).errors, errors)